@@ -0,0 +1,6 @@
+"""
+End-to-end benchmarks of kanki exports, run with: python -m benchmarks --help
+
+Exports a synthetic Kindle vocabulary file against a local stand-in for the Merriam-Webster API, so the numbers don't
+depend on the network or spend any API queries.
+"""
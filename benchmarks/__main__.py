@@ -0,0 +1,4 @@
+from benchmarks.bench import main
+
+if __name__ == '__main__':
+    main()
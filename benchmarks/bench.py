@@ -0,0 +1,165 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from tabulate import tabulate
+
+from benchmarks.fake_api import running_server
+from benchmarks.synthetic_vocab import generate_vocab_db
+from kanki.cache import LookupCache
+from kanki.merriam_webster import MWDictionary
+from kanki.run import Kanki
+from kanki.vocab import VocabDB
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', datefmt='%H:%M:%S')
+    args = get_arg_parser().parse_args()
+    if args.jobs < 1:
+        get_arg_parser().error('--jobs must be at least 1')
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='kanki_bench_')
+    os.makedirs(workdir, exist_ok=True)
+    server_options = {'latency': args.latency / 1000, 'jitter': args.jitter / 1000, 'error_rate': args.error_rate,
+                      'throttle_rate': args.throttle_rate, 'suggestion_rate': args.suggestion_rate, 'seed': args.seed}
+    results = []
+    with running_server(**server_options) as url:
+        for lookups in args.lookups:
+            db_path = os.path.join(workdir, f'vocab_{lookups}_{args.books or 0}_{args.vocabulary or 0}_{args.seed}.db')
+            generation_time = None
+            if not os.path.exists(db_path):
+                print(f'Generating a vocabulary file with {lookups} lookups...', file=sys.stderr)
+                start = time.perf_counter()
+                generate_vocab_db(db_path, lookups, args.books, args.vocabulary, args.seed)
+                generation_time = time.perf_counter() - start
+
+            print(f'Exporting {lookups} lookups...', file=sys.stderr)
+            export_dir = tempfile.mkdtemp(prefix=f'export_{lookups}_', dir=workdir)
+            # Every export runs in a fresh process, so its peak memory isn't inflated by the previous ones
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                result = executor.submit(measure_export, db_path, export_dir, url, args.jobs, args.cache,
+                                         args.trace_memory).result()
+            result['generation_s'] = generation_time
+            results.append(result)
+
+    print(tabulate([[r['lookups'], r['books'], r['queries'], f'{r["wall_s"]:.2f}', f'{r["lookups_per_s"]:.0f}',
+                     f'{r["peak_memory_mb"]:.1f}' if r['peak_memory_mb'] is not None else '-'] for r in results],
+                   headers=['Lookups', 'Books', 'API queries', 'Wall time (s)', 'Lookups/s', 'Peak memory (MB)']))
+    if args.results:
+        record_results(args.results, results, {'jobs': args.jobs, 'cache': args.cache, **server_options})
+        print(f'\nResults appended to "{args.results}".')
+    if not args.workdir:
+        shutil.rmtree(workdir)
+
+
+def measure_export(db_path: str, export_dir: str, url: str, jobs: int, cache: bool, trace_memory: bool) -> Dict:
+    """Export every book in the vocabulary file and return how long it took and how much memory it used."""
+    logging.disable(logging.ERROR)  # failed lookups are expected, they are counted in the export files instead
+    os.chdir(export_dir)
+    if trace_memory:
+        import tracemalloc
+        tracemalloc.start()
+
+    vocab = VocabDB.open(db_path)
+    books = vocab.catalog()
+    lookup_cache = LookupCache(os.path.join(export_dir, LookupCache.default_path)) if cache else None
+    dictionary = MWDictionary('benchmark', lookup_cache, pool_size=jobs, api_base_url=url)
+    dictionary.max_queries = None  # the stand-in API has no daily limit, export every lookup
+    kanki = Kanki(dictionary=dictionary, vocab=vocab, book_titles=[book.title for book in books], jobs=jobs)
+    lookups = sum(book.lookups for book in books)
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        start = time.perf_counter()
+        kanki.export_book_lookups()
+        wall_time = time.perf_counter() - start
+
+    return {
+        'lookups': lookups,
+        'books': len(books),
+        'queries': dictionary.queries_made,
+        'wall_s': wall_time,
+        'lookups_per_s': lookups / wall_time,
+        'peak_memory_mb': peak_memory_mb(trace_memory),
+        'memory_measure': 'tracemalloc' if trace_memory else 'max_rss',
+    }
+
+
+def peak_memory_mb(trace_memory: bool) -> Optional[float]:
+    """Return the peak memory of this process, or of the Python objects allocated if tracing memory."""
+    if trace_memory:
+        import tracemalloc
+        return tracemalloc.get_traced_memory()[1] / 2 ** 20
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2 ** 20 if sys.platform == 'darwin' else max_rss / 2 ** 10  # bytes on macOS, KiB elsewhere
+
+
+def record_results(path: str, results, parameters: Dict) -> None:
+    """Append the results to a JSON lines file, so they can be compared between revisions of kanki."""
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                  check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    with open(path, 'a', encoding='utf-8') as f:
+        for result in results:
+            record = {'date': datetime.now(timezone.utc).isoformat(timespec='seconds'), 'revision': revision,
+                      **parameters, **result}
+            f.write(json.dumps(record) + '\n')
+
+
+def get_arg_parser():
+    arg_parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                         description='Benchmark kanki exports of synthetic vocabulary files against a '
+                                                     'local stand-in for the Merriam-Webster API.')
+    arg_parser.add_argument('-n', '--lookups', type=int, nargs='+', default=[1000, 10_000], metavar='N',
+                            help='number of lookups in the vocabulary file, several sizes are benchmarked one after '
+                                 'another (default: 1000 10000)')
+    arg_parser.add_argument('--books', type=int, metavar='N',
+                            help='number of books (default: one per thousand lookups)')
+    arg_parser.add_argument('--vocabulary', type=int, metavar='N',
+                            help='number of different words (default: a tenth of the lookups)')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=Kanki.default_jobs, metavar='N',
+                            help=f'number of concurrent dictionary lookups (default: {Kanki.default_jobs})')
+    arg_parser.add_argument('--latency', type=float, default=20, metavar='MS',
+                            help='milliseconds the API takes to answer a query (default: 20)')
+    arg_parser.add_argument('--jitter', type=float, default=10, metavar='MS',
+                            help='up to this many milliseconds are randomly added to the latency (default: 10)')
+    arg_parser.add_argument('--error-rate', type=float, default=0.0, metavar='RATE',
+                            help='share of queries answered with 503 Service Unavailable (default: 0)')
+    arg_parser.add_argument('--throttle-rate', type=float, default=0.0, metavar='RATE',
+                            help='share of queries answered with 429 Too Many Requests (default: 0)')
+    arg_parser.add_argument('--suggestion-rate', type=float, default=0.05, metavar='RATE',
+                            help='share of words missing from the dictionary, answered with a list of suggestions '
+                                 '(default: 0.05)')
+    arg_parser.add_argument('--cache',
+                            help='export through a lookup cache, empty at the start of the export',
+                            action='store_true')
+    arg_parser.add_argument('--trace-memory',
+                            help='measure the peak memory of Python objects with tracemalloc instead of the peak '
+                                 'resident memory, slows the export down',
+                            action='store_true')
+    arg_parser.add_argument('--seed', type=int, default=0,
+                            help='seed of the generated vocabulary and API responses (default: 0)')
+    arg_parser.add_argument('--workdir', metavar='DIR',
+                            help='where to keep the generated vocabulary files, which are reused by later runs '
+                                 '(default: a new temporary directory)')
+    arg_parser.add_argument('--results', metavar='PATH',
+                            help='append the results to this JSON lines file')
+    return arg_parser
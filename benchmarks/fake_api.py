@@ -0,0 +1,135 @@
+import json
+import logging
+import multiprocessing
+import random
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator, Optional
+from urllib.parse import unquote, urlsplit
+
+API_PATH = '/api/v3/references/learners/json/'
+
+
+class FakeMWServer(ThreadingHTTPServer):
+    """
+    A local stand-in for the Merriam-Webster's Learner's Dictionary API, answering every query with a made up entry.
+
+    Whether a word is in the dictionary is decided by the word itself, so it is the same on every query, while errors
+    are random like on a real server under load.
+    """
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 suggestion_rate: float = 0.0, throttle_rate: float = 0.0, retry_after: float = 0.0, seed: int = 0):
+        """
+        :param port: port to listen on, 0 picks a free one
+        :param latency: seconds to wait before answering a query
+        :param jitter: up to this many seconds are randomly added to the latency
+        :param error_rate: share of queries answered with 503 Service Unavailable
+        :param suggestion_rate: share of words that aren't in the dictionary, answered with a list of suggestions
+        :param throttle_rate: share of queries answered with 429 Too Many Requests
+        :param retry_after: seconds to wait before retrying that 429 responses ask for
+        """
+        super().__init__(('127.0.0.1', port), FakeMWHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.suggestion_rate = suggestion_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.seed = seed
+        self.queries = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def handle_error(self, request, client_address) -> None:
+        # Clients that time out close the connection before the answer is written, which is expected
+        logging.debug('Error answering %s', client_address, exc_info=True)
+
+    @property
+    def url(self) -> str:
+        """The base URL to give MWDictionary."""
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}{API_PATH}'
+
+    def next_delay_and_error(self):
+        """Return the seconds to wait before answering the next query, and its error status if it should fail."""
+        with self._lock:
+            self.queries += 1
+            delay, draw = self.latency + self._rng.uniform(0, self.jitter), self._rng.random()
+        if draw < self.error_rate:
+            return delay, 503
+        if draw < self.error_rate + self.throttle_rate:
+            return delay, 429
+        return delay, None
+
+    def entry(self, word: str) -> list:
+        """Return the API response for a word."""
+        rng = random.Random(f'{self.seed}:{word}')
+        if rng.random() < self.suggestion_rate:
+            return [word + suffix for suffix in ('e', 'er', 'ly')]
+        return [{
+            'meta': {'id': word, 'stems': [word, word + 's', word + 'ed', word + 'ing']},
+            'hwi': {'hw': word, 'prs': [{'ipa': 'ˈ' + word}]},
+            'fl': 'verb',
+            'shortdef': [f'to {word} something {i + 1}' for i in range(rng.randint(1, 3))],
+        }]
+
+
+class FakeMWHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep connections alive like the real API
+    disable_nagle_algorithm = True  # headers and body are sent separately, don't delay the body
+    server: FakeMWServer
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        delay, error = self.server.next_delay_and_error()
+        if delay:
+            time.sleep(delay)
+
+        if not url.path.startswith(API_PATH) or 'key=' not in url.query:
+            self.send_json(404, {'error': 'Not Found'})
+        elif error == 429:
+            self.send_json(429, {'error': 'Too Many Requests'}, {'Retry-After': f'{self.server.retry_after:g}'})
+        elif error:
+            self.send_json(503, {'error': 'Service Unavailable'})
+        else:
+            self.send_json(200, self.server.entry(unquote(url.path[len(API_PATH):])))
+
+    def send_json(self, status: int, body, headers: Optional[dict] = None) -> None:
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args) -> None:
+        logging.debug(format, *args)
+
+
+@contextmanager
+def running_server(**options) -> Iterator[str]:
+    """
+    Run a FakeMWServer with the given options in a separate process, yielding its URL.
+
+    The server gets a process of its own, so it doesn't compete with the code being benchmarked for the GIL.
+    """
+    urls = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(urls, options), daemon=True)
+    process.start()
+    try:
+        yield urls.get(timeout=10)
+    finally:
+        process.terminate()
+        process.join()
+
+
+def serve(urls: multiprocessing.Queue, options: dict) -> None:
+    with FakeMWServer(**options) as server:
+        urls.put(server.url)
+        server.serve_forever()
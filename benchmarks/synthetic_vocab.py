@@ -0,0 +1,95 @@
+import itertools
+import os
+import random
+import sqlite3
+from typing import Iterator, List, Optional, Tuple, Union
+
+# The schema of vocab.db on a Kindle
+SCHEMA = '''
+    CREATE TABLE WORDS (id TEXT PRIMARY KEY NOT NULL UNIQUE, word TEXT, stem TEXT, lang TEXT,
+                        category INTEGER DEFAULT 0, timestamp INTEGER DEFAULT 0, profileid TEXT);
+    CREATE TABLE LOOKUPS (id TEXT PRIMARY KEY NOT NULL UNIQUE, word_key TEXT, book_key TEXT, dict_key TEXT, pos TEXT,
+                          usage TEXT, timestamp INTEGER DEFAULT 0);
+    CREATE TABLE BOOK_INFO (id TEXT PRIMARY KEY NOT NULL UNIQUE, asin TEXT, guid TEXT, lang TEXT, title TEXT,
+                            authors TEXT);
+    CREATE TABLE DICT_INFO (id TEXT PRIMARY KEY NOT NULL UNIQUE, asin TEXT, langin TEXT, langout TEXT);
+    CREATE TABLE METADATA (id TEXT PRIMARY KEY NOT NULL UNIQUE, dsname TEXT, sscnt INTEGER, profileid TEXT);
+    CREATE TABLE VERSION (id TEXT PRIMARY KEY NOT NULL UNIQUE, dsname TEXT, value INTEGER);
+    CREATE INDEX bookkey ON LOOKUPS (book_key);
+    CREATE INDEX wordkey ON LOOKUPS (word_key);
+    CREATE INDEX wordstem ON WORDS (stem);
+'''
+
+DICT_KEY = 'B003ODIZL6'  # the Kindle's English dictionary
+SUFFIXES = ('', 's', 'ed', 'ing')  # inflections of every generated word
+FIRST_TIMESTAMP = 1_500_000_000_000  # milliseconds since the epoch
+
+
+def generate_vocab_db(path: Union[str, os.PathLike], lookups: int, books: Optional[int] = None,
+                      vocabulary: Optional[int] = None, seed: int = 0) -> None:
+    """
+    Write a vocabulary file with the given number of lookups, in the schema used by the Kindle.
+
+    Words are drawn from a vocabulary of made up word stems with a Zipf-like distribution, like in real reading where a
+    few words are looked up again and again, and every lookup uses one of the inflections of its stem. Lookups are
+    spread over the books in the order they were read.
+
+    :param books: number of books, by default one per thousand lookups
+    :param vocabulary: number of word stems, by default a tenth of the lookups
+    """
+    books = books or max(1, lookups // 1000)
+    vocabulary = vocabulary or max(1, lookups // 10)
+    rng = random.Random(seed)
+    stems = unique_words(rng, vocabulary)
+
+    if os.path.exists(path):
+        os.remove(path)
+    connection = sqlite3.connect(path)
+    try:
+        with connection:
+            connection.executescript(SCHEMA)
+            connection.execute('INSERT INTO DICT_INFO VALUES (?, ?, ?, ?)', (DICT_KEY, DICT_KEY, 'en', 'en'))
+            connection.execute('INSERT INTO VERSION VALUES (?, ?, ?)', ('userdb_version', 'WORDS', 1))
+            connection.executemany('INSERT INTO BOOK_INFO VALUES (?, ?, ?, ?, ?, ?)',
+                                   (book_row(i) for i in range(books)))
+            connection.executemany('INSERT INTO WORDS VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                   ((f'en:{stem}{suffix}', stem + suffix, stem, 'en', 0, FIRST_TIMESTAMP, '')
+                                    for stem in stems for suffix in SUFFIXES))
+            connection.executemany('INSERT INTO LOOKUPS VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                   lookup_rows(rng, stems, lookups, books))
+    finally:
+        connection.close()
+
+
+def book_row(i: int) -> Tuple[str, str, str, str, str, str]:
+    key = f'CR!{i:020d}'
+    return key, f'B{i:09d}', key, 'en', f'Synthetic Book {i + 1}', f'Author, Number {i % 50 + 1}'
+
+
+def lookup_rows(rng: random.Random, stems: List[str], lookups: int,
+                books: int) -> Iterator[Tuple[str, str, str, str, str, str, int]]:
+    # Zipf-like weights, the cumulative sums let random.choices pick from a large vocabulary quickly
+    cumulative_weights = list(itertools.accumulate(1 / rank for rank in range(1, len(stems) + 1)))
+    lookups_per_book = -(-lookups // books)
+    timestamp = FIRST_TIMESTAMP
+    for i in range(lookups):
+        book_key = book_row(i // lookups_per_book)[0]
+        stem = rng.choices(stems, cum_weights=cumulative_weights)[0]
+        word = stem + rng.choice(SUFFIXES)
+        timestamp += rng.randint(1_000, 600_000)
+        usage = f'It was the {word} of a sentence number {i}, read on page {i % 400 + 1}.'
+        yield f'{book_key}:{i}', f'en:{word}', book_key, DICT_KEY, str(i), usage, timestamp
+
+
+def unique_words(rng: random.Random, count: int) -> List[str]:
+    """Return the given number of different pronounceable words."""
+    consonants, vowels = 'bcdfghjklmnprstvwz', 'aeiou'
+    words = set()
+    length = 2  # syllables, longer words are used as the short ones run out
+    while len(words) < count:
+        for _ in range(count - len(words)):
+            words.add(''.join(rng.choice(consonants) + rng.choice(vowels) for _ in range(length)))
+        length += 1
+    words = sorted(words)  # sets of strings are ordered differently every run
+    rng.shuffle(words)
+    return words
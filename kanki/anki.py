@@ -0,0 +1,269 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import time
+import zipfile
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+from kanki.cache import Entry
+from kanki.card import CardBatch
+from kanki.exceptions import UnsupportedCollectionError
+from kanki.vocab import Lookup
+
+# The collection format of Anki 2.0, which every later version can still import
+SCHEMA_VERSION = 11
+SCHEMA = '''
+    CREATE TABLE col (id integer PRIMARY KEY, crt integer NOT NULL, mod integer NOT NULL, scm integer NOT NULL,
+                      ver integer NOT NULL, dty integer NOT NULL, usn integer NOT NULL, ls integer NOT NULL,
+                      conf text NOT NULL, models text NOT NULL, decks text NOT NULL, dconf text NOT NULL,
+                      tags text NOT NULL);
+    CREATE TABLE notes (id integer PRIMARY KEY, guid text NOT NULL, mid integer NOT NULL, mod integer NOT NULL,
+                        usn integer NOT NULL, tags text NOT NULL, flds text NOT NULL, sfld integer NOT NULL,
+                        csum integer NOT NULL, flags integer NOT NULL, data text NOT NULL);
+    CREATE TABLE cards (id integer PRIMARY KEY, nid integer NOT NULL, did integer NOT NULL, ord integer NOT NULL,
+                        mod integer NOT NULL, usn integer NOT NULL, type integer NOT NULL, queue integer NOT NULL,
+                        due integer NOT NULL, ivl integer NOT NULL, factor integer NOT NULL, reps integer NOT NULL,
+                        lapses integer NOT NULL, left integer NOT NULL, odue integer NOT NULL, odid integer NOT NULL,
+                        flags integer NOT NULL, data text NOT NULL);
+    CREATE TABLE revlog (id integer PRIMARY KEY, cid integer NOT NULL, usn integer NOT NULL, ease integer NOT NULL,
+                         ivl integer NOT NULL, lastIvl integer NOT NULL, factor integer NOT NULL,
+                         time integer NOT NULL, type integer NOT NULL);
+    CREATE TABLE graves (usn integer NOT NULL, oid integer NOT NULL, type integer NOT NULL);
+    CREATE INDEX ix_notes_usn ON notes (usn);
+    CREATE INDEX ix_cards_usn ON cards (usn);
+    CREATE INDEX ix_revlog_usn ON revlog (usn);
+    CREATE INDEX ix_cards_nid ON cards (nid);
+    CREATE INDEX ix_cards_sched ON cards (did, queue, due);
+    CREATE INDEX ix_revlog_cid ON revlog (cid);
+    CREATE INDEX ix_notes_csum ON notes (csum);
+'''
+
+MODEL_ID = 1655241240717  # the same in every export, so Anki recognizes notes of earlier exports
+DECK_ID = 1655241240718
+NOTE_FIELDS = ('Word', 'Pronunciation', 'Sentence', 'Definitions', 'Book', 'Author')  # in the order of CardBatch
+FRONT_TEMPLATE = '<div class="sentence">{{Sentence}}</div>\n<div class="word">{{Word}}</div>'
+BACK_TEMPLATE = ('{{FrontSide}}\n\n<hr id=answer>\n\n'
+                 '{{#Pronunciation}}<div class="pronunciation">[{{Pronunciation}}]</div>{{/Pronunciation}}\n'
+                 '<div class="definitions">{{Definitions}}</div>\n'
+                 '<div class="source">{{Book}}, {{Author}}</div>')
+CSS = '''.card { font-family: arial; font-size: 20px; text-align: center; color: black; background-color: white; }
+.word { font-size: 28px; margin-top: 12px; }
+.pronunciation, .source { color: grey; }
+.source { font-size: 14px; margin-top: 12px; }'''
+
+GUID_ALPHABET = ('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+                 '!#$%&()*+,-./:;<=>?@[]^_`{|}~')  # the base 91 digits of Anki's own GUIDs
+HTML_TAG = re.compile(r'<[^>]*>')
+
+
+class AnkiCollection:
+    """
+    The kanki notes in an Anki collection file, in the collection format of Anki 2.0.
+
+    Notes are identified by a GUID derived from the id of their Kindle lookup, so writing the same lookup again updates
+    its note in place, in this collection and in any collection the notes are imported into.
+    """
+
+    def __init__(self, path: Union[str, os.PathLike], deck: str = 'kanki'):
+        """Open the collection file, creating it if it doesn't exist, and add the kanki note type and deck to it."""
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            if not self.connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'col'").fetchone():
+                self.create()
+            version, conf, models, decks = self.connection.execute(
+                'SELECT ver, conf, models, decks FROM col').fetchone()
+            if version == SCHEMA_VERSION:
+                self.deck_id = self.add_note_type_and_deck(json.loads(models), json.loads(decks), deck)
+        if version != SCHEMA_VERSION:
+            self.connection.close()
+            raise UnsupportedCollectionError(
+                f'"{os.fsdecode(path)}" is a collection of a newer version of Anki, which kanki can\'t write to. '
+                f'Export an Anki package (.apkg) instead.')
+
+        self._conf = json.loads(conf)
+        self._notes: Dict[str, int] = dict(self.connection.execute(
+            'SELECT guid, id FROM notes WHERE mid = ?', (MODEL_ID, )))  # guid -> note id
+        self._note_ids: Set[int] = set(row[0] for row in self.connection.execute('SELECT id FROM notes'))
+        self._card_ids: Set[int] = set(row[0] for row in self.connection.execute('SELECT id FROM cards'))
+
+    def create(self) -> None:
+        now = time.time()
+        conf = {'nextPos': 1, 'estTimes': True, 'activeDecks': [1], 'sortType': 'noteFld', 'timeLim': 0,
+                'sortBackwards': False, 'addToCur': True, 'curDeck': 1, 'newSpread': 0, 'dueCounts': True,
+                'curModel': MODEL_ID, 'collapseTime': 1200, 'schedVer': 2}
+        dconf = {'1': {'id': 1, 'mod': 0, 'name': 'Default', 'usn': 0, 'maxTaken': 60, 'autoplay': True, 'timer': 0,
+                       'replayq': True, 'dyn': False,
+                       'new': {'bury': False, 'delays': [1.0, 10.0], 'initialFactor': 2500, 'ints': [1, 4, 0],
+                               'order': 1, 'perDay': 20},
+                       'rev': {'bury': False, 'ease4': 1.3, 'ivlFct': 1.0, 'maxIvl': 36500, 'perDay': 200,
+                               'hardFactor': 1.2},
+                       'lapse': {'delays': [10.0], 'leechAction': 1, 'leechFails': 8, 'minInt': 1, 'mult': 0.0}}}
+        self.connection.executescript(SCHEMA)
+        self.connection.execute('INSERT INTO col VALUES (1, ?, ?, ?, ?, 0, 0, 0, ?, ?, ?, ?, ?)',
+                                (int(now // 86400 * 86400), int(now * 1000), int(now * 1000), SCHEMA_VERSION,
+                                 json.dumps(conf), '{}', json.dumps({'1': AnkiCollection.deck(1, 'Default')}),
+                                 json.dumps(dconf), '{}'))
+
+    def add_note_type_and_deck(self, models: dict, decks: dict, deck_name: str) -> int:
+        """Add the kanki note type and the deck to the collection if they're missing, returning the id of the deck."""
+        changed = False
+        if str(MODEL_ID) not in models:
+            models[str(MODEL_ID)] = AnkiCollection.note_type()
+            changed = True
+
+        deck_id = next((int(d['id']) for d in decks.values() if d['name'] == deck_name), None)
+        if deck_id is None:
+            deck_id = DECK_ID
+            while str(deck_id) in decks:
+                deck_id += 1
+            decks[str(deck_id)] = AnkiCollection.deck(deck_id, deck_name)
+            changed = True
+
+        if changed:
+            self.connection.execute('UPDATE col SET models = ?, decks = ?, mod = ?',
+                                    (json.dumps(models), json.dumps(decks), int(time.time() * 1000)))
+        return deck_id
+
+    def upsert(self, batch: CardBatch, lookups: List[Tuple[str, int]]) -> Tuple[int, int]:
+        """
+        Add the cards of the batch as notes, or update the notes if their lookups were written before. Everything is
+        written in a single transaction. Returns the number of notes added and updated.
+
+        :param lookups: the id and timestamp of the lookup of every card in the batch
+        """
+        now = int(time.time())
+        new_notes, new_cards, updated_notes = [], [], []
+        due = self._conf.get('nextPos', 1)
+        for fields, (lookup_id, timestamp) in zip(zip(*batch.columns()), lookups):
+            fields = '\x1f'.join('' if field is None else field for field in fields)
+            sort_field = HTML_TAG.sub('', fields[:fields.index('\x1f')])
+            checksum = AnkiCollection.field_checksum(sort_field)
+            guid = AnkiCollection.guid(lookup_id)
+            note_id = self._notes.get(guid)
+            if note_id is not None:
+                updated_notes.append((now, fields, sort_field, checksum, note_id))
+                continue
+
+            # Note and card ids are creation times in milliseconds, use the time of the lookup if it's free
+            note_id = timestamp
+            while note_id in self._note_ids or note_id in self._card_ids:
+                note_id += 1
+            self._notes[guid] = note_id
+            self._note_ids.add(note_id)
+            self._card_ids.add(note_id)
+            new_notes.append((note_id, guid, MODEL_ID, now, -1, '', fields, sort_field, checksum, 0, ''))
+            new_cards.append((note_id, note_id, self.deck_id, 0, now, -1, 0, 0, due, 0, 0, 0, 0, 0, 0, 0, 0, ''))
+            due += 1
+
+        self._conf['nextPos'] = due
+        with self.connection:
+            self.connection.executemany('INSERT INTO notes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', new_notes)
+            self.connection.executemany(f'INSERT INTO cards VALUES ({", ".join(["?"] * 18)})', new_cards)
+            self.connection.executemany('UPDATE notes SET mod = ?, usn = -1, flds = ?, sfld = ?, csum = ? '
+                                        'WHERE id = ?', updated_notes)
+            self.connection.execute('UPDATE col SET mod = ?, conf = ?', (now * 1000, json.dumps(self._conf)))
+        return len(new_notes), len(updated_notes)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    @staticmethod
+    def guid(lookup_id: str) -> str:
+        """Return a GUID for the note of a lookup, in the base 91 format Anki uses, always the same for a lookup."""
+        number = int.from_bytes(hashlib.blake2b(f'kanki:{lookup_id}'.encode('utf-8'), digest_size=8).digest(), 'big')
+        digits = []
+        while number:
+            number, digit = divmod(number, len(GUID_ALPHABET))
+            digits.append(GUID_ALPHABET[digit])
+        return ''.join(reversed(digits)) or GUID_ALPHABET[0]
+
+    @staticmethod
+    def field_checksum(text: str) -> int:
+        """The checksum of the sort field Anki uses to find duplicates."""
+        return int(hashlib.sha1(text.encode('utf-8')).hexdigest()[:8], 16)
+
+    @staticmethod
+    def note_type() -> dict:
+        return {
+            'id': MODEL_ID, 'name': 'kanki', 'type': 0, 'mod': int(time.time()), 'usn': -1, 'sortf': 0, 'did': None,
+            'flds': [{'name': name, 'ord': i, 'sticky': False, 'rtl': False, 'font': 'Arial', 'size': 20, 'media': []}
+                     for i, name in enumerate(NOTE_FIELDS)],
+            'tmpls': [{'name': 'Card 1', 'ord': 0, 'qfmt': FRONT_TEMPLATE, 'afmt': BACK_TEMPLATE, 'bqfmt': '',
+                       'bafmt': '', 'did': None}],
+            'css': CSS,
+            'latexPre': '\\documentclass[12pt]{article}\n\\special{papersize=3in,5in}\n\\usepackage[utf8]{inputenc}\n'
+                        '\\usepackage{amssymb,amsmath}\n\\pagestyle{empty}\n\\setlength{\\parindent}{0in}\n'
+                        '\\begin{document}\n',
+            'latexPost': '\\end{document}',
+            'req': [[0, 'any', [0, 2]]],
+            'tags': [],
+            'vers': [],
+        }
+
+    @staticmethod
+    def deck(deck_id: int, name: str) -> dict:
+        return {'id': deck_id, 'mod': int(time.time()), 'name': name, 'usn': -1, 'lrnToday': [0, 0],
+                'revToday': [0, 0], 'newToday': [0, 0], 'timeToday': [0, 0], 'collapsed': False, 'desc': '',
+                'dyn': 0, 'conf': 1, 'extendNew': 0, 'extendRev': 0}
+
+
+class AnkiWriter:
+    """
+    Writes cards straight into an Anki collection file (.anki2), or into an Anki package (.apkg) to import into Anki.
+
+    Like ExportWriter, cards are collected in a batch and every flushed batch is written in a single transaction. A
+    package is only written when the writer is closed, flushed cards are in a temporary collection until then.
+    """
+
+    def __init__(self, path: Union[str, os.PathLike], deck: str = 'kanki'):
+        self.path = path
+        self.count = 0  # number of cards written
+        self.added, self.updated = 0, 0  # number of notes added to and updated in the collection
+        self.is_package = os.fsdecode(path).lower().endswith('.apkg')
+        self.package_written = False  # true once the cards of a package are in the package file
+        self._collection_path: Union[str, os.PathLike] = path
+        if self.is_package:
+            # A package is a zipped collection, build the collection next to it and zip it when done
+            fd, self._collection_path = tempfile.mkstemp(suffix='.anki2', dir=os.path.dirname(os.path.abspath(path)))
+            os.close(fd)
+            os.remove(self._collection_path)
+        self.collection = AnkiCollection(self._collection_path, deck)
+        self._batch = CardBatch()
+        self._lookups: List[Tuple[str, int]] = []  # id and timestamp of the lookup of every card in the batch
+
+    def write_lookup(self, lookup: Lookup, entry: Optional[Entry]) -> None:
+        word_stem, definitions, ipa = entry if entry is not None else (lookup.word, [], None)
+        self._batch.append(word_stem, ipa, lookup.usage, '; '.join(definitions), lookup.title, lookup.authors,
+                           lookup.word)
+        self._lookups.append((lookup.id, lookup.timestamp))
+        self.count += 1
+
+    def flush(self) -> None:
+        if self._batch:
+            added, updated = self.collection.upsert(self._batch, self._lookups)
+            self.added += added
+            self.updated += updated
+            self._batch.clear()
+            self._lookups.clear()
+
+    def close(self) -> None:
+        self.flush()
+        self.collection.close()
+        if self.is_package:
+            temporary_path = f'{os.fsdecode(self.path)}.tmp'
+            with zipfile.ZipFile(temporary_path, 'w', zipfile.ZIP_DEFLATED) as package:
+                package.write(self._collection_path, 'collection.anki2')
+                package.writestr('media', '{}')
+            os.replace(temporary_path, self.path)
+            self.package_written = True
+            os.remove(self._collection_path)
+
+    def __enter__(self) -> 'AnkiWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
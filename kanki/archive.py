@@ -0,0 +1,62 @@
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import List, Tuple, Union
+
+
+class ResponseArchive:
+    """
+    An append-only store of the raw responses of the dictionary API, compressed and keyed by word.
+
+    Lookups only keep a few fields of a response, so when the parsing of responses improves, e.g. a new fallback for
+    pronunciations, the archive lets cards be rebuilt from the responses of earlier lookups instead of spending the API
+    quota again. Responses are never updated or removed, a word looked up again gets a new row and the most recent
+    response of a word is the one used.
+    """
+    default_path = 'kanki_responses.db'
+    fallback_path = 'kanki_responses_fallback.db'  # the responses of --fallback-url, parsed after the primary ones
+
+    def __init__(self, path: Union[str, bytes, os.PathLike] = default_path):
+        self.path = path
+        # Lookups may be made from several threads, so guard the connection with a lock
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS responses (
+                                       id INTEGER PRIMARY KEY,
+                                       word TEXT NOT NULL,
+                                       fetched REAL NOT NULL,
+                                       body BLOB NOT NULL)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_word ON responses (word)')
+        self.connection.commit()
+
+    @staticmethod
+    def normalize(word: str) -> str:
+        return word.strip().lower()
+
+    def add(self, word: str, body: bytes) -> None:
+        """Archive the raw body of the API response to a lookup of a word."""
+        compressed = zlib.compress(body)
+        with self._lock:
+            self.connection.execute('INSERT INTO responses (word, fetched, body) VALUES (?, ?, ?)',
+                                    (ResponseArchive.normalize(word), time.time(), compressed))
+            self.connection.commit()
+
+    def latest(self) -> List[Tuple[str, bytes]]:
+        """Return the most recent response of every word, still compressed, see decompress()."""
+        with self._lock:
+            return self.connection.execute('SELECT word, body FROM responses WHERE id IN '
+                                           '(SELECT MAX(id) FROM responses GROUP BY word) ORDER BY word').fetchall()
+
+    @staticmethod
+    def decompress(body: bytes) -> bytes:
+        return zlib.decompress(body)
+
+    def __len__(self) -> int:
+        """Return the number of words with an archived response."""
+        with self._lock:
+            return self.connection.execute('SELECT COUNT(DISTINCT word) FROM responses').fetchone()[0]
+
+    def close(self) -> None:
+        self.connection.close()
@@ -0,0 +1,240 @@
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from kanki.exceptions import InvalidBundleError
+
+Entry = Tuple[str, List[str], Optional[str]]  # (word stem, definitions, pronunciation)
+
+
+class LookupCache:
+    """
+    An on-disk cache of dictionary lookups, so words resolved in earlier runs don't have to be queried again.
+
+    Entries are keyed by the normalized query word and expire after a configurable number of days. When the cache
+    grows beyond its maximum size, the least recently used entries are evicted.
+
+    The cache also remembers the inflected forms of every cached word, e.g. "ran" and "running" for "run", so a lookup
+    of any of them is answered by the entry of their headword.
+    """
+    default_path = 'kanki_cache.db'
+    default_bundle_path = 'kanki_cache.json.gz'
+    bundle_format = 'kanki-cache'
+    bundle_version = 1
+    default_ttl_days = 180
+    default_max_entries = 100_000
+
+    def __init__(self, path: Union[str, bytes, os.PathLike] = default_path,
+                 ttl_days: Optional[float] = default_ttl_days, max_entries: Optional[int] = default_max_entries,
+                 refresh: bool = False):
+        """
+        :param ttl_days: days before an entry is considered stale, None or 0 to never expire entries
+        :param max_entries: maximum number of entries kept, None or 0 for no limit
+        :param refresh: ignore existing entries, but still store new ones
+        """
+        self.path = path
+        self.ttl_days = ttl_days
+        self.max_entries = max_entries
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self.inflection_hits = 0  # hits on the entry of a headword, for a lookup of one of its inflections
+
+        # Lookups may be made from several threads, so guard the connection with a lock
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS lookups (
+                                       word TEXT PRIMARY KEY,
+                                       word_stem TEXT NOT NULL,
+                                       definitions TEXT NOT NULL,
+                                       ipa TEXT,
+                                       created REAL NOT NULL,
+                                       accessed REAL NOT NULL)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS lookups_accessed ON lookups (accessed)')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS forms (
+                                       form TEXT PRIMARY KEY,
+                                       word TEXT NOT NULL)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS forms_word ON forms (word)')
+        self.connection.commit()
+        self._size = self.connection.execute('SELECT COUNT(*) FROM lookups').fetchone()[0]
+
+    @staticmethod
+    def normalize(word: str) -> str:
+        return word.strip().lower()
+
+    def get(self, word: str) -> Optional[Entry]:
+        """Return the cached entry for a word or its headword, or None if it isn't cached (or has expired)."""
+        if self.refresh:
+            self.misses += 1
+            return None
+
+        with self._lock:
+            key, row = self.find(LookupCache.normalize(word))
+            if row and self.is_expired(row[3]):
+                self.connection.execute('DELETE FROM lookups WHERE word = ?', (key, ))
+                self.connection.commit()
+                self._size -= 1
+                row = None
+
+            if not row:
+                self.misses += 1
+                return None
+
+            # Access times only matter for eviction, so they are committed along with the next write
+            self.connection.execute('UPDATE lookups SET accessed = ? WHERE word = ?', (time.time(), key))
+        self.hits += 1
+        if key != LookupCache.normalize(word):
+            self.inflection_hits += 1
+        word_stem, definitions, ipa, _ = row
+        return word_stem, json.loads(definitions), ipa
+
+    def find(self, key: str) -> Tuple[str, Optional[tuple]]:
+        """Return the key of the entry for a word, its own or its headword's, and the entry's row if there is one."""
+        row = self.connection.execute('SELECT word_stem, definitions, ipa, created FROM lookups WHERE word = ?',
+                                      (key, )).fetchone()
+        if row:
+            return key, row
+        headword = self.connection.execute('SELECT word FROM forms WHERE form = ?', (key, )).fetchone()
+        if not headword:
+            return key, None
+        return headword[0], self.connection.execute('SELECT word_stem, definitions, ipa, created FROM lookups '
+                                                    'WHERE word = ?', headword).fetchone()
+
+    def put(self, word: str, entry: Entry, forms: Iterable[str] = ()) -> None:
+        """
+        Cache the entry of a word.
+
+        :param forms: inflections of the word, e.g. the stems in an API response, to answer lookups of them with the
+                      entry as well. A form already known to belong to another word keeps that word.
+        """
+        self.put_many([(word, entry, forms)])
+
+    def put_many(self, entries: Iterable[Tuple[str, Entry, Iterable[str]]]) -> None:
+        """Cache the entries of several words, with their forms, in a single transaction, see put()."""
+        now = time.time()
+        with self._lock:
+            for word, (word_stem, definitions, ipa), forms in entries:
+                key = LookupCache.normalize(word)
+                exists = self.connection.execute('SELECT 1 FROM lookups WHERE word = ?', (key, )).fetchone()
+                if not exists:
+                    self._size += 1
+                self.connection.execute('INSERT OR REPLACE INTO lookups VALUES (?, ?, ?, ?, ?, ?)',
+                                        (key, word_stem, json.dumps(definitions), ipa, now, now))
+                self.connection.executemany('INSERT OR IGNORE INTO forms VALUES (?, ?)',
+                                            {(LookupCache.normalize(form), key) for form in forms} - {(key, key)})
+            self.evict()
+            self.connection.commit()
+
+    def __contains__(self, word: str) -> bool:
+        """Return true if the word would be a cache hit, without counting it as one."""
+        if self.refresh:
+            return False
+        with self._lock:
+            _, row = self.find(LookupCache.normalize(word))
+        return bool(row) and not self.is_expired(row[3])
+
+    def __len__(self) -> int:
+        return self._size
+
+    def is_expired(self, created: float) -> bool:
+        if not self.ttl_days:
+            return False
+        return time.time() - created > self.ttl_days * 24 * 60 * 60
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until the cache is within its maximum size."""
+        if not self.max_entries or self._size <= self.max_entries:
+            return
+        excess = self._size - self.max_entries
+        evicted = self.connection.execute('SELECT word FROM lookups ORDER BY accessed LIMIT ?', (excess, )).fetchall()
+        self.connection.executemany('DELETE FROM lookups WHERE word = ?', evicted)
+        self.connection.executemany('DELETE FROM forms WHERE word = ?', evicted)
+        self._size -= excess
+
+    def export_bundle(self, path: Union[str, bytes, os.PathLike]) -> int:
+        """
+        Write the entries that haven't expired to a compressed bundle, to be imported into the caches of others,
+        returning the number of entries written.
+
+        Entries are deduplicated by headword: the words and inflections that share an entry are stored with it as its
+        forms, so e.g. "run", "ran" and "running" are stored once. The bundle records its format version and a
+        checksum of its entries.
+        """
+        with self._lock:
+            rows = self.connection.execute('SELECT word, word_stem, definitions, ipa, created FROM lookups '
+                                           'ORDER BY created').fetchall()
+            forms: Dict[str, set] = {}
+            for form, word in self.connection.execute('SELECT form, word FROM forms'):
+                forms.setdefault(word, set()).add(form)
+
+        headwords = {}  # word stem -> (definitions, ipa, created, forms)
+        for word, word_stem, definitions, ipa, created in rows:
+            if self.is_expired(created):
+                continue
+            # Rows are ordered by creation, so the most recent entry of a headword wins, with the forms of all of them
+            known_forms = headwords[word_stem][3] if word_stem in headwords else set()
+            headwords[word_stem] = (definitions, ipa, created, known_forms | {word} | forms.get(word, set()))
+        entries = [[word_stem, json.loads(definitions), ipa, created,
+                    sorted(known_forms - {LookupCache.normalize(word_stem)})]
+                   for word_stem, (definitions, ipa, created, known_forms) in sorted(headwords.items())]
+
+        bundle = {'format': LookupCache.bundle_format, 'version': LookupCache.bundle_version,
+                  'sha256': LookupCache.checksum(entries), 'entries': entries}
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            json.dump(bundle, f, ensure_ascii=False, separators=(',', ':'))
+        return len(entries)
+
+    def import_bundle(self, path: Union[str, bytes, os.PathLike]) -> int:
+        """
+        Merge the entries of a bundle written by export_bundle() into the cache, returning the number of entries added
+        or updated. An entry that is already cached is only replaced by a more recent one.
+        """
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                bundle = json.load(f)
+        except (OSError, EOFError, ValueError) as err:
+            raise InvalidBundleError(f'Couldn\'t read lookup cache bundle "{path}": {err}') from err
+        if not isinstance(bundle, dict) or bundle.get('format') != LookupCache.bundle_format:
+            raise InvalidBundleError(f'"{path}" isn\'t a lookup cache bundle.')
+        if bundle.get('version') != LookupCache.bundle_version:
+            raise InvalidBundleError(f'Lookup cache bundle "{path}" is version {bundle.get("version")}, but this '
+                                     f'version of kanki only reads version {LookupCache.bundle_version}.')
+        entries = bundle.get('entries')
+        if not isinstance(entries, list) or bundle.get('sha256') != LookupCache.checksum(entries):
+            raise InvalidBundleError(f'Lookup cache bundle "{path}" is corrupt, its checksum doesn\'t match.')
+
+        entries = [entry for entry in entries if not self.is_expired(entry[3])]
+        now = time.time()
+        with self._lock:
+            changes = self.connection.total_changes
+            # One statement per table merges the whole bundle, keeping whichever entry of a word is the most recent
+            self.connection.executemany('''INSERT INTO lookups VALUES (?, ?, ?, ?, ?, ?)
+                                           ON CONFLICT (word) DO UPDATE SET
+                                               word_stem = excluded.word_stem, definitions = excluded.definitions,
+                                               ipa = excluded.ipa, created = excluded.created
+                                           WHERE excluded.created > lookups.created''',
+                                        ((LookupCache.normalize(word_stem), word_stem, json.dumps(definitions), ipa,
+                                          created, now) for word_stem, definitions, ipa, created, _ in entries))
+            merged = self.connection.total_changes - changes
+            self.connection.executemany('INSERT OR IGNORE INTO forms VALUES (?, ?)',
+                                        ((LookupCache.normalize(form), LookupCache.normalize(word_stem))
+                                         for word_stem, _, _, _, forms in entries for form in forms))
+            self._size = self.connection.execute('SELECT COUNT(*) FROM lookups').fetchone()[0]
+            self.evict()
+            self.connection.commit()
+        return merged
+
+    @staticmethod
+    def checksum(entries: list) -> str:
+        """Return the SHA-256 of the entries of a bundle, serialized the way they are in the bundle."""
+        serialized = json.dumps(entries, ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+    def close(self) -> None:
+        self.connection.commit()
+        self.connection.close()
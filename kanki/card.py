@@ -1,12 +1,14 @@
-from typing import List, Optional
+import re
+from typing import IO, List, Optional
 
 
 class Card:
     """A vocabulary flashcard."""
+    __slots__ = ('word', '_sentence', '_book_title', 'author', '_definitions', 'pronunciation', 'highlight')
 
     def __init__(self, word, sentence, book_title, author):
         self.word = word
-        self.sentence = Card.surround_substring_with_html(sentence, word, 'b')
+        self.highlight = word  # the word as it was looked up, to emphasize in the sentence
         self.sentence = sentence
         self.book_title = book_title
         self.author = author
@@ -58,8 +60,113 @@ class Card:
         """Replace all Nones in a list with empty strings."""
         return list(map(lambda s: '' if s is None else s, strings))
 
-    @staticmethod
-    def surround_substring_with_html(string: str, substring: str, html: str):
-        open_tag = f'<{html}>'
-        close_tag = f'</{html}>'
-        return string.replace(substring, open_tag + substring + close_tag)
+
+class CardBatch:
+    """
+    Many cards stored column by column, in the order of the fields of the kanki card type.
+
+    A batch is much smaller than the same number of Card objects, and is encoded in one go: every column is escaped
+    with a single pass over it, and the whole batch is written to the file with a single call.
+    """
+    __slots__ = ('words', 'pronunciations', 'sentences', 'definitions', 'book_titles', 'authors', 'highlights')
+    formats = ('csv', 'tsv')
+    highlight_tag = 'b'
+
+    def __init__(self):
+        self.words: List[str] = []
+        self.pronunciations: List[Optional[str]] = []
+        self.sentences: List[str] = []
+        self.definitions: List[Optional[str]] = []
+        self.book_titles: List[str] = []
+        self.authors: List[str] = []
+        self.highlights: List[Optional[str]] = []  # word to emphasize in each sentence
+
+    def append(self, word: str, pronunciation: Optional[str], sentence: str, definitions: Optional[str],
+               book_title: str, author: str, highlight: Optional[str] = None) -> None:
+        self.words.append(word)
+        self.pronunciations.append(pronunciation)
+        self.sentences.append(sentence)
+        self.definitions.append(definitions)
+        self.book_titles.append(book_title)
+        self.authors.append(author)
+        self.highlights.append(highlight)
+
+    def append_card(self, card: Card) -> None:
+        self.append(card.word, card.pronunciation, card.sentence, card.definitions, card.book_title, card.author,
+                    card.highlight)
+
+    def clear(self) -> None:
+        for field in CardBatch.__slots__:
+            getattr(self, field).clear()
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    def highlighted_sentences(self) -> List[str]:
+        """Return the sentences with their looked up word emphasized, and double quotes replaced like in Card."""
+        open_tag, close_tag = f'<{CardBatch.highlight_tag}>', f'</{CardBatch.highlight_tag}>'
+        return [highlight_word(sentence.replace('"', "'"), word, open_tag, close_tag) if word
+                else sentence.replace('"', "'")
+                for sentence, word in zip(self.sentences, self.highlights)]
+
+    def columns(self) -> List[List[Optional[str]]]:
+        """Return the fields of all cards, column by column in the order of the kanki card type."""
+        return [self.words, self.pronunciations, self.highlighted_sentences(), self.definitions,
+                [title.replace('"', "'") for title in self.book_titles], self.authors]
+
+    def encode(self, format: str = 'csv') -> str:
+        """
+        Return all cards in the batch, one line per card.
+
+        CSV quotes every field like Card.get_csv_encoding, TSV only quotes fields with tabs, quotes or line breaks.
+        Quotes in fields are escaped by doubling them, like the csv module does.
+        """
+        if format == 'csv':
+            columns = [['' if field is None else field.replace('"', '""') for field in column]
+                       for column in self.columns()]
+            line = '"{}","{}","{}","{}","{}","{}"\n'
+        elif format == 'tsv':
+            columns = [[escape_tsv(field) for field in column] for column in self.columns()]
+            line = '{}\t{}\t{}\t{}\t{}\t{}\n'
+        else:
+            raise ValueError(f'Unknown card format {format}, expected one of {CardBatch.formats}')
+        return ''.join(map(line.format, *columns))
+
+    def write(self, file: IO[str], format: str = 'csv') -> None:
+        file.write(self.encode(format))
+
+
+def highlight_word(sentence: str, word: str, open_tag: str, close_tag: str) -> str:
+    """Surround every occurrence of the word in the sentence with HTML tags, in any case but not inside other words."""
+    lowered, word = sentence.lower(), word.lower()
+    if len(lowered) != len(sentence):
+        # Lowercasing changed the length of the sentence, so positions in it can't be used, e.g. 'İ' -> 'i̇'
+        pattern = re.compile(rf'(?<!\w){re.escape(word)}(?!\w)', re.IGNORECASE)
+        return pattern.sub(lambda match: open_tag + match[0] + close_tag, sentence)
+
+    parts = []
+    written = 0  # end of the part of the sentence already in parts
+    start = lowered.find(word)
+    while start != -1:
+        end = start + len(word)
+        if not (start and is_word_character(lowered[start - 1])) and \
+                not (end < len(lowered) and is_word_character(lowered[end])):
+            parts.extend((sentence[written:start], open_tag, sentence[start:end], close_tag))
+            written = end
+        start = lowered.find(word, end)
+    if not parts:
+        return sentence
+    parts.append(sentence[written:])
+    return ''.join(parts)
+
+
+def is_word_character(character: str) -> bool:
+    return character.isalnum() or character == '_'
+
+
+def escape_tsv(field: Optional[str]) -> str:
+    if field is None:
+        return ''
+    if '"' in field or '\t' in field or '\n' in field or '\r' in field:
+        return '"' + field.replace('"', '""') + '"'
+    return field
@@ -0,0 +1,216 @@
+import email.utils
+import logging
+import random
+import threading
+import time
+from typing import Callable, Optional, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from kanki.exceptions import ServiceUnavailableError
+
+
+class RateLimiter:
+    """
+    Spaces out requests shared by several threads, adapting the rate to the server AIMD-style.
+
+    There is no limit until the server signals that it is overloaded. Then the rate is cut to a fraction of the rate
+    requests were made at, and it increases additively with every success after that, probing for the rate the server
+    can take.
+    """
+
+    def __init__(self, max_rate: Optional[float] = None, min_rate: float = 0.5, increase: float = 0.5,
+                 decrease: float = 0.5):
+        """
+        :param max_rate: requests per second never to exceed, None for no limit other than the server's
+        :param min_rate: requests per second never to go below when slowing down
+        :param increase: requests per second added to the rate for every second of successful requests
+        :param decrease: factor to multiply the rate with when the server is overloaded
+        """
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.rate: Optional[float] = max_rate  # current requests per second, None if unlimited
+        self._next_request = 0.0  # time.monotonic() at which the next request may be made
+        self._last_request: Optional[float] = None
+        self._interval = None  # moving average of the time between requests, to know the rate when throttled
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        """Block until the next request may be made."""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_request)
+            if self.rate is not None:
+                self._next_request = start + 1 / self.rate
+            if self._last_request is not None:
+                interval = start - self._last_request
+                self._interval = interval if self._interval is None else 0.8 * self._interval + 0.2 * interval
+            self._last_request = start
+        if start > now:
+            time.sleep(start - now)
+
+    def succeeded(self) -> None:
+        with self._lock:
+            if self.rate is not None:
+                self.rate += self.increase / self.rate
+                if self.max_rate is not None:
+                    self.rate = min(self.rate, self.max_rate)
+
+    def throttled(self) -> None:
+        """Slow down, the server is overloaded."""
+        with self._lock:
+            if self.rate is None:
+                if not self._interval:
+                    return  # too few requests to know the rate they were made at, backing off has to do for now
+                # Requests were only limited by their latency, start from the rate they were made at
+                self.rate = 1 / self._interval
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._next_request = max(self._next_request, time.monotonic() + 1 / self.rate)
+
+
+class CircuitBreaker:
+    """
+    Stops all requests after sustained errors, so a run can stop cleanly instead of sending requests that are bound to
+    fail. Once open, the breaker stays open until it is reset, e.g. for the rest of an export.
+    """
+
+    def __init__(self, failure_threshold: int = 10):
+        """:param failure_threshold: number of failed requests in a row, in any thread, that opens the breaker"""
+        self.failure_threshold = failure_threshold
+        self.failures = 0  # in a row
+        self.reason: Optional[str] = None  # why the breaker opened, None while requests are allowed
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.reason is not None
+
+    def check(self) -> None:
+        """:raises ServiceUnavailableError: if no more requests should be made"""
+        if self.reason is not None:
+            raise ServiceUnavailableError(self.reason)
+
+    def succeeded(self) -> None:
+        with self._lock:
+            self.failures = 0
+
+    def failed(self, reason: str) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold and self.reason is None:
+                self.reason = f'{self.failures} requests in a row failed, the last one with: {reason}'
+                logging.error(f'Stopping all requests to the dictionary API. {self.reason}')
+
+    def reset(self) -> None:
+        """Allow requests again, e.g. when a long running process starts another export after an outage."""
+        with self._lock:
+            self.failures = 0
+            self.reason = None
+
+    def open(self, reason: str) -> None:
+        with self._lock:
+            if self.reason is None:
+                self.reason = reason
+                logging.error(f'Stopping all requests to the dictionary API. {self.reason}')
+
+
+class APIClient:
+    """
+    Sends GET requests to a web API, with timeouts, retries, an adaptive request rate and a circuit breaker.
+
+    Responses with a status meaning the server is overloaded or temporarily failing (429 and 5xx), timeouts and
+    connection errors are retried with jittered exponential backoff, waiting at least as long as a Retry-After header
+    asks. Safe to use from several threads at once, which share the rate limit and the circuit breaker.
+    """
+    retry_statuses = frozenset((429, 500, 502, 503, 504))
+    default_timeout = 10.0
+    default_retries = 4
+
+    def __init__(self, pool_size: int = 1, timeout: Union[float, Tuple[float, float]] = default_timeout,
+                 retries: int = default_retries, backoff: float = 0.5, max_backoff: float = 30.0,
+                 max_retry_after: float = 120.0, max_rate: Optional[float] = None, failure_threshold: int = 10):
+        """
+        :param pool_size: number of keep-alive connections, should match the number of threads making requests
+        :param timeout: seconds to wait for the server to connect and to send data, or a (connect, read) tuple
+        :param retries: times to retry a failed request
+        :param backoff: seconds to wait before the first retry, doubling for every retry after that
+        :param max_backoff: most seconds to wait before a retry, unless the server asks for more with Retry-After
+        :param max_retry_after: if the server asks to wait longer than this, give up instead of waiting
+        :param max_rate: requests per second never to exceed, None for no limit other than the server's
+        :param failure_threshold: failed requests in a row before all requests are stopped
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.rate_limiter = RateLimiter(max_rate)
+        self.circuit_breaker = CircuitBreaker(failure_threshold)
+
+        # Reuse connections between requests instead of opening a new one for every request
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, url: str,
+            on_response: Optional[Callable[[requests.Response, float], None]] = None) -> requests.Response:
+        """
+        Return the response to a GET request, retrying it if it fails temporarily.
+
+        :param on_response: called with every response received and its latency in seconds, retries included
+        :raises ServiceUnavailableError: if the request kept failing, or the circuit breaker is open
+        """
+        for attempt in range(self.retries + 1):
+            self.circuit_breaker.check()
+            self.rate_limiter.wait()
+            start = time.perf_counter()
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as err:
+                failure, retry_after = f'{type(err).__name__}: {err}', None
+            else:
+                if on_response is not None:
+                    on_response(response, time.perf_counter() - start)
+                if response.status_code not in APIClient.retry_statuses:
+                    self.rate_limiter.succeeded()
+                    self.circuit_breaker.succeeded()
+                    return response
+                failure, retry_after = f'HTTP {response.status_code}', APIClient.retry_after(response)
+                self.rate_limiter.throttled()
+
+            self.circuit_breaker.failed(failure)
+            if attempt == self.retries:
+                break
+            if retry_after is not None and retry_after > self.max_retry_after:
+                self.circuit_breaker.open(f'The server asked to wait {retry_after:.0f} seconds before retrying')
+                break
+            # Full jitter, so threads that failed together don't retry together
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            delay = max(delay, retry_after or 0)
+            logging.info(f'{failure}, retrying in {delay:.1f} seconds')
+            time.sleep(delay)
+
+        self.circuit_breaker.check()
+        raise ServiceUnavailableError(f'Request failed {self.retries + 1} times, the last time with: {failure}')
+
+    def close(self) -> None:
+        self.session.close()
+
+    @staticmethod
+    def retry_after(response: requests.Response) -> Optional[float]:
+        """Return the seconds to wait that the Retry-After header of a response asks for, if any."""
+        value = response.headers.get('Retry-After')
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
@@ -0,0 +1,127 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import List, NamedTuple, Optional, Union
+
+
+class DeadLetter(NamedTuple):
+    word: str
+    reason: str  # DeadLetters.MISSING or DeadLetters.FAILED
+    error: str  # of the last attempt
+    attempts: int
+    retry_at: float  # seconds since the epoch after which the word may be looked up again
+
+
+class DeadLetters:
+    """
+    An on-disk store of the words that couldn't be looked up, either because the dictionary doesn't have them or
+    because its response wasn't in the expected format, so that later exports don't spend API queries on them again.
+
+    Every failure is kept along with its reason and number of attempts, and is skipped until it expires. Each failed
+    attempt doubles the time until the word is tried again, up to a maximum, so words that keep failing cost fewer and
+    fewer queries.
+    """
+    default_path = 'kanki_dead_letters.db'
+    MISSING, FAILED = 'missing', 'failed'
+    default_base_delay_days = 1.0
+    default_max_delay_days = 128.0
+
+    def __init__(self, path: Union[str, bytes, os.PathLike] = default_path,
+                 base_delay_days: float = default_base_delay_days, max_delay_days: float = default_max_delay_days,
+                 refresh: bool = False):
+        """
+        :param base_delay_days: days before a word that failed once is looked up again
+        :param max_delay_days: most days before a word that keeps failing is looked up again
+        :param refresh: don't skip any words, but still record failures
+        """
+        self.path = path
+        self.base_delay_days = base_delay_days
+        self.max_delay_days = max_delay_days
+        self.refresh = refresh
+        self.skips = 0  # lookups skipped since the word is known to fail
+
+        # Lookups may fail in several threads, so guard the connection with a lock
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS dead_letters (
+                                       word TEXT PRIMARY KEY,
+                                       reason TEXT NOT NULL,
+                                       error TEXT NOT NULL,
+                                       attempts INTEGER NOT NULL,
+                                       first_failed REAL NOT NULL,
+                                       last_failed REAL NOT NULL,
+                                       retry_at REAL NOT NULL)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS dead_letters_retry_at ON dead_letters (retry_at)')
+        self.connection.commit()
+
+    @staticmethod
+    def normalize(word: str) -> str:
+        return word.strip().lower()
+
+    def get(self, word: str) -> Optional[DeadLetter]:
+        """Return the failure of a word if it is known to fail and shouldn't be looked up again yet, otherwise None."""
+        dead_letter = self.find(word)
+        if dead_letter is not None:
+            self.skips += 1
+        return dead_letter
+
+    def __contains__(self, word: str) -> bool:
+        """Return true if the word would be skipped, without counting it as a skip."""
+        return self.find(word) is not None
+
+    def find(self, word: str) -> Optional[DeadLetter]:
+        if self.refresh:
+            return None
+        with self._lock:
+            row = self.connection.execute('SELECT word, reason, error, attempts, retry_at FROM dead_letters '
+                                          'WHERE word = ? AND retry_at > ?',
+                                          (DeadLetters.normalize(word), time.time())).fetchone()
+        return DeadLetter._make(row) if row else None
+
+    def record(self, word: str, error: Exception) -> DeadLetter:
+        """Record a failed lookup of a word, a TypeError if it is missing from the dictionary, and when to retry it."""
+        reason = DeadLetters.MISSING if isinstance(error, TypeError) else DeadLetters.FAILED
+        key, now = DeadLetters.normalize(word), time.time()
+        with self._lock:
+            row = self.connection.execute('SELECT attempts FROM dead_letters WHERE word = ?', (key, )).fetchone()
+            attempts = row[0] + 1 if row else 1
+            retry_at = now + self.delay_days(attempts) * 24 * 60 * 60
+            self.connection.execute('''INSERT INTO dead_letters VALUES (?, ?, ?, ?, ?, ?, ?)
+                                       ON CONFLICT (word) DO UPDATE SET
+                                           reason = excluded.reason, error = excluded.error,
+                                           attempts = excluded.attempts, last_failed = excluded.last_failed,
+                                           retry_at = excluded.retry_at''',
+                                    (key, reason, str(error), attempts, now, now, retry_at))
+            self.connection.commit()
+        return DeadLetter(key, reason, str(error), attempts, retry_at)
+
+    def delay_days(self, attempts: int) -> float:
+        """Return the days to wait before looking up a word again after it failed the given number of times."""
+        return min(self.base_delay_days * 2 ** (attempts - 1), self.max_delay_days)
+
+    def remove(self, *words: str) -> None:
+        """Forget words, e.g. once they have been found."""
+        with self._lock:
+            self.connection.executemany('DELETE FROM dead_letters WHERE word = ?',
+                                        ((DeadLetters.normalize(word), ) for word in words))
+            self.connection.commit()
+
+    def due(self, limit: Optional[int] = None) -> List[str]:
+        """Return the words that may be looked up again, those that have waited the longest first."""
+        with self._lock:
+            rows = self.connection.execute('SELECT word FROM dead_letters WHERE retry_at <= ? ORDER BY retry_at '
+                                           'LIMIT ?', (time.time(), -1 if limit is None else limit)).fetchall()
+        return [row[0] for row in rows]
+
+    def next_due(self) -> Optional[float]:
+        """Return when the next word may be looked up again, None if there are no failed words."""
+        with self._lock:
+            return self.connection.execute('SELECT MIN(retry_at) FROM dead_letters').fetchone()[0]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.connection.execute('SELECT COUNT(*) FROM dead_letters').fetchone()[0]
+
+    def close(self) -> None:
+        self.connection.close()
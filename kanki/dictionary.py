@@ -0,0 +1,324 @@
+import logging
+from abc import ABC, abstractmethod
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime
+from typing import Optional
+
+from kanki.cache import Entry
+from kanki.dead_letters import DeadLetters
+from kanki.exceptions import MissingWordError, ServiceUnavailableError
+
+
+class Dictionary(ABC):
+    """A source of word definitions that kanki can export cards from."""
+    max_queries: Optional[int] = None  # amount of lookups allowed per day, None if unlimited
+    cache = None  # the LookupCache in front of the dictionary, if any
+    ledger = None  # the QuotaLedger recording queries spent today, if any
+    queries_made = 0  # queries counting against max_queries made so far
+    metrics = None  # the Metrics of the export, if collected
+    dead_letters = None  # the DeadLetters of words known to fail, if kept
+
+    @abstractmethod
+    def lookup(self, word: str) -> Entry:
+        """
+        Look up a word, returning the word itself, its definitions and pronunciation.
+
+        Must be safe to call from several threads at once.
+
+        :raises KeyError: if the dictionary entry wasn't in the expected format
+        :raises TypeError: if the word wasn't found in the dictionary
+        """
+
+    def has_entry(self, word: str) -> bool:
+        """Return true if the dictionary is known to have the word, without looking it up."""
+        return False
+
+    def costs_query(self, word: str) -> bool:
+        """Return true if looking up the word would count against max_queries."""
+        return self.max_queries is not None and (self.cache is None or word not in self.cache)
+
+    def reset(self) -> None:
+        """Allow queries again after the dictionary was unavailable, e.g. before the next export of watch mode."""
+
+    def close(self) -> None:
+        if self.cache is not None:
+            self.cache.close()
+
+
+class QuotaDictionary(Dictionary):
+    """
+    Stands in for an online dictionary when planning an export: knows which words would cost a query and how many
+    queries are left today, but doesn't look words up, so nothing is sent or written.
+    """
+
+    def __init__(self, max_queries: Optional[int], cache=None, ledger=None):
+        self.max_queries = max_queries
+        self.cache = cache
+        self.ledger = ledger
+
+    def lookup(self, word: str) -> Entry:
+        """:raises RuntimeError: always, a plan only counts the queries an export needs"""
+        raise RuntimeError(f'Can\'t look up {word}, words are not looked up when planning an export')
+
+
+class FallbackDictionary(Dictionary):
+    """Looks up words in a primary dictionary, and only in the fallback dictionary if the primary one lacks them."""
+
+    def __init__(self, primary: Dictionary, fallback: Dictionary):
+        self.primary = primary
+        self.fallback = fallback
+
+    @property
+    def max_queries(self) -> Optional[int]:
+        return self.fallback.max_queries
+
+    @property
+    def cache(self):
+        return self.fallback.cache
+
+    @property
+    def ledger(self):
+        return self.fallback.ledger
+
+    @property
+    def metrics(self):
+        return self.fallback.metrics
+
+    @metrics.setter
+    def metrics(self, metrics) -> None:
+        self.primary.metrics = metrics
+        self.fallback.metrics = metrics
+
+    @property
+    def queries_made(self) -> int:
+        return self.primary.queries_made + self.fallback.queries_made
+
+    @property
+    def dead_letters(self):
+        return self.fallback.dead_letters
+
+    def lookup(self, word: str) -> Entry:
+        try:
+            return self.primary.lookup(word)
+        except TypeError:
+            return self.fallback.lookup(word)
+
+    def has_entry(self, word: str) -> bool:
+        return self.primary.has_entry(word) or self.fallback.has_entry(word)
+
+    def costs_query(self, word: str) -> bool:
+        return not self.primary.has_entry(word) and self.fallback.costs_query(word)
+
+    def reset(self) -> None:
+        self.primary.reset()
+        self.fallback.reset()
+
+    def close(self) -> None:
+        self.primary.close()
+        self.fallback.close()
+
+
+class HedgedDictionary(Dictionary):
+    """
+    Looks up words in a primary dictionary, and also in a secondary one, e.g. another Merriam-Webster endpoint, when
+    the primary one lacks a word or is slow to answer it.
+
+    The secondary dictionary is queried in parallel once the primary one hasn't answered within the latency budget, or
+    right away when it doesn't have the word, and the first entry found is used. When the primary dictionary suggests
+    other words instead, the top suggestion is looked up in parallel as well, so a missing word costs at most one more
+    round trip, and one more query of the primary dictionary's quota if there is one to spare, i.e. one that isn't
+    reserved for the words of the export.
+
+    The quota and cache are the primary dictionary's: the secondary dictionary keeps its own quota, and entries it
+    finds are cached here, like entries of suggestions are cached for the word looked up.
+    """
+    default_hedge_after = 1.0
+
+    def __init__(self, primary: Dictionary, secondary: Optional[Dictionary] = None,
+                 hedge_after: float = default_hedge_after, follow_suggestions: bool = True, workers: int = 1):
+        """
+        :param secondary: the dictionary to query when the primary one lacks a word or is slow, None to only follow
+                          suggestions
+        :param hedge_after: seconds to wait for the primary dictionary before querying the secondary one as well
+        :param follow_suggestions: look up the top word the primary dictionary suggests for a word it doesn't have
+        :param workers: number of words looked up at once, e.g. the number of jobs of the export
+        """
+        self.primary = primary
+        self.secondary = secondary
+        self.hedge_after = hedge_after
+        self.follow_suggestions = follow_suggestions
+        # Every word looked up at once may have a query to each dictionary and one for a suggestion in flight
+        self.executor = ThreadPoolExecutor(max_workers=3 * workers, thread_name_prefix='hedge')
+
+    @property
+    def max_queries(self) -> Optional[int]:
+        return self.primary.max_queries
+
+    @property
+    def cache(self):
+        return self.primary.cache
+
+    @property
+    def ledger(self):
+        return self.primary.ledger
+
+    @property
+    def metrics(self):
+        return self.primary.metrics
+
+    @metrics.setter
+    def metrics(self, metrics) -> None:
+        self.primary.metrics = metrics
+        if self.secondary is not None:
+            self.secondary.metrics = metrics
+
+    @property
+    def queries_made(self) -> int:
+        return self.primary.queries_made
+
+    def lookup(self, word: str) -> Entry:
+        """
+        :raises KeyError or TypeError: the primary dictionary's error, if no dictionary had an entry for the word
+        :raises ServiceUnavailableError: if the primary dictionary did, see APIClient.get, also when looking up the
+                                         word it suggested
+        """
+        primary = self.executor.submit(self.primary.lookup, word)
+        pending = {primary}
+        done, _ = wait(pending, timeout=self.hedge_after)
+        secondary = None if done else self.hedge(word, pending)
+        primary_error, unavailable_error = None, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    entry = future.result()
+                except ServiceUnavailableError as err:
+                    if future is primary:
+                        raise
+                    if future is secondary:
+                        logging.warning(f'Secondary dictionary unavailable, couldn\'t look up {word} in it')
+                    else:
+                        # The suggestion wasn't checked, so the word isn't known to be missing
+                        unavailable_error = err
+                    continue
+                except (KeyError, TypeError) as err:
+                    if future is not primary:
+                        continue
+                    primary_error = err
+                    if secondary is None:
+                        secondary = self.hedge(word, pending)
+                    suggestion = next(iter(getattr(err, 'suggestions', ())), None)
+                    # Following a suggestion costs another query, only spent if the export doesn't need it
+                    if self.follow_suggestions and suggestion and HedgedDictionary.reserve(self.primary, suggestion):
+                        pending.add(self.executor.submit(self.primary.lookup, suggestion))
+                        self.count('suggestions_followed')
+                    continue
+                if future is not primary:
+                    self.count('hedges_won' if future is secondary else 'suggestions_found')
+                    if self.cache is not None:
+                        self.cache.put(word, entry)
+                return entry
+        raise unavailable_error or primary_error
+
+    def hedge(self, word: str, pending: set) -> Optional[Future]:
+        """Look the word up in the secondary dictionary as well, if there is one with queries left today."""
+        if self.secondary is None or not HedgedDictionary.reserve(self.secondary, word):
+            return None
+        self.count('hedges')
+        future = self.executor.submit(self.secondary.lookup, word)
+        pending.add(future)
+        return future
+
+    @staticmethod
+    def reserve(dictionary: Dictionary, word: str) -> bool:
+        """
+        Reserve a query of the dictionary's daily limit to look up the word with, if it costs one. Return false if
+        there is none to spare, see QuotaLedger.reserve.
+        """
+        return dictionary.ledger is None or not dictionary.costs_query(word) or dictionary.ledger.reserve()
+
+    def count(self, name: str) -> None:
+        if self.metrics is not None:
+            self.metrics.count(name)
+
+    def has_entry(self, word: str) -> bool:
+        return self.primary.has_entry(word)
+
+    def costs_query(self, word: str) -> bool:
+        return self.primary.costs_query(word)
+
+    def reset(self) -> None:
+        self.primary.reset()
+        if self.secondary is not None:
+            self.secondary.reset()
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        self.primary.close()
+        if self.secondary is not None:
+            self.secondary.close()
+
+
+class DeadLetterDictionary(Dictionary):
+    """
+    Skips words known to fail in a dictionary, the words it lacks or answered in an unexpected format, until their
+    failure expires, recording every failure and forgetting the words once they are found.
+    """
+
+    def __init__(self, dictionary: Dictionary, dead_letters: DeadLetters):
+        self.dictionary = dictionary
+        self.dead_letters = dead_letters
+
+    @property
+    def max_queries(self) -> Optional[int]:
+        return self.dictionary.max_queries
+
+    @property
+    def cache(self):
+        return self.dictionary.cache
+
+    @property
+    def ledger(self):
+        return self.dictionary.ledger
+
+    @property
+    def metrics(self):
+        return self.dictionary.metrics
+
+    @metrics.setter
+    def metrics(self, metrics) -> None:
+        self.dictionary.metrics = metrics
+
+    @property
+    def queries_made(self) -> int:
+        return self.dictionary.queries_made
+
+    def lookup(self, word: str) -> Entry:
+        """:raises KeyError or TypeError: also without looking the word up, if it is known to fail"""
+        dead_letter = self.dead_letters.get(word)
+        if dead_letter is not None:
+            message = (f'{word} failed {dead_letter.attempts} times, last with: {dead_letter.error}, skipped until '
+                       f'{datetime.fromtimestamp(dead_letter.retry_at):%Y-%m-%d %H:%M}')
+            if dead_letter.reason == DeadLetters.MISSING:
+                raise MissingWordError(message)
+            raise KeyError(message)
+        try:
+            entry = self.dictionary.lookup(word)
+        except (KeyError, TypeError) as err:
+            self.dead_letters.record(word, err)
+            raise
+        self.dead_letters.remove(word)
+        return entry
+
+    def has_entry(self, word: str) -> bool:
+        return self.dictionary.has_entry(word)
+
+    def costs_query(self, word: str) -> bool:
+        return word not in self.dead_letters and self.dictionary.costs_query(word)
+
+    def reset(self) -> None:
+        self.dictionary.reset()
+
+    def close(self) -> None:
+        self.dictionary.close()
+        self.dead_letters.close()
@@ -1,2 +1,26 @@
 class MissingBookError(Exception):
     """When a book is requested that is not in the vocabulary file."""
+
+
+class MissingVocabError(Exception):
+    """When none of the given paths is, or has, a Kindle vocabulary file."""
+
+
+class UnsupportedCollectionError(Exception):
+    """When an Anki collection file is in a format kanki can't safely write to."""
+
+
+class ServiceUnavailableError(Exception):
+    """When the dictionary API keeps failing, so that the export should stop and be resumed later."""
+
+
+class InvalidBundleError(Exception):
+    """When a lookup cache bundle is corrupt, or was written by a version of kanki this one can't read."""
+
+
+class MissingWordError(TypeError):
+    """When a word isn't in the dictionary, with the words the dictionary suggests instead, if any."""
+
+    def __init__(self, message: str, suggestions=()):
+        super().__init__(message)
+        self.suggestions = list(suggestions)
@@ -0,0 +1,62 @@
+import os
+from typing import Optional, Union
+
+from kanki.cache import Entry
+from kanki.card import Card, CardBatch
+from kanki.vocab import Lookup
+
+
+class ExportWriter:
+    """
+    Writes cards to an export file as soon as they are created.
+
+    Cards are collected in a batch and written together. Every flushed batch is fsynced, so cards that have been
+    flushed survive a crash or a power loss.
+    """
+
+    def __init__(self, path: Union[str, bytes, os.PathLike], header: str, append: bool = False,
+                 format: str = 'csv'):
+        """:param format: csv or tsv, see CardBatch.write"""
+        if format not in CardBatch.formats:
+            raise ValueError(f'Unknown card format {format}, expected one of {CardBatch.formats}')
+        self.path = path
+        self.format = format
+        self.count = 0  # number of cards written
+        self._header: Optional[str] = header
+        self._batch = CardBatch()
+        self._file = open(path, 'a' if append else 'w', encoding='utf-8', newline='')
+
+    def write(self, card: Card) -> None:
+        self._batch.append_card(card)
+        self.count += 1
+
+    def write_lookup(self, lookup: Lookup, entry: Optional[Entry]) -> None:
+        """Write the card of a lookup, with the dictionary entry of its word if it was found, without a Card object."""
+        if entry is None:
+            self._batch.append(lookup.word, None, lookup.usage, None, lookup.title, lookup.authors, lookup.word)
+        else:
+            word_stem, definitions, ipa = entry
+            self._batch.append(word_stem, ipa, lookup.usage, '; '.join(definitions), lookup.title, lookup.authors,
+                               lookup.word)
+        self.count += 1
+
+    def flush(self) -> None:
+        """Write all batched cards and make sure they have reached the disk."""
+        if self._header is not None:
+            self._file.write(self._header)
+            self._header = None
+        if self._batch:
+            self._batch.write(self._file, self.format)
+            self._batch.clear()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        self.flush()
+        self._file.close()
+
+    def __enter__(self) -> 'ExportWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
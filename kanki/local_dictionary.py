@@ -0,0 +1,139 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+from typing import Iterator, List, Optional, Tuple, Union
+
+from kanki.cache import Entry, LookupCache
+from kanki.dictionary import Dictionary
+
+
+class LocalDictionary(Dictionary):
+    """
+    An offline dictionary, looked up in a prebuilt index file that is memory-mapped.
+
+    The index is an open addressing hash table of headwords and inflections, followed by the dictionary entries, so a
+    lookup reads a single slot and a single entry no matter how large the dictionary is. Build the index from a
+    dictionary dump with LocalDictionary.build().
+    """
+    default_path = 'kanki_dictionary.idx'
+    magic = b'KANKIDX1'
+    header = struct.Struct('<8sQ')  # magic, number of slots
+    slot = struct.Struct('<QQ')  # hash of word, offset of entry (0 if the slot is empty)
+    entry_length = struct.Struct('<I')
+
+    def __init__(self, path: Union[str, bytes, os.PathLike] = default_path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._slots = LocalDictionary.header.unpack_from(self._index, 0)
+        if magic != LocalDictionary.magic:
+            raise ValueError(f'"{os.fsdecode(path)}" is not a kanki dictionary index')
+
+    def lookup(self, word: str) -> Entry:
+        entry = self.find(LookupCache.normalize(word))
+        if entry is None:
+            raise TypeError(f'{word} not found in local dictionary')
+        return entry
+
+    def has_entry(self, word: str) -> bool:
+        return self.find(LookupCache.normalize(word)) is not None
+
+    def find(self, key: str) -> Optional[Entry]:
+        key_hash = LocalDictionary.hash(key)
+        i = key_hash % self._slots
+        while True:
+            slot_hash, offset = LocalDictionary.slot.unpack_from(self._index, LocalDictionary.slot_offset(i))
+            if not offset:
+                return None
+            if slot_hash == key_hash:
+                entry_key, word_stem, definitions, ipa = self.read_entry(offset)
+                if entry_key == key:
+                    return word_stem, definitions, ipa
+            i = (i + 1) % self._slots
+
+    def read_entry(self, offset: int) -> list:
+        length, = LocalDictionary.entry_length.unpack_from(self._index, offset)
+        start = offset + LocalDictionary.entry_length.size
+        return json.loads(self._index[start:start + length])
+
+    def close(self) -> None:
+        self._index.close()
+
+    @staticmethod
+    def hash(key: str) -> int:
+        # Python's hash() is randomized between runs, the index needs the same hash every time
+        return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+
+    @staticmethod
+    def slot_offset(i: int) -> int:
+        return LocalDictionary.header.size + i * LocalDictionary.slot.size
+
+    @staticmethod
+    def build(dump_path: Union[str, bytes, os.PathLike],
+              index_path: Union[str, bytes, os.PathLike] = default_path) -> int:
+        """
+        Build an index from a dictionary dump in the JSON lines format, returning the number of words indexed.
+
+        Every line is either an entry in the format returned by the Merriam-Webster API, or an object with the keys
+        "word", "definitions" and optionally "ipa" and "forms" (inflections of the word). An entry can be found by its
+        headword and all of its inflections. If several entries have the same headword, the first one is used.
+        """
+        keys: List[Tuple[int, str, int]] = []  # (hash, key, offset relative to the first entry)
+        seen = set()
+        with tempfile.TemporaryFile() as entries:
+            for forms, entry in LocalDictionary.read_dump(dump_path):
+                word_stem, definitions, ipa = entry
+                for key in forms:
+                    if key in seen:
+                        continue
+                    # Every form gets its own copy of the entry, so that a lookup can check the key it found
+                    seen.add(key)
+                    keys.append((LocalDictionary.hash(key), key, entries.tell()))
+                    data = json.dumps([key, word_stem, definitions, ipa], ensure_ascii=False).encode('utf-8')
+                    entries.write(LocalDictionary.entry_length.pack(len(data)) + data)
+
+            # Keep the table at most half full, so probe sequences stay short
+            slots = max(1, 2 * len(keys))
+            table = bytearray(slots * LocalDictionary.slot.size)
+            entries_start = LocalDictionary.slot_offset(slots)
+            for key_hash, key, offset in keys:
+                i = key_hash % slots
+                while LocalDictionary.slot.unpack_from(table, i * LocalDictionary.slot.size)[1]:
+                    i = (i + 1) % slots
+                LocalDictionary.slot.pack_into(table, i * LocalDictionary.slot.size, key_hash, entries_start + offset)
+
+            temporary_path = f'{os.fsdecode(index_path)}.tmp'
+            with open(temporary_path, 'wb') as index:
+                index.write(LocalDictionary.header.pack(LocalDictionary.magic, slots))
+                index.write(table)
+                entries.seek(0)
+                while chunk := entries.read(1 << 20):
+                    index.write(chunk)
+            os.replace(temporary_path, index_path)
+        return len(keys)
+
+    @staticmethod
+    def read_dump(dump_path: Union[str, bytes, os.PathLike]) -> Iterator[Tuple[List[str], Entry]]:
+        """Yield the normalized forms of every word in a dictionary dump along with its entry."""
+        from kanki.merriam_webster import MWDictionary  # imports requests, which offline lookups don't need
+
+        with open(dump_path, 'r', encoding='utf-8') as dump:
+            for line in dump:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                try:
+                    if 'meta' in record:
+                        word_stem = MWDictionary.get_word_stem(record)
+                        entry = (word_stem, MWDictionary.get_word_definition(record),
+                                 MWDictionary.get_pronunciation(record))
+                        forms = [record['meta']['id'].split(':')[0]] + record['meta']['stems']
+                    else:
+                        entry = (record['word'], record['definitions'], record.get('ipa'))
+                        forms = [record['word']] + record.get('forms', [])
+                except (KeyError, IndexError, TypeError):
+                    continue  # skip entries we can't parse, just like unexpected API responses
+                yield list(dict.fromkeys(LookupCache.normalize(form) for form in forms)), entry
@@ -1,11 +1,21 @@
+import json
 import logging
 import sys
-from typing import List, Tuple, NoReturn, Optional
+import threading
+from typing import List, Tuple, NoReturn, Optional, Union
 
 import requests
 
+from kanki.archive import ResponseArchive
+from kanki.cache import Entry, LookupCache
+from kanki.client import APIClient
+from kanki.dictionary import Dictionary
+from kanki.exceptions import MissingWordError
+from kanki.metrics import Metrics, timer
+from kanki.quota import QuotaLedger
 
-class MWDictionary:
+
+class MWDictionary(Dictionary):
     """
     A wrapper for a subset of the Merriam-Websters Learner's dictionary API.
 
@@ -14,49 +24,134 @@ class MWDictionary:
     api_base_url = 'https://www.dictionaryapi.com/api/v3/references/learners/json/'
     max_queries = 1000  # amount of free lookups allowed per day
 
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, cache: Optional[LookupCache] = None, pool_size: int = 1,
+                 ledger: Optional[QuotaLedger] = None, api_base_url: str = api_base_url,
+                 metrics: Optional[Metrics] = None, client: Optional[APIClient] = None,
+                 archive: Optional[ResponseArchive] = None):
+        """
+        :param pool_size: number of keep-alive connections to the API, should match the number of concurrent lookups
+        :param ledger: where to record the API queries spent today
+        :param api_base_url: where to send queries, e.g. a local stand-in for the API when benchmarking
+        :param metrics: where to record the time spent on queries, parsing and the cache
+        :param client: how to send queries, with its timeouts, retries and rate limit, by default APIClient(pool_size)
+        :param archive: where to keep the raw responses, to parse them again later without querying the API
+        """
         self.api_key = api_key
+        self.api_base_url = api_base_url
+        self.cache = cache
+        self.ledger = ledger
+        self.metrics = metrics
+        self.archive = archive
+        self.queries_made = 0  # API queries sent, cache hits are not counted
+        self._lock = threading.Lock()
+        self.client = client if client is not None else APIClient(pool_size)
+        self.session = self.client.session
 
     def lookup(self, word: str) -> Tuple[str, List[str], str]:
-        """Looks up a word in the dictionary, returning the word itself, its definition and pronunciation."""
+        """
+        Looks up a word in the dictionary, returning the word itself, its definition and pronunciation.
+
+        Safe to call from several threads at once.
+
+        :raises KeyError: if the response wasn't in the expected format
+        :raises MissingWordError: a TypeError, if the word wasn't found in the dictionary, with the suggested words
+        :raises ServiceUnavailableError: if the API kept failing, see APIClient.get
+        """
+        if self.cache is not None:
+            with timer(self.metrics, 'cache'):
+                cached_entry = self.cache.get(word)
+            if cached_entry:
+                return cached_entry
+
         api_request = self.api_base_url + word + '?key=' + self.api_key
 
         logging.info('Looking up word: ' + word)
-        response = requests.get(api_request)
-
+        response = self.client.get(api_request, self.record_query)
         self.check_response(response)
+        if self.archive is not None:
+            with timer(self.metrics, 'archive'):
+                self.archive.add(word, response.content)
 
-        dict_entry = response.json()[0]
         try:
-            # Take the interesting parts of the response
-            word_stem = self.get_word_stem(dict_entry)
-            definitions = self.get_word_definition(dict_entry)
-            ipa = self.get_pronunciation(dict_entry)
-            print('OK')
-            return word_stem, definitions, ipa
+            with timer(self.metrics, 'json'):
+                entries = response.json()
+        except ValueError:
+            logging.warning(f'API response for word {word} wasn\'t valid JSON')
+            raise KeyError('JSON')
+        try:
+            with timer(self.metrics, 'parse'):
+                entry, forms = MWDictionary.parse(word, entries)
+        except MissingWordError as err:
+            logging.info(f'{word} not found in Merriam-Webster\'s Learner\'s dictionary, suggestions: '
+                         f'{err.suggestions[:3]}')
+            raise
         except KeyError as err:
             # Sometimes the response doesn't have the format we expected, will have to handle these edge cases as they
             # become known.
             logging.warning(f'API response for word {word} wasn\'t in the expected format. Reason: key {str(err)} not found')
-            print(f'bad API response')
             raise
         except TypeError:
-            # If the response isn't a dictionary, it means we get a list of suggested words so looking up keys won't
-            # work.
-            print(f'not found in Merriam-Webster\'s Learner\'s dictionary!')
+            # If the entries aren't dictionaries, looking up keys won't work
+            logging.info(f'{word} not found in Merriam-Webster\'s Learner\'s dictionary')
             raise
+        if self.cache is not None:
+            with timer(self.metrics, 'cache'):
+                self.cache.put(word, entry, forms)
+        return entry
+
+    @staticmethod
+    def parse(word: str, entries) -> Tuple[Entry, List[str]]:
+        """
+        Return the entry of a word from the API response to its lookup, parsed from JSON, along with the forms of the
+        word that the entry answers too. Also parses archived responses, see parse_archived.
+
+        :raises KeyError: if the response wasn't in the expected format
+        :raises MissingWordError: a TypeError, if the response has no entry for the word, with the suggested words
+        """
+        if not entries:
+            # No entry and not even a suggestion
+            raise MissingWordError(f'{word} not found')
+        if isinstance(entries, list) and all(isinstance(entry, str) for entry in entries):
+            # Instead of entries, we get a list of suggested words
+            raise MissingWordError(f'{word} not found', suggestions=entries)
+        # Take the interesting parts of the response
+        dict_entry = entries[0]
+        entry = (MWDictionary.get_word_stem(dict_entry), MWDictionary.get_word_definition(dict_entry),
+                 MWDictionary.get_pronunciation(dict_entry))
+        return entry, MWDictionary.get_word_stems(dict_entry)
+
+    def record_query(self, response: requests.Response, seconds: float) -> None:
+        """Count a query that reached the API against the quota, retries included."""
+        if self.metrics is not None:
+            self.metrics.add_time('http', seconds)
+            self.metrics.record_response(response.status_code, seconds)
+        with self._lock:
+            self.queries_made += 1
+        if self.ledger is not None:
+            self.ledger.record()
+
+    def reset(self) -> None:
+        self.client.circuit_breaker.reset()
+
+    def close(self) -> None:
+        super().close()
+        self.client.close()
+        if self.archive is not None:
+            self.archive.close()
 
     @staticmethod
     def check_response(response: requests.Response) -> NoReturn:
-        if response.status_code != 200:
-            logging.error('Unable to query Merriam-Webster\'s Dictionary API.')
-        elif 'Invalid API key' in response.text:
+        """:raises KeyError: if the API answered with an error that retrying won't fix"""
+        if 'Invalid API key' in response.text:
             api_key = response.request.url.split('?key=')[-1]
             logging.error(f'Invalid API key: {api_key}')
             print('Make sure your API key is subscribed to Merriam Websters Learner\'s Dictionary.\n'
                   'You can replace the current key by providing the argument [-k KEY].')
             print('Exiting...')
             sys.exit(1)
+        elif response.status_code != 200:
+            logging.error(f'Unable to query Merriam-Webster\'s Dictionary API, status {response.status_code}.')
+            raise KeyError(f'HTTP {response.status_code}')
 
     @staticmethod
     def get_word_definition(entry: dict) -> List[str]:
@@ -66,19 +161,25 @@ class MWDictionary:
     def get_word_stem(entry: dict) -> str:
         return entry['meta']['stems'][0]
 
+    @staticmethod
+    def get_word_stems(entry: dict) -> List[str]:
+        """Return every form of the word in an entry, e.g. its inflections, that the entry also answers."""
+        return entry['meta']['stems']
+
     @staticmethod
     def get_pronunciation(entry: dict) -> Optional[str]:
         """Maybe return word pronunciation from API response."""
         headword_information = 'hwi'
         pronunciations = 'prs'
         phonetic_alphabet = 'ipa'  # International Phonetic Alphabet pronunciation
+        merriam_webster_alphabet = 'mw'  # the only pronunciation in e.g. the Collegiate dictionary
         variants = 'vrs'
         alternative_pronunciations = 'altprs'
 
         # Where to find the pronunciations can differ from word to word
         prs = entry[headword_information].get(pronunciations, None)
         if prs:
-            return prs[0][phonetic_alphabet]
+            return prs[0].get(phonetic_alphabet) or prs[0][merriam_webster_alphabet]
 
         # If there is no pronunciation suitable for print, we might find the one for electronic display
         altprs = entry[headword_information].get(alternative_pronunciations, None)
@@ -89,5 +190,23 @@ class MWDictionary:
         vrs = entry[variants][0]
         variant_pronunciation = vrs[pronunciations][0].get(phonetic_alphabet, None)
         if not variant_pronunciation:
-            print('Couldn\'t find pronunciation')
+            logging.info('Couldn\'t find pronunciation')
         return variant_pronunciation
+
+
+def parse_archived(responses: List[Tuple[str, bytes]]) -> List[Tuple[str, Union[Tuple[Entry, List[str]], Exception]]]:
+    """
+    Parse archived API responses, see ResponseArchive.latest, returning for each word its entry and forms, or the error
+    (KeyError or TypeError) a lookup would have raised. Run in worker processes by Kanki.reparse.
+    """
+    results = []
+    for word, body in responses:
+        try:
+            try:
+                entries = json.loads(ResponseArchive.decompress(body))
+            except ValueError:
+                raise KeyError('JSON')
+            results.append((word, MWDictionary.parse(word, entries)))
+        except (KeyError, TypeError) as err:
+            results.append((word, err))
+    return results
@@ -0,0 +1,147 @@
+import bisect
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from typing import Callable, ContextManager, Dict, Iterable, Iterator, List, Optional, TypeVar, Union
+
+T = TypeVar('T')
+
+
+class Metrics:
+    """
+    Collects where the time of an export goes, and counts of what happened during it, for a JSON report.
+
+    Phases may run in several threads at once, e.g. HTTP requests, so the seconds of a phase are the total time spent
+    in it by all threads and can add up to more than the wall time of the export.
+    """
+    latency_buckets_ms = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self.started = datetime.now(timezone.utc)
+        self.phase_seconds: Dict[str, float] = Counter()
+        self.phase_calls: Dict[str, int] = Counter()
+        self.counters: Dict[str, int] = Counter()
+        self.http_statuses: Dict[int, int] = Counter()
+        self.latencies = [0] * (len(Metrics.latency_buckets_ms) + 1)  # number of API queries in each bucket
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, phase: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - start)
+
+    def add_time(self, phase: str, seconds: float) -> None:
+        with self._lock:
+            self.phase_seconds[phase] += seconds
+            self.phase_calls[phase] += 1
+
+    def timed_iter(self, phase: str, iterable: Iterable[T]) -> Iterator[T]:
+        """Yield from the iterable, timing how long it takes to produce every item, e.g. rows from a query."""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add_time(phase, time.perf_counter() - start)
+            yield item
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += n
+
+    def record_response(self, status_code: int, seconds: float) -> None:
+        """Record the status code and latency of an API query."""
+        with self._lock:
+            self.http_statuses[status_code] += 1
+            self.latencies[bisect.bisect_left(Metrics.latency_buckets_ms, seconds * 1000)] += 1
+            self.latency_total += seconds
+            self.latency_max = max(self.latency_max, seconds)
+
+    def report(self, **details) -> dict:
+        """Return everything collected, along with the given details about the export."""
+        bucket_names = [f'<={bound}' for bound in Metrics.latency_buckets_ms] + [f'>{Metrics.latency_buckets_ms[-1]}']
+        with self._lock:
+            queries = sum(self.latencies)
+            return {
+                'started': self.started.isoformat(timespec='seconds'),
+                **details,
+                'phases': {phase: {'seconds': round(seconds, 6), 'calls': self.phase_calls[phase]}
+                           for phase, seconds in sorted(self.phase_seconds.items())},
+                'api_latency_ms': {
+                    'count': queries,
+                    'mean': round(1000 * self.latency_total / queries, 3) if queries else None,
+                    'max': round(1000 * self.latency_max, 3),
+                    'histogram': dict(zip(bucket_names, self.latencies)),
+                },
+                'http_status': {str(status): count for status, count in sorted(self.http_statuses.items())},
+                'counts': dict(sorted(self.counters.items())),
+            }
+
+    def write(self, path: Union[str, bytes, os.PathLike], **details) -> None:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(**details), f, indent=2)
+            f.write('\n')
+
+
+def timer(metrics: Optional[Metrics], phase: str) -> ContextManager:
+    """Time a phase if metrics are being collected."""
+    return metrics.timer(phase) if metrics is not None else nullcontext()
+
+
+class Profiler:
+    """
+    Profiles the calling thread and the functions run through it in other threads, e.g. dictionary lookups in worker
+    threads, which cProfile alone doesn't see.
+    """
+
+    def __init__(self):
+        self.profiles: List[cProfile.Profile] = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> 'Profiler':
+        self.thread_profile().enable()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.thread_profile().disable()
+
+    def run(self, function: Callable[..., T], *args) -> T:
+        profile = self.thread_profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Since Python 3.12 a single profiler sees every thread, and only one may be enabled at a time
+            return function(*args)
+        try:
+            return function(*args)
+        finally:
+            profile.disable()
+
+    def thread_profile(self) -> cProfile.Profile:
+        profile = getattr(self._local, 'profile', None)
+        if profile is None:
+            profile = self._local.profile = cProfile.Profile()
+            with self._lock:
+                self.profiles.append(profile)
+        return profile
+
+    def dump(self, path: Union[str, bytes, os.PathLike]) -> None:
+        """Write the stats of all threads to a file that can be read with pstats or e.g. snakeviz."""
+        with self._lock:
+            stats = pstats.Stats(*self.profiles)
+        stats.dump_stats(path)
@@ -0,0 +1,149 @@
+import json
+import os
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Optional, TextIO, Union
+
+from kanki.cache import Entry
+from kanki.vocab import Lookup
+
+
+class EventLog:
+    """
+    Writes one JSON record per line for every word resolved, failed or missing, for other tools to follow an export.
+
+    Records are buffered and written out along with the progress line, not one write per word.
+    """
+
+    def __init__(self, path: Union[str, bytes, os.PathLike]):
+        self.path = path
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def write(self, event: str, **fields) -> None:
+        record = {'time': datetime.now(timezone.utc).isoformat(timespec='milliseconds'), 'event': event, **fields}
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class Progress:
+    """
+    Reports the progress of looking up words on a single line, with the words per second and the time left.
+
+    The line is only redrawn a few times per second, so large exports don't spend their time printing. When the output
+    isn't a terminal, e.g. piped to a log, a plain line is written every few seconds instead.
+    """
+    RESOLVED, FAILED, MISSING, SKIPPED = 'resolved', 'failed', 'missing', 'skipped'
+    terminal_interval = 0.2  # seconds between redraws of the line in a terminal
+    log_interval = 10.0  # seconds between lines written to a log
+
+    def __init__(self, total: int, action: str = 'Looking up', quiet: bool = False, events: Optional[EventLog] = None,
+                 stream: Optional[TextIO] = None, interval: Optional[float] = None):
+        """
+        :param total: number of words that will be reported
+        :param action: what is done to the words, e.g. 'Prefetching'
+        :param quiet: don't show the progress, only write events
+        :param events: where to write a record of every word, if anywhere
+        :param stream: where to show the progress, sys.stdout by default
+        :param interval: seconds between updates of the progress, by default depending on whether the stream is a
+                         terminal
+        """
+        self.total = total
+        self.action = action
+        self.quiet = quiet
+        self.events = events
+        self.stream = stream if stream is not None else sys.stdout
+        self.terminal = self.stream.isatty()
+        if interval is None:
+            interval = Progress.terminal_interval if self.terminal else Progress.log_interval
+        self.interval = interval
+        self.counts = {Progress.RESOLVED: 0, Progress.FAILED: 0, Progress.MISSING: 0, Progress.SKIPPED: 0}
+        self.started = time.monotonic()
+        self.last_shown = self.started
+        self.line_length = 0  # of the line in the terminal, to clear what the next one doesn't overwrite
+        self.shown = 0  # words done when the progress was last shown
+
+    @property
+    def done(self) -> int:
+        return sum(self.counts.values())
+
+    def record(self, word: str, outcome: str, lookup: Optional[Lookup] = None, entry: Optional[Entry] = None,
+               error: Optional[Exception] = None) -> None:
+        """Count the outcome of a word, e.g. Progress.RESOLVED, and show the progress if it is time to."""
+        self.counts[outcome] += 1
+        if self.events is not None:
+            fields = {'word': word}
+            if lookup is not None:
+                fields.update(lookup=lookup.word, book=lookup.title, timestamp=lookup.timestamp)
+            if entry is not None:
+                fields['headword'] = entry[0]
+            if error is not None:
+                fields['error'] = str(error)
+            self.events.write(outcome, **fields)
+
+        now = time.monotonic()
+        if now - self.last_shown >= self.interval:
+            self.last_shown = now
+            self.show(now)
+
+    def show(self, now: float) -> None:
+        if self.events is not None:
+            self.events.flush()
+        if self.quiet:
+            return
+        self.shown = self.done
+        line = self.format_line(now)
+        if self.terminal:
+            self.stream.write('\r' + line.ljust(self.line_length))
+            self.line_length = len(line)
+        else:
+            self.stream.write(line + '\n')
+        self.stream.flush()
+
+    def format_line(self, now: float) -> str:
+        digits = len(str(self.total))
+        elapsed = now - self.started
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        if self.done >= self.total:
+            eta = f'done in {Progress.format_seconds(elapsed)}'
+        elif rate:
+            eta = f'{Progress.format_seconds((self.total - self.done) / rate)} left'
+        else:
+            eta = 'time left unknown'
+        line = (f'[{self.done:>{digits}}/{self.total}] {self.action} words, {rate:.1f} words/s, {eta}: '
+                f'{self.counts[Progress.RESOLVED]} OK, {self.counts[Progress.FAILED]} bad API responses, '
+                f'{self.counts[Progress.MISSING]} not found')
+        if self.counts[Progress.SKIPPED]:
+            line += f', {self.counts[Progress.SKIPPED]} skipped'
+        return line
+
+    @staticmethod
+    def format_seconds(seconds: float) -> str:
+        minutes, seconds = divmod(round(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        if hours:
+            return f'{hours}h {minutes:02}m'
+        if minutes:
+            return f'{minutes}m {seconds:02}s'
+        return f'{seconds}s'
+
+    def close(self) -> None:
+        """Show the final progress, if any words were reported, and end the line."""
+        if self.done > self.shown:
+            self.show(time.monotonic())
+        if self.done and self.terminal and not self.quiet:
+            self.stream.write('\n')
+            self.stream.flush()
+        if self.events is not None:
+            self.events.flush()
+
+    def __enter__(self) -> 'Progress':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
@@ -0,0 +1,87 @@
+import json
+import math
+import os
+import threading
+from datetime import date
+from typing import Union
+
+
+class QuotaLedger:
+    """
+    Keeps track of the dictionary API queries spent today, across runs.
+
+    The free API allows a limited number of queries per day, so exports that need more than what is left today are
+    spread out over several days.
+
+    Queries can be reserved for lookups that are about to be made, e.g. the words an export has scheduled, so that
+    optional queries, like those for the words the dictionary suggests, only spend queries that aren't needed.
+    """
+    default_path = 'kanki_quota.json'
+
+    def __init__(self, daily_limit: int, path: Union[str, bytes, os.PathLike] = default_path):
+        self.daily_limit = daily_limit
+        self.path = path
+        self.day = date.today().isoformat()
+        self.used = 0
+        self.reserved = 0  # queries set aside for lookups that haven't been made yet, only known to this run
+
+        if os.path.isfile(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                ledger = json.load(f)
+            if ledger.get('day') == self.day:
+                self.used = ledger.get('used', 0)
+
+        self._lock = threading.Lock()
+
+    def remaining(self) -> int:
+        """Return the number of API queries left today."""
+        self.roll_over()
+        return max(0, self.daily_limit - self.used)
+
+    def spare(self) -> int:
+        """Return the number of API queries left today that haven't been reserved."""
+        return max(0, self.remaining() - self.reserved)
+
+    def reserve(self) -> bool:
+        """Set a query aside for a lookup about to be made, if there is one to spare. Return true if there was."""
+        with self._lock:
+            if self.spare() == 0:
+                return False
+            self.reserved += 1
+            return True
+
+    def release(self) -> None:
+        """Give back the queries reserved for lookups that weren't made, e.g. at the end of an export."""
+        with self._lock:
+            self.reserved = 0
+
+    def record(self, queries: int = 1) -> None:
+        """
+        Record API queries as spent, using up reserved queries first, and save the ledger, so queries are accounted
+        for even if kanki crashes.
+        """
+        with self._lock:
+            self.roll_over()
+            self.used += queries
+            self.reserved = max(0, self.reserved - queries)
+            self.save()
+
+    def days_needed(self, queries: int) -> int:
+        """Return the number of days needed to make the given number of API queries, starting today."""
+        remaining_today = self.remaining()
+        if queries <= remaining_today:
+            return 1
+        return 1 + math.ceil((queries - remaining_today) / self.daily_limit)
+
+    def roll_over(self) -> None:
+        """Start counting from zero when a new day has begun."""
+        today = date.today().isoformat()
+        if today != self.day:
+            self.day = today
+            self.used = 0
+
+    def save(self) -> None:
+        temporary_path = f'{os.fsdecode(self.path)}.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as f:
+            json.dump({'day': self.day, 'used': self.used}, f)
+        os.replace(temporary_path, self.path)
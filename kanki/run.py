@@ -1,16 +1,34 @@
 import argparse
 import logging
+import math
 import os
 import os.path
 import sqlite3
 import sys
-from datetime import datetime
-from typing import Iterable, List, Optional, Tuple, Union, Dict
-from tabulate import tabulate
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import closing, nullcontext
+from datetime import date, datetime, timezone
+from typing import Iterable, Iterator, List, Optional, Tuple, Union, Dict
 
-from kanki.exceptions import MissingBookError
-from kanki.card import Card
-from kanki.merriam_webster import MWDictionary
+from kanki.anki import AnkiWriter
+from kanki.archive import ResponseArchive
+from kanki.cache import Entry, LookupCache
+from kanki.dead_letters import DeadLetters
+from kanki.dictionary import (DeadLetterDictionary, Dictionary, FallbackDictionary, HedgedDictionary,
+                              QuotaDictionary)
+from kanki.exceptions import (InvalidBundleError, MissingBookError, MissingVocabError, ServiceUnavailableError,
+                              UnsupportedCollectionError)
+from kanki.export import ExportWriter
+from kanki.card import Card, CardBatch
+from kanki.local_dictionary import LocalDictionary
+from kanki.metrics import Metrics, Profiler, timer
+from kanki.progress import EventLog, Progress
+from kanki.quota import QuotaLedger
+from kanki.search import LookupFilter, SearchIndex
+from kanki.state import ExportState
+from kanki.vocab import Lookup, VocabDB
+from kanki.watch import VocabWatcher
 
 
 def main():
@@ -25,38 +43,254 @@ def main():
         print('Exiting...')
         sys.exit()
 
-    kanki = Kanki()
+    if args.jobs < 1:
+        arg_parser.error('--jobs must be at least 1')
+    if args.timeout <= 0:
+        arg_parser.error('--timeout must be positive')
+    if args.retries < 0:
+        arg_parser.error('--retries can\'t be negative')
+    if args.command == 'reparse' and args.workers is not None and args.workers < 1:
+        arg_parser.error('--workers must be at least 1')
+    if args.hedge_after < 0:
+        arg_parser.error('--hedge-after can\'t be negative')
+    if args.max_rate is not None and args.max_rate <= 0:
+        arg_parser.error('--max-rate must be positive')
+    if args.command == 'watch' and (args.interval <= 0 or args.debounce < 0):
+        arg_parser.error('--interval must be positive and --debounce can\'t be negative')
+
+    # Resuming continues a previous export from where it stopped, like an incremental export
+    kanki = Kanki(jobs=args.jobs, since_last=args.since_last or args.resume, format=args.format)
+    kanki.quiet = args.quiet
     api_key_path = 'api_key.txt'
+    data_dir = os.path.dirname(api_key_path)
     api_key = args.key
     if api_key:
         save_api_key_to_file(api_key, api_key_path)
 
-    dictionary_required = args.title or args.word or args.id
+    if args.build_index:
+        index_path = args.dictionary or LocalDictionary.default_path
+        words = LocalDictionary.build(args.build_index, index_path)
+        print(f'Indexed {words} words from "{args.build_index}" in "{index_path}".\n'
+              f'Use it by running kanki with [-d {index_path}].')
+
+    dictionary_required = (args.title or args.word or args.id or args.resume
+                           or args.command in ('watch', 'prefetch', 'retry-failed'))
     if dictionary_required:
-        if not api_key:
+        if not api_key and not args.plan and not args.offline:
             api_key = read_api_key_from_file(api_key_path)
-        kanki.dictionary = MWDictionary(api_key)
+        kanki.dictionary = create_dictionary(args, api_key, data_dir)
+    if args.events:
+        kanki.events = EventLog(args.events)
+    try:
+        run_commands(args, kanki, data_dir)
+    except UnsupportedCollectionError as err:
+        logging.error(err)
+        print('Exiting...')
+        sys.exit(1)
+    finally:
+        if kanki.dictionary is not None:
+            kanki.dictionary.close()
+        if kanki.events is not None:
+            kanki.events.close()
 
-    sql_required = args.list or args.title or args.id
+
+def run_commands(args: argparse.Namespace, kanki: 'Kanki', data_dir: str) -> None:
+    """Do what the arguments ask for, once the dictionary is ready."""
+    kanki.anki_path, kanki.deck = args.anki, args.deck
+    if args.command == 'watch':
+        kanki.state = ExportState(os.path.join(data_dir, ExportState.default_path))
+        watcher = VocabWatcher(args.paths, interval=args.interval, debounce=args.debounce)
+        titles = Kanki.flatten(args.watch_title) if args.watch_title else None
+        try:
+            kanki.watch(watcher, titles, metrics_path=args.metrics)
+        except KeyboardInterrupt:
+            print('\nStopped watching.')
+        return
+    if args.command == 'search':
+        kanki.open_vocab_db(args.db_path or [Kanki.default_db_path])
+        kanki.search_index = SearchIndex(os.path.join(data_dir, SearchIndex.default_path))
+        lookup_filter = get_lookup_filter(args, args.query, Kanki.flatten(args.search_title or []))
+        try:
+            kanki.print_search_results(lookup_filter, args.limit)
+        except sqlite3.OperationalError as err:
+            # Most likely a query that isn't valid FTS5 syntax
+            logging.error(f'Invalid search query {args.query}: {err}')
+            sys.exit(1)
+        return
+    if args.command == 'prefetch':
+        kanki.open_vocab_db(args.db_path or [Kanki.default_db_path])
+        kanki.prefetch(args.limit)
+        return
+    if args.command == 'retry-failed':
+        kanki.open_vocab_db(args.db_path or [Kanki.default_db_path])
+        kanki.retry_failed(args.limit)
+        return
+    if args.command == 'reparse':
+        kanki.open_vocab_db(args.db_path or [Kanki.default_db_path])
+        kanki.book_titles = Kanki.flatten(args.reparse_title) if args.reparse_title else None
+        cache, dead_letters = None, None
+        if not args.no_cache:
+            cache = LookupCache(os.path.join(data_dir, LookupCache.default_path), ttl_days=args.cache_ttl,
+                                max_entries=args.cache_size)
+            dead_letters = DeadLetters(os.path.join(data_dir, DeadLetters.default_path))
+        fallback_archive_path = os.path.join(data_dir, ResponseArchive.fallback_path)
+        fallback_archive = ResponseArchive(fallback_archive_path) if os.path.isfile(fallback_archive_path) else None
+        with closing(ResponseArchive(os.path.join(data_dir, ResponseArchive.default_path))) as archive:
+            try:
+                kanki.reparse(archive, cache, args.workers, dead_letters, fallback_archive)
+            finally:
+                if cache is not None:
+                    cache.close()
+                    dead_letters.close()
+                if fallback_archive is not None:
+                    fallback_archive.close()
+        return
+    if args.command == 'cache':
+        with closing(LookupCache(os.path.join(data_dir, LookupCache.default_path), ttl_days=args.cache_ttl,
+                                 max_entries=args.cache_size)) as cache:
+            if args.cache_command == 'export':
+                entries = cache.export_bundle(args.path)
+                print(f'Exported {entries} cached lookups to "{args.path}".')
+                return
+            for path in args.paths:
+                try:
+                    merged = cache.import_bundle(path)
+                except InvalidBundleError as err:
+                    logging.error(err)
+                    print('Exiting...')
+                    sys.exit(1)
+                print(f'Imported {merged} new or more recent lookups from "{path}".')
+        return
+
+    sql_required = args.list or args.title or args.id or args.resume
     if sql_required:
-        kanki.connect_sql_cursor(args.db_path)
+        kanki.open_vocab_db(args.db_path or [Kanki.default_db_path])
 
         if args.list:
             kanki.print_book_info()
 
+        kanki.state = ExportState(os.path.join(data_dir, ExportState.default_path))
         titles_to_export = []
         if args.title:
             titles_to_export = Kanki.flatten(args.title)
         if args.id:
             titles_to_export = titles_to_export + kanki.get_book_titles(Kanki.flatten(args.id))
+        if args.resume:
+            if not kanki.state.pending:
+                print('There is no export to resume.')
+            titles_to_export = Kanki.merge_titles(titles_to_export, kanki.state.pending)
 
         kanki.book_titles = titles_to_export
-        if titles_to_export:
-            kanki.export_book_lookups()
+        kanki.lookup_filter = get_lookup_filter(args, args.match)
+        if kanki.lookup_filter:
+            kanki.search_index = SearchIndex(os.path.join(data_dir, SearchIndex.default_path))
+        if titles_to_export and args.plan:
+            kanki.print_export_plan(follow_suggestions=not args.no_suggestions)
+        elif titles_to_export:
+            try:
+                kanki.export_book_lookups(metrics_path=args.metrics, profile_path=args.profile)
+            except ServiceUnavailableError as err:
+                logging.error(f'The dictionary API is unavailable. {err}')
+                print('Export stopped. Run kanki with --resume later to continue where it stopped.')
+                sys.exit(1)
 
-    if args.word:
+    if args.word and not args.plan:
         # For debugging, we can look up single words instead of going through a whole book.
-        kanki.dictionary.lookup(args.word)
+        try:
+            word_stem, definitions, ipa = kanki.dictionary.lookup(args.word)
+            print(f'{word_stem} [{ipa}]: {"; ".join(definitions)}')
+        except KeyError:
+            print('bad API response')
+        except TypeError:
+            print('not found in the dictionary!')
+        except ServiceUnavailableError as err:
+            print(f'the dictionary API is unavailable: {err}')
+
+
+def get_lookup_filter(args: argparse.Namespace, match: Optional[str], titles: Iterable[str] = ()) -> LookupFilter:
+    return LookupFilter(match, args.words, args.first_day, args.last_day, tuple(titles))
+
+
+def parse_day(day: str) -> date:
+    try:
+        return date.fromisoformat(day)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid date {day}, expected YYYY-MM-DD') from None
+
+
+def add_filter_arguments(parser: argparse.ArgumentParser, default: Optional[str] = None) -> None:
+    """
+    :param default: of the arguments, argparse.SUPPRESS for a subcommand, so that it doesn't override the filters
+                    given to kanki itself
+    """
+    parser.add_argument('--words', metavar='PATTERN', default=default,
+                        help='only lookups of words matching a pattern, with * for any characters, e.g. \'run*\'')
+    parser.add_argument('--from', dest='first_day', type=parse_day, metavar='DATE', default=default,
+                        help='only lookups made on or after a date, YYYY-MM-DD')
+    parser.add_argument('--until', dest='last_day', type=parse_day, metavar='DATE', default=default,
+                        help='only lookups made on or before a date, YYYY-MM-DD')
+
+
+def create_dictionary(args: argparse.Namespace, api_key: Optional[str], data_dir: str) -> Dictionary:
+    """
+    Return the dictionary to look up words in: the Merriam-Webster API, a local dictionary, or both. With --plan, only
+    what is needed to count the API queries of an export.
+    """
+    # requests is only imported when the API is used, so that other commands start quickly
+    from kanki.client import APIClient
+    from kanki.merriam_webster import MWDictionary
+
+    local_dictionary = None
+    if args.dictionary or args.offline:
+        index_path = args.dictionary or LocalDictionary.default_path
+        if not os.path.isfile(index_path):
+            logging.error(f'Dictionary index "{index_path}" not found')
+            print('Build one from a dictionary dump with the [--build-index DUMP] argument.')
+            print('Exiting...')
+            sys.exit(1)
+        local_dictionary = LocalDictionary(index_path)
+        if args.offline:
+            return local_dictionary
+
+    cache_path = os.path.join(data_dir, LookupCache.default_path)
+    dead_letters_path = os.path.join(data_dir, DeadLetters.default_path)
+    cache = None
+    # A plan is a dry run, it reads the cache and failed words of earlier exports but doesn't create any files
+    if not args.no_cache and (not args.plan or os.path.isfile(cache_path)):
+        cache = LookupCache(cache_path, ttl_days=args.cache_ttl, max_entries=args.cache_size, refresh=args.refresh)
+    ledger = QuotaLedger(MWDictionary.max_queries, os.path.join(data_dir, QuotaLedger.default_path))
+    if args.plan:
+        dictionary = QuotaDictionary(MWDictionary.max_queries, cache, ledger)
+        if not args.no_cache and os.path.isfile(dead_letters_path):
+            dictionary = DeadLetterDictionary(dictionary, DeadLetters(dead_letters_path, refresh=args.refresh))
+        return FallbackDictionary(local_dictionary, dictionary) if local_dictionary else dictionary
+
+    # Looking up suggestions of missing words doubles the queries in flight at once
+    pool_size = args.jobs if args.no_suggestions else 2 * args.jobs
+    client = APIClient(pool_size=pool_size, timeout=args.timeout, retries=args.retries, max_rate=args.max_rate)
+    archive = None if args.no_archive else ResponseArchive(os.path.join(data_dir, ResponseArchive.default_path))
+    dictionary = MWDictionary(api_key, cache, ledger=ledger, client=client, archive=archive)
+    if args.fallback_url or not args.no_suggestions:
+        secondary = None
+        if args.fallback_url:
+            # The endpoint has a quota of its own, spent only on words the Learner's dictionary lacks or is slow on
+            secondary_ledger = QuotaLedger(MWDictionary.max_queries,
+                                           os.path.join(data_dir, 'kanki_quota_fallback.json'))
+            secondary_client = APIClient(pool_size=args.jobs, timeout=args.timeout, retries=args.retries,
+                                         max_rate=args.max_rate)
+            secondary_archive = None if args.no_archive else \
+                ResponseArchive(os.path.join(data_dir, ResponseArchive.fallback_path))
+            secondary = MWDictionary(args.fallback_key or api_key, ledger=secondary_ledger,
+                                     api_base_url=args.fallback_url, client=secondary_client, archive=secondary_archive)
+        dictionary = HedgedDictionary(dictionary, secondary, hedge_after=args.hedge_after,
+                                      follow_suggestions=not args.no_suggestions, workers=args.jobs)
+    if not args.no_cache:
+        # Words known to fail are skipped like cached words, the local dictionary is still searched for them
+        dead_letters = DeadLetters(dead_letters_path, refresh=args.refresh)
+        dictionary = DeadLetterDictionary(dictionary, dead_letters)
+    if local_dictionary:
+        return FallbackDictionary(local_dictionary, dictionary)
+    return dictionary
 
 
 def get_arg_parser():
@@ -73,12 +307,159 @@ def get_arg_parser():
                             nargs='+',
                             action='append',
                             type=int)
-    arg_parser.add_argument('-p', '--db_path', type=str, default='vocab.db',
-                            help='the path to the vocabulary database (default: ./vocab.db)')
+    arg_parser.add_argument('-p', '--db_path', type=str, action='append',
+                            help='the path to the vocabulary database, or a directory with them. Repeat to merge the '
+                                 'lookups of several Kindles (default: ./vocab.db)')
     arg_parser.add_argument('-k', '--key', type=str,
                             help='your Merriam-Websters Learner\'s Dictionary API key')
     arg_parser.add_argument('-w', '--word',
                             help='a single word to look up in the dictionary.')
+    arg_parser.add_argument('-s', '--since-last',
+                            help='only export lookups made since the last export of each book, appending them to a '
+                                 'dated export file',
+                            action='store_true')
+    arg_parser.add_argument('-r', '--resume',
+                            help='continue an export that was interrupted or stopped by the daily API limit',
+                            action='store_true')
+    arg_parser.add_argument('--plan',
+                            help='print the number of API queries and days the export needs, without exporting',
+                            action='store_true')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=Kanki.default_jobs, metavar='N',
+                            help=f'number of concurrent dictionary lookups (default: {Kanki.default_jobs})')
+    arg_parser.add_argument('--timeout', type=float, default=Kanki.default_timeout, metavar='SECONDS',
+                            help=f'seconds to wait for the dictionary API to respond before retrying '
+                                 f'(default: {Kanki.default_timeout:g})')
+    arg_parser.add_argument('--retries', type=int, default=Kanki.default_retries, metavar='N',
+                            help=f'times to retry a lookup when the dictionary API is overloaded or failing, with '
+                                 f'backoff (default: {Kanki.default_retries})')
+    arg_parser.add_argument('--max-rate', type=float, metavar='N',
+                            help='most dictionary API queries per second (default: no limit, slow down only when '
+                                 'the API asks to)')
+    arg_parser.add_argument('--fallback-url', metavar='URL',
+                            help='also look words up at another Merriam-Webster endpoint when the Learner\'s '
+                                 'dictionary lacks them or is slow, e.g. the Collegiate dictionary at '
+                                 'https://www.dictionaryapi.com/api/v3/references/collegiate/json/')
+    arg_parser.add_argument('--fallback-key', metavar='KEY',
+                            help='the API key for --fallback-url (default: the key of the Learner\'s dictionary)')
+    arg_parser.add_argument('--hedge-after', type=float, default=HedgedDictionary.default_hedge_after,
+                            metavar='SECONDS',
+                            help=f'seconds to wait for the Learner\'s dictionary before also querying --fallback-url '
+                                 f'(default: {HedgedDictionary.default_hedge_after:g})')
+    arg_parser.add_argument('--no-suggestions',
+                            help='don\'t look up the word the dictionary suggests for a word it lacks',
+                            action='store_true')
+    arg_parser.add_argument('-f', '--format', choices=CardBatch.formats, default=Kanki.default_format,
+                            help=f'format of the export files, fields separated by commas or tabs '
+                                 f'(default: {Kanki.default_format})')
+    arg_parser.add_argument('-a', '--anki', metavar='PATH',
+                            help='write cards to an Anki package (.apkg) to import, or straight into an Anki 2.0 '
+                                 'collection file (.anki2), instead of a text file. Cards of earlier exports are '
+                                 'updated instead of duplicated')
+    arg_parser.add_argument('--deck', default=Kanki.default_deck,
+                            help=f'the Anki deck to add cards to, with --anki (default: {Kanki.default_deck})')
+    arg_parser.add_argument('-q', '--quiet',
+                            help='don\'t show the progress of exports or what kanki is doing, only warnings and errors',
+                            action='store_true')
+    arg_parser.add_argument('--events', metavar='PATH',
+                            help='append a JSON record of every word looked up, found or not, to a JSON lines file, '
+                                 'e.g. for other tools to follow the export')
+    arg_parser.add_argument('--metrics', metavar='PATH',
+                            help='write a JSON report of where the time of the export went, API latencies, HTTP '
+                                 'statuses, cache hits and failed words')
+    arg_parser.add_argument('--profile', metavar='PATH',
+                            help='write cProfile stats of the export, e.g. for python -m pstats')
+    arg_parser.add_argument('-d', '--dictionary', metavar='INDEX',
+                            help='look words up in a local dictionary index first, and only query Merriam-Webster\'s '
+                                 'for words it lacks')
+    arg_parser.add_argument('--offline',
+                            help=f'only look words up in the local dictionary index (default: '
+                                 f'./{LocalDictionary.default_path})',
+                            action='store_true')
+    arg_parser.add_argument('--build-index', metavar='DUMP',
+                            help='build a local dictionary index from a dictionary dump in the JSON lines format')
+    arg_parser.add_argument('--no-cache',
+                            help='don\'t read or write the local lookup cache',
+                            action='store_true')
+    arg_parser.add_argument('--refresh',
+                            help='ignore cached lookups and query the dictionary again, updating the cache',
+                            action='store_true')
+    arg_parser.add_argument('--no-archive',
+                            help=f'don\'t keep the raw API responses in {ResponseArchive.default_path}, '
+                                 'to rebuild cards from them with kanki reparse',
+                            action='store_true')
+    arg_parser.add_argument('--cache-ttl', type=float, default=LookupCache.default_ttl_days, metavar='DAYS',
+                            help=f'days before a cached lookup expires, 0 to never expire '
+                                 f'(default: {LookupCache.default_ttl_days})')
+    arg_parser.add_argument('--cache-size', type=int, default=LookupCache.default_max_entries, metavar='N',
+                            help=f'maximum number of cached lookups, 0 for no limit '
+                                 f'(default: {LookupCache.default_max_entries})')
+    arg_parser.add_argument('--match', metavar='QUERY',
+                            help='only export lookups whose word, sentence or book matches a full-text query, e.g. '
+                                 '\'"a whole phrase"\', see kanki search')
+    add_filter_arguments(arg_parser)
+
+    commands = arg_parser.add_subparsers(dest='command', metavar='COMMAND',
+                                         description='give options of kanki itself before the command')
+    watch_parser = commands.add_parser('watch', help='export new lookups every time the vocabulary file changes, e.g. '
+                                                     'when a Kindle is plugged in',
+                                       description='Watch vocabulary files, e.g. on a mounted Kindle, and export the '
+                                                   'new lookups every time they change until interrupted.')
+    watch_parser.add_argument('paths', nargs='+', metavar='PATH',
+                              help='the vocabulary file(s) to watch, or directories with them')
+    watch_parser.add_argument('-t', '--title', dest='watch_title', nargs='+', action='append', metavar='TITLE',
+                              help='only export these books (default: every book with new lookups)')
+    watch_parser.add_argument('--interval', type=float, default=VocabWatcher.default_interval, metavar='SECONDS',
+                              help=f'seconds between checks for changes (default: {VocabWatcher.default_interval:g})')
+    watch_parser.add_argument('--debounce', type=float, default=VocabWatcher.default_debounce, metavar='SECONDS',
+                              help=f'seconds the files must stay unchanged before exporting, as the Kindle writes '
+                                   f'them several times while syncing (default: {VocabWatcher.default_debounce:g})')
+
+    prefetch_parser = commands.add_parser('prefetch', help='spend the API queries left today on words of the most '
+                                                           'recently read books, so later exports run from the cache',
+                                          description='Look up words that aren\'t cached yet, from the most recently '
+                                                      'read book first, with the API queries left today.')
+    prefetch_parser.add_argument('--limit', type=int, metavar='N',
+                                 help='most API queries to spend (default: all that are left today)')
+
+    search_parser = commands.add_parser('search', help='search the lookups of all books',
+                                        description='Search the words, sentences and book titles of all lookups, '
+                                                    'the most recent first.')
+    search_parser.add_argument('query', nargs='?', metavar='QUERY',
+                               help='words that must all appear, "a whole phrase", prefix* or e.g. usage: word to '
+                                    'only search sentences, '
+                                    'see https://www.sqlite.org/fts5.html#full_text_query_syntax')
+    search_parser.add_argument('-t', '--title', dest='search_title', nargs='+', action='append', metavar='TITLE',
+                               help='only search these books')
+    add_filter_arguments(search_parser, default=argparse.SUPPRESS)
+    search_parser.add_argument('-n', '--limit', type=int, default=50, metavar='N',
+                               help='most lookups to show (default: 50)')
+
+    retry_parser = commands.add_parser('retry-failed', help='look up words that failed before again, once they are '
+                                                            'due, and export the cards of those found',
+                                       description='Look up the words that failed in earlier exports and are due '
+                                                   'for another try, with the API queries left today.')
+    retry_parser.add_argument('--limit', type=int, metavar='N',
+                              help='most words to look up (default: as many as there are API queries left today)')
+
+    reparse_parser = commands.add_parser('reparse', help='export the cards again from the archived API responses, '
+                                                         'without querying the API',
+                                         description='Parse the archived responses of earlier lookups again, e.g. '
+                                                     'after updating kanki, and export the cards and failed words of '
+                                                     'the books from them without querying the API.')
+    reparse_parser.add_argument('-t', '--title', dest='reparse_title', nargs='+', action='append', metavar='TITLE',
+                                help='only export these books (default: every book)')
+    reparse_parser.add_argument('--workers', type=int, metavar='N',
+                                help='number of processes parsing responses (default: one per CPU)')
+
+    cache_parser = commands.add_parser('cache', help='share the lookup cache, e.g. with others reading the same books',
+                                       description='Export the lookup cache to a compressed bundle, or merge bundles '
+                                                   'of others into it, so words are only queried once.')
+    cache_commands = cache_parser.add_subparsers(dest='cache_command', metavar='COMMAND', required=True)
+    cache_export_parser = cache_commands.add_parser('export', help='write the cached lookups to a bundle')
+    cache_export_parser.add_argument('path', nargs='?', default=LookupCache.default_bundle_path, metavar='PATH',
+                                     help=f'the bundle to write (default: {LookupCache.default_bundle_path})')
+    cache_import_parser = cache_commands.add_parser('import', help='merge bundles into the lookup cache')
+    cache_import_parser.add_argument('paths', nargs='+', metavar='PATH', help='the bundle(s) to merge')
     return arg_parser
 
 
@@ -106,109 +487,767 @@ def read_api_key_from_file(path: Union[str, bytes, os.PathLike]):
 
 class Kanki:
     successful_words_path = 'kanki_export.txt'
+    default_db_path = 'vocab.db'
     failed_words_path = 'kanki_failed_words.txt'
+    default_jobs = 4
+    default_timeout = 10.0  # seconds to wait for the dictionary API, see APIClient
+    default_retries = 4
+    default_format = 'csv'
+    default_deck = 'kanki'
+    checkpoint_interval = 50  # cards written between saving the progress of an export
+    reparse_threshold = 500  # fewer archived responses than this are parsed without starting worker processes
 
-    def __init__(self, dictionary=None, db_cursor=None, book_titles=None):
-        self.dictionary: Optional[MWDictionary] = dictionary
-        self.db_cursor: Optional[sqlite3.Cursor] = db_cursor
+    def __init__(self, dictionary=None, vocab=None, book_titles=None, jobs=default_jobs, state=None,
+                 since_last=False, format=default_format):
+        self.dictionary: Optional[Dictionary] = dictionary
+        self.vocab: Optional[VocabDB] = vocab
         self.book_titles: Optional[List[str]] = book_titles
+        self.jobs: int = jobs  # number of concurrent dictionary lookups
+        self.state: Optional[ExportState] = state  # how far each book has been exported
+        self.since_last: bool = since_last  # only export lookups newer than those in the last export
+        self.format: str = format  # of the export files, csv or tsv
+        self.anki_path: Optional[str] = None  # Anki package or collection to write cards to instead of a text file
+        self.deck: str = Kanki.default_deck
+        self.postponed_from: Optional[Lookup] = None  # first lookup that didn't fit in today's API limit
+        self.metrics: Optional[Metrics] = None  # collected during an export if a metrics report is wanted
+        self.profiler: Optional[Profiler] = None
+        self.lookup_filter = LookupFilter()  # only export the lookups matching it
+        self.search_index: Optional[SearchIndex] = None  # to filter lookups with
+        self.quiet: bool = False  # only print warnings, errors and what was asked for, e.g. --list
+        self.events: Optional[EventLog] = None  # where to write a record of every word looked up
+
+    def inform(self, message: str) -> None:
+        """Print a message about what kanki is doing, unless asked to be quiet."""
+        if not self.quiet:
+            print(message)
 
-    def connect_sql_cursor(self, db_path: str) -> None:
-        """Connect the sql cursor to the given Kindle vocabulary file."""
-        if not os.path.isfile(db_path):
-            logging.error(f'Vocabulary database file "{db_path}" not found')
+    def open_vocab_db(self, db_paths: Union[str, List[str]]) -> None:
+        """Open the given Kindle vocabulary file, or merge several files or directories of them into one."""
+        db_paths = [db_paths] if isinstance(db_paths, str) else db_paths
+        try:
+            for db_path in db_paths:
+                if not os.path.exists(db_path):
+                    raise MissingVocabError(f'Vocabulary database file "{db_path}" not found')
+            self.vocab = VocabDB.open_many(db_paths)
+        except MissingVocabError as err:
+            logging.error(err)
             print(f'See https://github.com/wjohnsson/kanki/blob/master/README.md#usage how to find the Kindle '
                   f'vocabulary database file.')
             print('Exiting...')
             sys.exit(1)
-        connection = sqlite3.connect(db_path)
-        self.db_cursor = connection.cursor()
+        if self.vocab.sources > 1:
+            self.inform(f'Merged {self.vocab.sources} vocabulary files, skipping {self.vocab.duplicates} lookups '
+                        f'found in more than one.')
+
+    def watch(self, watcher: VocabWatcher, book_titles: Optional[List[str]] = None,
+              metrics_path: Optional[str] = None) -> None:
+        """
+        Export the new lookups of the watched vocabulary files every time they change, until interrupted.
+
+        The dictionary stays open between exports, so its connections to the API and its cache are reused. An export
+        stopped by an outage of the API is continued after the next change, with the circuit breaker of the API client
+        closed again.
+
+        :param book_titles: the books to export, by default every book with lookups that haven't been exported
+        """
+        self.since_last = True
+        for paths in watcher.changes():
+            self.inform(f'--- {datetime.now().strftime("%H:%M:%S")} Vocabulary changed: {", ".join(paths)}')
+            # The API may have recovered from an outage that stopped the previous export
+            self.dictionary.reset()
+            # The Kindle may still change the files, so SQLite has to lock them while reading
+            try:
+                self.vocab = VocabDB.open_many(paths, immutable=False)
+            except MissingVocabError as err:
+                logging.warning(err)
+                continue
+            try:
+                self.book_titles = book_titles or self.books_with_new_lookups()
+                if self.book_titles:
+                    self.export_book_lookups(metrics_path=metrics_path)
+                else:
+                    self.inform('No new lookups since the last export.')
+            except ServiceUnavailableError as err:
+                # The books stay pending, so they are exported first after the next sync, or with --resume
+                logging.error(f'The dictionary API is unavailable. {err}')
+                self.inform('Export stopped, it continues after the next sync.')
+            finally:
+                self.vocab.close()
+
+    def prefetch(self, limit: Optional[int] = None) -> None:
+        """
+        Look up words that aren't cached yet with the API queries left today, so that later exports of the books run
+        from the cache. Words of the most recently read books are looked up first.
+
+        :param limit: most API queries to spend, by default all that are left today
+        """
+        if self.dictionary.cache is None:
+            print('There is no lookup cache to prefetch words into.')
+            return
+        budget = self.remaining_queries()
+        if budget is None:
+            print('The dictionary has no daily limit, words are looked up when they are exported.')
+            return
+        if limit is not None:
+            budget = min(budget, limit)
+
+        words = self.prefetch_words(budget)
+        self.inform(f'--- Prefetching {len(words)} words, {self.remaining_queries()} API queries left today')
+        found = len(self.look_up_words(words, 'Prefetching'))
+        self.inform(f'\n- {found} words cached.'
+                    f'\n- {self.dictionary.queries_made} dictionary API queries made, {self.remaining_queries()} left '
+                    f'today.')
+
+    def look_up_words(self, words: List[str], action: str) -> Dict[str, Entry]:
+        """
+        Look up words concurrently, showing the progress, until the API queries left today run out. Return the entries
+        of the words found.
+        """
+        entries = {}
+        executor = ThreadPoolExecutor(max_workers=self.jobs)
+        progress = Progress(len(words), action, quiet=self.quiet, events=self.events)
+        try:
+            results = [executor.submit(self.look_up_word_within_limit, word) for word in words]
+            for word, result in zip(words, results):
+                try:
+                    entry = result.result()
+                    progress.record(word, Progress.RESOLVED if entry else Progress.SKIPPED, entry=entry)
+                    if entry:
+                        entries[word] = entry
+                except KeyError as err:
+                    progress.record(word, Progress.FAILED, error=err)
+                except TypeError as err:
+                    progress.record(word, Progress.MISSING, error=err)
+        except ServiceUnavailableError as err:
+            logging.error(f'The dictionary API is unavailable. {err}')
+        finally:
+            executor.shutdown(cancel_futures=True)
+            self.release_queries()
+            progress.close()
+        return entries
+
+    def look_up_word_within_limit(self, word: str) -> Optional[Entry]:
+        """
+        Look up a word unless the API queries left today have run out, e.g. on retries or suggested words, reserving
+        the query it costs. Return its entry if so.
+        """
+        ledger = self.dictionary.ledger
+        if self.remaining_queries() == 0 or (ledger is not None and self.dictionary.costs_query(word)
+                                             and not ledger.reserve()):
+            return None
+        return self.dictionary.lookup(word)
+
+    def retry_failed(self, limit: Optional[int] = None) -> None:
+        """
+        Look up the words that failed in earlier exports again, those whose failure has expired, with the API queries
+        left today. The cards of the lookups of the words found are appended to today's export, like --since-last.
+
+        :param limit: most words to look up, by default as many as there are API queries left today
+        """
+        dead_letters = self.dictionary.dead_letters
+        if dead_letters is None:
+            print('Failed words are only remembered when the lookup cache is used.')
+            return
+        budget = self.remaining_queries()
+        if limit is not None:
+            budget = limit if budget is None else min(budget, limit)
+        words = dead_letters.due(budget)
+        if not words:
+            next_due = dead_letters.next_due()
+            waiting = f', the next one until {datetime.fromtimestamp(next_due):%Y-%m-%d %H:%M}' if next_due else ''
+            self.inform(f'No failed words are due for another lookup, {len(dead_letters)} are waiting{waiting}.')
+            return
+
+        self.inform(f'--- Retrying {len(words)} of {len(dead_letters)} failed words, {self.remaining_queries()} API '
+                    f'queries left today')
+        entries = self.look_up_words(words, 'Retrying')
+        lookups = [lookup for lookup in self.vocab.all_lookups() if Kanki.query_word(lookup) in entries]
+        exported_to = ''
+        if lookups:
+            self.since_last = True
+            self.book_titles = list(dict.fromkeys(lookup.title for lookup in lookups))
+            path, _ = self.export_paths()
+            with self.open_successful_output(path, self.metadata_about_export()) as output:
+                for lookup in lookups:
+                    output.write_lookup(lookup, entries[Kanki.query_word(lookup)])
+            exported_to = f' to \'{path}\''
+        self.inform(f'\n- {len(entries)} words found, {len(lookups)} cards of their lookups exported{exported_to}.'
+                    f'\n- {len(dead_letters)} failed words left.'
+                    f'\n- {self.dictionary.queries_made} dictionary API queries made, {self.remaining_queries()} left '
+                    f'today.')
+
+    def prefetch_words(self, budget: int) -> List[str]:
+        """
+        Return at most `budget` words to prefetch, the unique words that would cost an API query, from the book with
+        the most recent lookup first, like --list.
+        """
+        titles = [book.title for book in self.vocab.catalog()]
+        words = {}  # ordered set
+        for lookup in self.vocab.lookups(titles):
+            if len(words) >= budget:
+                break
+            word = Kanki.query_word(lookup)
+            if word not in words and self.dictionary.costs_query(word):
+                words[word] = None
+        return list(words)
+
+    def reparse(self, archive: ResponseArchive, cache: Optional[LookupCache] = None, workers: Optional[int] = None,
+                dead_letters: Optional[DeadLetters] = None, fallback_archive: Optional[ResponseArchive] = None) -> None:
+        """
+        Export the cards and failed words of the books again from the archived API responses, without querying the
+        API, e.g. after the parsing of responses has improved. Every book is exported if no titles are given.
+
+        The responses are parsed in parallel by a process pool. A word missing from its response is found like the
+        export found it, see resolve_archived. Entries that parse are also cached, and their words forgotten as failed
+        words. Lookups of words without an archived response, e.g. those found in the local dictionary, are left out.
+
+        :param workers: number of processes parsing responses, by default one per CPU
+        :param fallback_archive: the archived responses of --fallback-url, if any
+        """
+        from kanki.merriam_webster import parse_archived
+
+        responses = archive.latest()
+        fallback_responses = fallback_archive.latest() if fallback_archive is not None else []
+        all_responses = responses + fallback_responses
+        if not all_responses:
+            print('There are no archived API responses to parse.')
+            return
+        self.inform(f'--- Parsing {len(all_responses)} archived API responses')
+        workers = workers or os.cpu_count() or 1
+        if workers == 1 or len(all_responses) < Kanki.reparse_threshold:
+            results = parse_archived(all_responses)
+        else:
+            # A few chunks per worker, so workers that finish early get more to do
+            chunk_size = math.ceil(len(all_responses) / (4 * workers))
+            chunks = [all_responses[i:i + chunk_size] for i in range(0, len(all_responses), chunk_size)]
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = [result for chunk_results in executor.map(parse_archived, chunks)
+                           for result in chunk_results]
+        primary_results = dict(results[:len(responses)])
+        fallback_results = dict(results[len(responses):])
+
+        parsed: Dict[str, Union[Entry, Exception]] = {}  # word -> its entry, or the error parsing it
+        found = []
+        for word in sorted(primary_results.keys() | fallback_results.keys()):
+            result = Kanki.resolve_archived(word, primary_results, fallback_results)
+            if isinstance(result, Exception):
+                parsed[word] = result
+            else:
+                entry, forms = result
+                parsed[word] = entry
+                found.append((word, entry, forms))
+        if cache is not None:
+            cache.put_many(found)
+        if dead_letters is not None:
+            dead_letters.remove(*(word for word, _, _ in found))
+
+        if not self.book_titles:
+            self.book_titles = [book.title for book in self.vocab.catalog()]
+        counts, lookups = self.select_lookups()
+        successful_words_path, failed_words_path = self.export_paths()
+        header = self.metadata_about_export()
+        failed_words, missing_words, unarchived = 0, 0, 0
+        with self.open_successful_output(successful_words_path, header) as successful_output, \
+                ExportWriter(failed_words_path, header, self.since_last, self.format) as failed_output:
+            for lookup in lookups:
+                result = parsed.get(Kanki.query_word(lookup))
+                if result is None:
+                    unarchived += 1
+                elif isinstance(result, Exception):
+                    failed_output.write_lookup(lookup, None)
+                    failed_words += isinstance(result, KeyError)
+                    missing_words += isinstance(result, TypeError)
+                else:
+                    successful_output.write_lookup(lookup, result)
+
+        self.inform(f'\n####  REPARSE INFO  ####'
+                    f'\nBooks exported: {self.book_titles}'
+                    f'\n- {successful_output.count} cards exported to \'{successful_words_path}\'.'
+                    f'\n- {failed_words} words not in expected format and {missing_words} words not in the online '
+                    f'dictionary, written to \'{failed_words_path}\'.'
+                    f'\n- {unarchived} lookups left out, their words have no archived API response.')
+
+    @staticmethod
+    def resolve_archived(word: str, primary_results: dict, fallback_results: dict) \
+            -> Union[Tuple[Entry, List[str]], Exception]:
+        """
+        Return the entry and forms of a word from the parsed responses of the primary and fallback dictionaries, see
+        parse_archived, or the error looking it up would have raised.
+
+        Like HedgedDictionary, a word the primary dictionary lacks is found in the fallback dictionary, or else under
+        the top word the primary dictionary suggested instead, which was archived when the export followed it. Entries
+        found for another word, or in the fallback dictionary, come without forms, as the export cached them.
+        """
+        result = primary_results.get(word)
+        if result is not None and not isinstance(result, Exception):
+            return result
+        fallback_result = fallback_results.get(word)
+        if fallback_result is not None and not isinstance(fallback_result, Exception):
+            return fallback_result[0], []
+        suggestion = next(iter(getattr(result, 'suggestions', ())), None)
+        if suggestion:
+            suggested = primary_results.get(ResponseArchive.normalize(suggestion))
+            if suggested is not None and not isinstance(suggested, Exception):
+                return suggested[0], []
+        return result if result is not None else fallback_result
+
+    def books_with_new_lookups(self) -> List[str]:
+        """Return the titles of the books with lookups that haven't been exported yet, pending books first."""
+        catalog = self.vocab.catalog()
+        titles = {book.title.lower(): book.title for book in catalog}
+        pending = [titles[title.lower()] for title in self.state.pending if title.lower() in titles]
+        return pending + [book.title for book in catalog
+                          if book.last_lookup > self.state.last_timestamp(book.title) and book.title not in pending]
+
+    def export_book_lookups(self, metrics_path: Optional[str] = None, profile_path: Optional[str] = None) -> None:
+        """
+        Export all lookups in the given book titles to a Kanki readable format.
+
+        Cards are written to the export files as soon as their word has been looked up, and the progress is checkpointed
+        regularly. Lookups that need more API queries than are left today, or that weren't reached because the export
+        was interrupted, can be exported later with --resume.
+
+        :param metrics_path: where to write a JSON report of the time spent in each phase of the export, API latencies
+                             and counts of HTTP statuses, cache hits and failed words
+        :param profile_path: where to write cProfile stats of the export
+        :raises ServiceUnavailableError: if the dictionary API became unavailable, once the progress is saved
+        """
+        if metrics_path:
+            self.metrics = Metrics()
+            self.dictionary.metrics = self.metrics
+        if profile_path:
+            self.profiler = Profiler()
+        try:
+            with self.profiler or nullcontext(), timer(self.metrics, 'total'):
+                self.export_lookups()
+        finally:
+            if profile_path:
+                self.profiler.dump(profile_path)
+                self.inform(f'Profile written to \'{profile_path}\'.')
+            if metrics_path:
+                self.metrics.write(metrics_path, **self.metrics_details())
+                self.inform(f'Metrics written to \'{metrics_path}\'.')
+
+    def export_lookups(self) -> None:
+        with timer(self.metrics, 'select'):
+            counts, lookups = self.select_lookups()
+        if self.metrics is not None:
+            lookups = self.metrics.timed_iter('sql', lookups)
+        if not self.book_titles:
+            self.inform('No new lookups since the last export.')
+            return
+        for book_title, count in zip(self.book_titles, counts):
+            self.inform(f'--- Exporting {count} lookups from book: {book_title}')
+
+        # An export of some of the lookups of the books doesn't tell how far the books have been exported
+        if self.state is not None and not self.lookup_filter:
+            self.begin_export()
+        successful_words_path, failed_words_path = self.export_paths()
+        header = self.metadata_about_export()
+        exported = {}  # book title -> timestamp of the last lookup written
+        in_progress = self.book_titles[0]  # the first book not completely exported
+        failed_words, missing_words = 0, 0
+        successful_output = None
+        try:
+            try:
+                with self.open_successful_output(successful_words_path, header) as successful_output, \
+                        ExportWriter(failed_words_path, header, self.since_last, self.format) as failed_output, \
+                        closing(self.resolve_lookups(self.schedule(lookups, self.remaining_queries()),
+                                                     sum(counts))) as entries:
+                    outputs = [successful_output, failed_output]
+                    completed = False
+                    try:
+                        for i, (lookup, entry, error) in enumerate(entries):
+                            with timer(self.metrics, 'write'):
+                                if error is None:
+                                    successful_output.write_lookup(lookup, entry)
+                                else:
+                                    failed_output.write_lookup(lookup, None)
+                                    failed_words += isinstance(error, KeyError)
+                                    missing_words += isinstance(error, TypeError)
+                            exported[lookup.title] = lookup.timestamp
+                            in_progress = lookup.title
+                            if (i + 1) % Kanki.checkpoint_interval == 0:
+                                with timer(self.metrics, 'checkpoint'):
+                                    self.checkpoint(outputs, exported, in_progress)
+                        completed = True
+                    finally:
+                        # Also save the progress if the export crashed, so that it can be resumed
+                        if completed:
+                            in_progress = self.postponed_from.title if self.postponed_from else None
+                        with timer(self.metrics, 'checkpoint'):
+                            self.checkpoint(outputs, exported, in_progress)
+                        if self.metrics is not None:
+                            self.metrics.count('cards_exported', successful_output.count)
+                            self.metrics.count('words_failed', failed_words)
+                            self.metrics.count('words_missing', missing_words)
+            finally:
+                # The cards of a package are only exported once it has been written, when its writer was closed
+                if isinstance(successful_output, AnkiWriter) and successful_output.package_written:
+                    self.save_progress(exported, in_progress)
+        except KeyboardInterrupt:
+            print('\nExport interrupted. Run kanki with --resume to continue where it stopped.')
+            sys.exit(1)
+        self.inform(f'\n####  EXPORT INFO  ####'
+                    f'\nBooks exported: {self.book_titles}'
+                    f'\n- {successful_output.count} cards successfully exported to \'{successful_words_path}.\''
+                    f'\n- {failed_words} words not in expected format, written to \'{failed_words_path}\'.'
+                    f'\n- {missing_words} words not in the online dictionary, also written to '
+                    f'\'{failed_words_path}\'.'
+                    f'\n- {self.dictionary.queries_made} dictionary API queries made.')
+        if isinstance(successful_output, AnkiWriter):
+            self.inform(f'- {successful_output.added} notes added and {successful_output.updated} notes of earlier '
+                        f'exports updated in the deck \'{self.deck}\'.')
+        if self.postponed_from:
+            postponed = sum(counts) - successful_output.count - failed_output.count
+            if self.metrics is not None:
+                self.metrics.count('lookups_postponed', postponed)
+            again = 'the same export again' if self.lookup_filter else 'kanki with --resume'
+            self.inform(f'- {postponed} lookups postponed since the daily API limit was reached. '
+                        f'Run {again} tomorrow to continue.')
+
+    def metrics_details(self) -> dict:
+        """Return details about the export for the metrics report."""
+        details = {'books': self.book_titles, 'jobs': self.jobs, 'api_queries': self.dictionary.queries_made}
+        if self.dictionary.cache is not None:
+            cache = self.dictionary.cache
+            details['cache'] = {'hits': cache.hits, 'misses': cache.misses, 'inflection_hits': cache.inflection_hits}
+        if self.dictionary.dead_letters is not None:
+            details['dead_letters'] = {'skips': self.dictionary.dead_letters.skips}
+        return details
+
+    def print_export_plan(self, follow_suggestions: bool = True) -> None:
+        """
+        Print how many API queries and days the export needs, without querying the dictionary.
 
-    def export_book_lookups(self) -> None:
-        """Export all lookups in the given book titles to a Kanki readable format."""
+        :param follow_suggestions: if the words the dictionary suggests for missing words are looked up as well, see
+                                   HedgedDictionary, which may cost more queries than planned
+        """
+        counts, lookups = self.select_lookups()
+        query_words = set(Kanki.query_word(lookup) for lookup in lookups)
+        queries = self.count_api_queries(query_words)
+        # Words that failed in earlier exports are skipped without a query, but don't make cards either
+        dead_letters = self.dictionary.dead_letters
+        skipped = 0 if dead_letters is None else \
+            sum(1 for word in query_words if word in dead_letters and not self.dictionary.has_entry(word))
+        remaining_today = self.remaining_queries()
+
+        print(f'\n####  EXPORT PLAN  ####'
+              f'\nBooks: {self.book_titles}'
+              f'\n- {sum(counts)} lookups of {len(query_words)} unique words, '
+              f'{len(query_words) - queries - skipped} of them already cached.'
+              f'\n- {queries} API queries needed, {"no limit" if remaining_today is None else remaining_today} '
+              f'left today.'
+              f'\n- The export will take {self.days_needed(queries)} day(s).')
+        if skipped:
+            print(f'- {skipped} words will be skipped, they failed in earlier exports and make no cards. Use '
+                  f'retry-failed to look them up again.')
+        if follow_suggestions and queries:
+            print('- Words missing from the dictionary can cost a second query each, for the word it suggests '
+                  'instead, which may postpone some lookups to another day. Use --no-suggestions to spend one query '
+                  'per word.')
+
+    def select_lookups(self) -> Tuple[List[int], Iterator[Lookup]]:
+        """
+        Return the number of lookups to export from each book, and an iterator over the lookups of all books in the
+        order they should be exported.
+        """
         try:
-            if self.too_many_api_queries(self.book_titles):
-                self.book_titles = self.remove_books_until_safe()
+            for book_title in self.book_titles:
+                self.vocab.book(book_title)  # make sure the book exists
         except MissingBookError:
             print('Make sure all given book titles match the output given by --list (case insensitive)')
             print('Exiting...')
             sys.exit(1)
 
-        cards, failed_words, missing_words = self.create_flashcards()
+        since = self.exported_until()
+        counts = self.vocab.count_lookups_since(self.book_titles, since)
+        if self.since_last:
+            for book_title, count in zip(self.book_titles, counts):
+                if not count:
+                    self.inform(f'No new lookups in book: {book_title}')
+            self.book_titles = [book_title for book_title, count in zip(self.book_titles, counts) if count]
+            counts = [count for count in counts if count]
+        if self.lookup_filter:
+            return self.filter_lookups(since)
+        return counts, self.vocab.lookups(self.book_titles, since)
 
-        self.write_to_export_file(cards, Kanki.successful_words_path)
-        self.write_to_export_file(failed_words + missing_words, Kanki.failed_words_path)
+    def filter_lookups(self, since: Optional[Dict[str, int]] = None) -> Tuple[List[int], Iterator[Lookup]]:
+        """
+        Keep the lookups of the books that match the lookup filter, and the books that have any, returning the number
+        of lookups left in each book and an iterator over the lookups.
 
-        print(f'\n####  EXPORT INFO  ####'
-              f'\nBooks exported: {self.book_titles}'
-              f'\n- {len(cards)} cards successfully exported to \'{Kanki.successful_words_path}.\''
-              f'\n- {len(failed_words)} words not in expected format, written to \'{Kanki.failed_words_path}\'.'
-              f'\n- {len(missing_words)} words not in the online dictionary, also written to '
-              f'\'{Kanki.failed_words_path}\'.')
+        The lookups are streamed like those of an unfiltered export, only the ids of the matching lookups of the book
+        being exported are kept in memory.
 
-    def remove_books_until_safe(self) -> List[str]:
-        """Remove books until we are below the API query limit."""
-        remaining_books = self.book_titles.copy()  # to ensure the function has no side effects
+        :param since: only include lookups made after the given timestamp, by book title
+        """
+        if self.search_index is None:
+            self.search_index = SearchIndex()
+        since = {book_title.lower(): timestamp for book_title, timestamp in (since or {}).items()}
+        with timer(self.metrics, 'search'):
+            self.search_index.sync(self.vocab)
+            counts = [self.search_index.count(self.lookup_filter._replace(titles=(book_title,)),
+                                              since.get(book_title.lower(), 0)) for book_title in self.book_titles]
+        for book_title, count in zip(self.book_titles, counts):
+            if not count:
+                self.inform(f'No lookups matching the filters in book: {book_title}')
+        self.book_titles = [book_title for book_title, count in zip(self.book_titles, counts) if count]
+        counts = [count for count in counts if count]
 
-        while self.too_many_api_queries(remaining_books):
-            remaining_books.pop()
+        def matching_lookups() -> Iterator[Lookup]:
+            book_title, matches = None, set()
+            for lookup in self.vocab.lookups(self.book_titles, since):
+                if lookup.title != book_title:
+                    book_title = lookup.title
+                    matches = self.search_index.ids(self.lookup_filter._replace(titles=(book_title,)),
+                                                    since.get(book_title.lower(), 0))
+                if lookup.id in matches:
+                    yield lookup
 
-            if not remaining_books:
-                logging.error(f'ERROR: kanki cannot handle the case where one book has more than '
-                              f'{self.dictionary.max_queries} lookups')
-                print('The chosen book(s) have too many lookups for the free version of Merriam Webster\'s API. '
-                      'Please choose another set of books.')
-                print('Exiting...')
-                sys.exit(1)
+        return counts, matching_lookups()
+
+    def print_search_results(self, lookup_filter: LookupFilter, limit: Optional[int]) -> None:
+        """Print the lookups matching the filter, the most recent first."""
+        from tabulate import tabulate
+        self.search_index.sync(self.vocab)
+        results = self.search_index.search(lookup_filter, limit)
+        rows = [[datetime.fromtimestamp(lookup.timestamp // 1000, timezone.utc).strftime('%Y-%m-%d'),
+                 Kanki.shorten(lookup.title, 30), lookup.word, Kanki.shorten(lookup.usage, 80)]
+                for lookup in results]
+        print(tabulate(rows, headers=['Date', 'Book', 'Word', 'Sentence']))
+        if limit is not None and len(results) == limit:
+            print(f'Showing the {limit} most recent lookups, use --limit to see more.')
+
+    @staticmethod
+    def shorten(text: str, length: int) -> str:
+        return text if len(text) <= length else text[:length] + '...'
+
+    def exported_until(self) -> Optional[Dict[str, int]]:
+        """Return the timestamp of the last exported lookup of every book, if only new lookups should be exported."""
+        if not self.since_last or self.state is None:
+            return None
+        return {book_title: self.state.last_timestamp(book_title) for book_title in self.book_titles}
+
+    def schedule(self, lookups: Iterable[Lookup], budget: Optional[int]) -> Iterator[Lookup]:
+        """
+        Yield the lookups, in order, for as long as they can be exported with at most `budget` API queries (no limit if
+        None).
+
+        When the budget runs out, the first lookup that didn't fit is kept in `postponed_from`. A large book can then
+        be exported over several days by continuing from there.
+
+        The query of every word is reserved in the quota ledger, so that optional queries, e.g. for the words the
+        dictionary suggests, can't spend it. Queries they spend anyway leave fewer for the rest of the export.
+        """
+        self.postponed_from = None
+        if budget is None:
+            yield from lookups
+            return
+
+        ledger = self.dictionary.ledger
+        words = set()
+        for lookup in lookups:
+            word = Kanki.query_word(lookup)
+            if word not in words and self.dictionary.costs_query(word):
+                if len(words) == budget or (ledger is not None and not ledger.reserve()):
+                    self.postponed_from = lookup
+                    return
+                words.add(word)
+            yield lookup
 
-        return remaining_books
+    def release_queries(self) -> None:
+        """Give back the API queries reserved for words that weren't looked up, e.g. when an export stops."""
+        if self.dictionary.ledger is not None:
+            self.dictionary.ledger.release()
 
-    def too_many_api_queries(self, books: List[str]) -> bool:
-        """Return true if the given book titles have more lookups than the dictionary supports."""
-        total_lookups = sum(self.count_lookups(b) for b in books)
-        return total_lookups > self.dictionary.max_queries
+    def begin_export(self) -> None:
+        """
+        Mark the books as pending until their export completes, along with the books of earlier exports still pending.
+        A full export starts over from the first lookup.
+        """
+        if not self.since_last:
+            for book_title in self.book_titles:
+                self.state.update(book_title, 0)
+        self.state.pending = Kanki.merge_titles(self.state.pending, self.book_titles)
+        self.state.save()
+
+    def checkpoint(self, outputs: List[Union[ExportWriter, AnkiWriter]], exported: Dict[str, int],
+                   in_progress: Optional[str]) -> None:
+        """
+        Make sure all cards written so far are on disk, then save how far every book has been exported, see
+        save_progress. The progress of an export to an Anki package is only saved once the package has been written,
+        as the flushed cards are lost if the export is killed before that.
+
+        :param in_progress: title of the first book with lookups left to export, None if the export is complete
+        """
+        for output in outputs:
+            output.flush()
+        if not any(isinstance(output, AnkiWriter) and output.is_package for output in outputs):
+            self.save_progress(exported, in_progress)
+
+    def save_progress(self, exported: Dict[str, int], in_progress: Optional[str]) -> None:
+        """
+        Save how far every book has been exported, unless only the lookups matching the lookup filter are exported.
+
+        :param exported: title of every book exported from -> timestamp of its last lookup exported
+        :param in_progress: title of the first book with lookups left to export, None if the export is complete
+        """
+        if self.state is None or self.lookup_filter:
+            return
+
+        for book_title, timestamp in exported.items():
+            self.state.update(book_title, timestamp)
+        left = []
+        if in_progress:
+            titles = [book_title.lower() for book_title in self.book_titles]
+            left = self.book_titles[titles.index(in_progress.lower()):]
+        # Only this export's finished books are done, books other exports left pending stay so
+        finished = {book_title.lower() for book_title in self.book_titles} - {book_title.lower() for book_title in left}
+        self.state.pending = Kanki.merge_titles([book_title for book_title in self.state.pending
+                                                 if book_title.lower() not in finished], left)
+        self.state.save()
+
+    @staticmethod
+    def merge_titles(titles: List[str], more_titles: List[str]) -> List[str]:
+        """Return the book titles followed by the other titles that aren't among them, ignoring case."""
+        seen = {book_title.lower() for book_title in titles}
+        return titles + [book_title for book_title in more_titles if book_title.lower() not in seen]
+
+    def remaining_queries(self) -> Optional[int]:
+        """Return the number of API queries that can still be made today, None if there is no limit."""
+        if self.dictionary.ledger is None or self.dictionary.max_queries is None:
+            return self.dictionary.max_queries
+        return self.dictionary.ledger.remaining()
+
+    def days_needed(self, queries: int) -> int:
+        """Return the number of days needed to make the given number of API queries, starting today."""
+        if self.dictionary.max_queries is None:
+            return 1
+        if self.dictionary.ledger is None:
+            return math.ceil(queries / self.dictionary.max_queries) or 1
+        return self.dictionary.ledger.days_needed(queries)
+
+    def count_api_queries(self, words: Iterable[str]) -> int:
+        """Return the number of API queries needed to look up the given words, i.e. the unique ones not cached."""
+        return sum(1 for word in set(words) if self.dictionary.costs_query(word))
+
+    def export_paths(self) -> Tuple[str, str]:
+        """Return the paths to export successful and failed words to. Incremental exports go to dated files."""
+        successful_words_path, failed_words_path = Kanki.successful_words_path, Kanki.failed_words_path
+        if self.since_last:
+            date = datetime.today().strftime('%Y-%m-%d')
+            successful_words_path, failed_words_path = (f'{os.path.splitext(path)[0]}_{date}.txt'
+                                                        for path in (successful_words_path, failed_words_path))
+        return self.anki_path or successful_words_path, failed_words_path
+
+    def open_successful_output(self, path: str, header: str) -> Union[ExportWriter, AnkiWriter]:
+        """Open the output for cards of words found in the dictionary, an Anki package or collection if given."""
+        if self.anki_path:
+            return AnkiWriter(self.anki_path, self.deck)
+        return ExportWriter(path, header, self.since_last, self.format)
+
+    @staticmethod
+    def query_word(lookup: Lookup) -> str:
+        """
+        Return the word to look up in the dictionary for a Kindle lookup.
+
+        The Kindle stores the stem of every word looked up, so e.g. "ran" and "running" are both looked up as "run".
+        """
+        return (lookup.stem or lookup.word).strip().lower()
 
     def count_lookups(self, book_title: str) -> int:
         """Return the number of Kindle lookups in the given book titles."""
-        sql_query = '''SELECT COUNT (*) FROM LOOKUPS LEFT JOIN BOOK_INFO ON BOOK_INFO.id = LOOKUPS.book_key
-                       WHERE BOOK_INFO.title = ? COLLATE NOCASE'''
-        self.db_cursor.execute(sql_query, (book_title, ))
-        count = self.db_cursor.fetchone()[0]
+        return self.vocab.count_lookups(book_title)
 
-        # Assumes all existing books have at least one lookup
-        if not count:
-            raise MissingBookError(f'The book titled {book_title} does have any lookups')
-        return count
-
-    def create_flashcards(self) -> Tuple[List[Card], List[Card], List[Card]]:
+    def create_flashcards(self, lookups: Optional[List[Lookup]] = None) -> Tuple[List[Card], List[Card], List[Card]]:
+        """Look up the words of the given lookups (by default all lookups in the books) and turn them into cards."""
         cards = []  # words successfully found in dictionary
         failed_words = []  # words where the response from the dictionary was not what we expected
         missing_words = []  # words not in the dictionary
 
-        for book_title in self.book_titles:
-            lookups = self.get_lookups(book_title)
+        if lookups is None:
+            counts, lookups = self.select_lookups()
+            total = sum(counts)
+        else:
+            total = len(lookups)
+
+        for lookup, card, error in self.resolve_cards(lookups, total):
+            if isinstance(error, KeyError):
+                failed_words.append(card)
+            elif isinstance(error, TypeError):
+                missing_words.append(card)
+            else:
+                cards.append(card)
+        return cards, failed_words, missing_words
+
+    def resolve_cards(self, lookups: Iterable[Lookup],
+                      total: int) -> Iterator[Tuple[Lookup, Card, Optional[Exception]]]:
+        """
+        Look up the words of the given lookups and yield a card for each lookup, in order, together with the error
+        (KeyError or TypeError) if the word couldn't be found in the dictionary. Stops with ServiceUnavailableError if
+        the dictionary API is unavailable, since the remaining words can't be found either.
+        """
+        for lookup, entry, error in self.resolve_lookups(lookups, total):
+            card = Card(lookup.word, lookup.usage, lookup.title, lookup.authors)
+            if entry is not None:
+                card.word, definitions, card.pronunciation = entry
+                card.definitions = definitions
+            yield lookup, card, error
 
-            print(f'--- Exporting {len(lookups)} lookups from book: {book_title}')
-            for i, lookup in enumerate(lookups):
-                word = lookup[0]
-                sentence = lookup[1]
-                author = lookup[3]
+    def resolve_lookups(self, lookups: Iterable[Lookup],
+                        total: int) -> Iterator[Tuple[Lookup, Optional[Entry], Optional[Exception]]]:
+        """
+        Look up the words of the given lookups and yield the dictionary entry of each lookup, in order, or the error
+        (KeyError or TypeError) if the word couldn't be found in the dictionary. Stops with ServiceUnavailableError if
+        the dictionary API is unavailable, since the remaining words can't be found either.
 
-                card = Card(word, sentence, book_title, author)
+        Words are looked up concurrently, and the same word is only looked up once even if it appears in several
+        lookups, possibly in different books and inflections.
+        """
+        executor = ThreadPoolExecutor(max_workers=self.jobs)
+        progress = Progress(total, quiet=self.quiet, events=self.events)
+        try:
+            for lookup, result in self.submit_lookups(executor, lookups):
+                entry, error = None, None
                 try:
-                    digits = len(str(len(lookups)))
-                    progress = f'[{str(i + 1).zfill(digits)}/{len(lookups)}]'
-                    print(f'{progress} Looking up word {word}... ', end='')
-                    word_stem, definitions, ipa = self.dictionary.lookup(word)
-                    card.word = word_stem
-                    card.definitions = definitions
-                    card.pronunciation = ipa
-                    cards.append(card)
-                except KeyError:
-                    failed_words.append(card)
-                except TypeError:
-                    missing_words.append(card)
-        return cards, failed_words, missing_words
+                    with timer(self.metrics, 'wait'):
+                        entry = result.result()
+                    progress.record(Kanki.query_word(lookup), Progress.RESOLVED, lookup, entry)
+                except KeyError as err:
+                    error = err
+                    progress.record(Kanki.query_word(lookup), Progress.FAILED, lookup, error=err)
+                except TypeError as err:
+                    error = err
+                    progress.record(Kanki.query_word(lookup), Progress.MISSING, lookup, error=err)
+                yield lookup, entry, error
+        finally:
+            # Don't spend API queries on words that won't be exported
+            executor.shutdown(cancel_futures=True)
+            self.release_queries()
+            progress.close()
+
+    def submit_lookups(self, executor: ThreadPoolExecutor,
+                       lookups: Iterable[Lookup]) -> Iterator[Tuple[Lookup, Future]]:
+        """
+        Submit the words of the lookups to the executor, yielding each lookup with the future of its word's lookup.
+
+        At most a few lookups per worker are in flight at a time, so the lookups can be streamed.
+        """
+        results: Dict[str, Future] = {}  # word -> its dictionary lookup
+        in_flight = deque()
+        for lookup in lookups:
+            word = Kanki.query_word(lookup)
+            if word not in results:
+                if self.profiler is not None:
+                    results[word] = executor.submit(self.profiler.run, self.dictionary.lookup, word)
+                else:
+                    results[word] = executor.submit(self.dictionary.lookup, word)
+            in_flight.append((lookup, results[word]))
+            if len(in_flight) >= 4 * self.jobs:
+                yield in_flight.popleft()
+        while in_flight:
+            yield in_flight.popleft()
 
     def print_book_info(self) -> None:
         book_info = [[str(k)] + list(v) for k, v in self.get_book_info().items()]
@@ -217,78 +1256,42 @@ class Kanki:
             if len(book[1]) > 60:
                 book_info[i][1] = book_info[i][1][:60] + '...'
 
+        from tabulate import tabulate
         headers = ['ID', 'Title', 'Lookups', 'Last lookup time']
         print(tabulate(book_info, headers=headers))
 
     def get_book_info(self) -> Dict[int, List[str]]:
         """Get info about all books in the Kindle database. The book with the most recent lookup is at the top."""
-        sql_query = '''SELECT
-                           ROW_NUMBER() OVER (ORDER BY MAX(timestamp) desc),
-                           title,
-                           COUNT(timestamp),
-                           STRFTIME('%Y-%m-%d', DATETIME(MAX(timestamp) / 1000, 'unixepoch'))
-                       FROM
-                           LOOKUPS
-                           INNER JOIN BOOK_INFO ON book_key = BOOK_INFO.id
-                       GROUP BY
-                           title
-                       ORDER BY
-                           MAX(timestamp) desc'''
-        self.db_cursor.execute(sql_query)
-        return {book[0]: book[1:] for book in self.db_cursor.fetchall()}
-
-    def get_lookups(self, book_title: str) -> List[tuple]:
-        """Return all Kindle lookups for the given book title."""
-        sql_query = '''
-            SELECT WORDS.word, LOOKUPS.usage, BOOK_INFO.title as title, BOOK_INFO.authors, LOOKUPS.timestamp
-              FROM LOOKUPS LEFT JOIN WORDS ON WORDS.id = LOOKUPS.word_key
-                           LEFT JOIN BOOK_INFO ON BOOK_INFO.id = LOOKUPS.book_key
-            WHERE title = ? COLLATE NOCASE
-            ORDER BY LOOKUPS.timestamp
-        '''
-        self.db_cursor.execute(sql_query, (book_title, ))
-        rows = self.db_cursor.fetchall()
-        return rows
+        book_info = {}
+        for i, book in enumerate(self.vocab.catalog()):
+            last_lookup = datetime.fromtimestamp(book.last_lookup // 1000, timezone.utc).strftime('%Y-%m-%d')
+            book_info[i + 1] = [book.title, book.lookups, last_lookup]
+        return book_info
+
+    def get_lookups(self, book_title: str) -> List[Lookup]:
+        """Return all Kindle lookups for the given book title, or only the new ones when exporting since last time."""
+        since = None
+        if self.since_last and self.state is not None:
+            since = {book_title: self.state.last_timestamp(book_title)}
+        return list(self.vocab.lookups([book_title], since))
 
     def get_author(self, book_title: str) -> str:
         """Return the author of a book in the Kindle database given the book's title."""
-        sql_query = 'SELECT authors FROM BOOK_INFO WHERE title = ?'
-        self.db_cursor.execute(sql_query, (book_title,))
-        book_author = self.db_cursor.fetchone()[0]
-        return book_author
+        return self.vocab.book(book_title).authors
 
     @staticmethod
     def flatten(items: List[Iterable]) -> List:
         return [item for sublist in items for item in sublist]
 
-    def write_to_export_file(self, cards: List[Card], path: Union[str, bytes, os.PathLike]) -> None:
-        """Write all cards to file in an Anki readable format."""
-        with open(path, 'w', encoding='utf-8') as output:
-            output.write(self.metadata_about_export())
-
-            for card in cards:
-                output.write(card.get_csv_encoding() + '\n')
-
-        if not cards:
-            return
-        Kanki.check_number_of_card_fields(cards[0])
-
-    @staticmethod
-    def check_number_of_card_fields(card: Card):
-        number_of_fields = len(vars(card))
-        expected_number_of_fields = len(card.card_fields_in_order())
-        if number_of_fields > expected_number_of_fields:
-            logging.warning(f'The number of fields in a card have increased, '
-                            f'consider adding them to the Anki card type.')
-
     def metadata_about_export(self) -> str:
         datetime_now = datetime.today().strftime('%Y-%m-%d %H:%M')
+        separator = '\t' if self.format == 'tsv' else ','
         itemized_books = ''.join([f'#  - {title}\n' for title in self.book_titles])
         metadata = (f'# Card data generated on {datetime_now} by kanki from book(s):\n'
                     f'{itemized_books}'
                     '#\n'
                     '# Format:\n'
-                    '# word,pronunciation,sentence,definition,author\n\n')
+                    f'# {separator.join(["word", "pronunciation", "sentence", "definition", "author"])}\n\n')
         return metadata
 
     def get_book_titles(self, ids: List[int]) -> List[str]:
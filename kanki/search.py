@@ -0,0 +1,139 @@
+import os
+import sqlite3
+from datetime import date, datetime, timedelta, timezone
+from typing import Iterator, List, NamedTuple, Optional, Set, Tuple, Union
+
+from kanki.vocab import Lookup, VocabDB
+
+
+class LookupFilter(NamedTuple):
+    """Which lookups to search for or export, lookups have to match everything given."""
+    match: Optional[str] = None  # full-text query over the words, sentences and book titles, in FTS5 syntax
+    words: Optional[str] = None  # glob pattern the word or its stem must match, e.g. 'run*'
+    first_day: Optional[date] = None  # of lookups, inclusive
+    last_day: Optional[date] = None  # of lookups, inclusive
+    titles: Tuple[str, ...] = ()  # of the books, case insensitive, any book if empty
+
+    def __bool__(self) -> bool:
+        return any(self)
+
+
+class SearchIndex:
+    """
+    A full-text index over the lookups of the Kindle vocabulary file, kept in a file of its own so that the Kindle's
+    file is never modified.
+
+    The lookups are copied to an SQLite table with an FTS5 index over their words, sentences and book titles. Syncing
+    with the vocabulary file only copies the lookups made since the last sync, unless lookups were added out of order
+    or removed, e.g. when merging another Kindle, in which case the differences are found by lookup id.
+    """
+    default_path = 'kanki_search.db'
+    schema = '''
+        CREATE TABLE IF NOT EXISTS lookups (
+            rowid INTEGER PRIMARY KEY,
+            id TEXT UNIQUE NOT NULL,
+            word TEXT,
+            stem TEXT,
+            usage TEXT,
+            title TEXT,
+            authors TEXT,
+            timestamp INTEGER NOT NULL);
+        CREATE INDEX IF NOT EXISTS lookups_timestamp ON lookups (timestamp);
+        CREATE VIRTUAL TABLE IF NOT EXISTS lookups_fts USING fts5(
+            word, stem, usage, title,
+            content='lookups', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2');
+        CREATE TRIGGER IF NOT EXISTS lookups_insert AFTER INSERT ON lookups BEGIN
+            INSERT INTO lookups_fts (rowid, word, stem, usage, title)
+            VALUES (new.rowid, new.word, new.stem, new.usage, new.title);
+        END;
+        CREATE TRIGGER IF NOT EXISTS lookups_delete AFTER DELETE ON lookups BEGIN
+            INSERT INTO lookups_fts (lookups_fts, rowid, word, stem, usage, title)
+            VALUES ('delete', old.rowid, old.word, old.stem, old.usage, old.title);
+        END;
+    '''
+
+    def __init__(self, path: Union[str, bytes, os.PathLike] = default_path):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(SearchIndex.schema)
+
+    def sync(self, vocab: VocabDB) -> int:
+        """Bring the index up to date with the vocabulary file, returning the number of lookups added or removed."""
+        with self.connection:
+            last_timestamp = self.connection.execute('SELECT MAX(timestamp) FROM lookups').fetchone()[0] or 0
+            changes = self.insert(vocab.all_lookups(since=last_timestamp))
+            totals = self.connection.execute('SELECT COUNT(*), IFNULL(SUM(timestamp), 0) FROM lookups').fetchone()
+            if totals != vocab.lookup_totals():
+                changes += self.resync(vocab)
+        return changes
+
+    def resync(self, vocab: VocabDB) -> int:
+        """Add the lookups missing from the index, and remove those no longer in the vocabulary file."""
+        lookups = {lookup.id: lookup for lookup in vocab.all_lookups()}
+        indexed = {row[0] for row in self.connection.execute('SELECT id FROM lookups')}
+        removed = indexed - lookups.keys()
+        self.connection.executemany('DELETE FROM lookups WHERE id = ?', ((lookup_id, ) for lookup_id in removed))
+        return len(removed) + self.insert(lookups[lookup_id] for lookup_id in lookups.keys() - indexed)
+
+    def insert(self, lookups: Iterator[Lookup]) -> int:
+        cursor = self.connection.executemany(
+            'INSERT OR IGNORE INTO lookups (id, word, stem, usage, title, authors, timestamp) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            ((lookup.id, lookup.word, lookup.stem, lookup.usage, lookup.title, lookup.authors, lookup.timestamp)
+             for lookup in lookups))
+        return max(cursor.rowcount, 0)
+
+    def search(self, lookup_filter: LookupFilter, limit: Optional[int] = None) -> List[Lookup]:
+        """Return the lookups matching the filter, the most recent first."""
+        where, parameters = SearchIndex.where(lookup_filter)
+        sql_query = f'''
+            SELECT word, usage, title, authors, timestamp, stem, id FROM lookups
+            {where}
+            ORDER BY timestamp DESC
+            {'LIMIT ?' if limit is not None else ''}
+        '''
+        if limit is not None:
+            parameters.append(limit)
+        return [Lookup._make(row) for row in self.connection.execute(sql_query, parameters)]
+
+    def count(self, lookup_filter: LookupFilter, since: int = 0) -> int:
+        """Return the number of lookups matching the filter made after the given timestamp."""
+        where, parameters = SearchIndex.where(lookup_filter, since)
+        return self.connection.execute(f'SELECT COUNT(*) FROM lookups {where}', parameters).fetchone()[0]
+
+    def ids(self, lookup_filter: LookupFilter, since: int = 0) -> Set[str]:
+        """Return the ids of the lookups matching the filter made after the given timestamp."""
+        where, parameters = SearchIndex.where(lookup_filter, since)
+        return {lookup_id for lookup_id, in self.connection.execute(f'SELECT id FROM lookups {where}', parameters)}
+
+    @staticmethod
+    def where(lookup_filter: LookupFilter, since: int = 0) -> Tuple[str, list]:
+        """Return the WHERE clause and its parameters selecting the lookups matching the filter made after since."""
+        conditions, parameters = [], []
+        if lookup_filter.match:
+            conditions.append('lookups.rowid IN (SELECT rowid FROM lookups_fts WHERE lookups_fts MATCH ?)')
+            parameters.append(lookup_filter.match)
+        if lookup_filter.words:
+            conditions.append('(lower(word) GLOB ? OR lower(stem) GLOB ?)')
+            parameters.extend([lookup_filter.words.lower()] * 2)
+        if lookup_filter.first_day:
+            conditions.append('timestamp >= ?')
+            parameters.append(day_to_timestamp(lookup_filter.first_day))
+        if lookup_filter.last_day:
+            conditions.append('timestamp < ?')
+            parameters.append(day_to_timestamp(lookup_filter.last_day + timedelta(days=1)))
+        if since:
+            conditions.append('timestamp > ?')
+            parameters.append(since)
+        if lookup_filter.titles:
+            conditions.append(f'lower(title) IN ({", ".join("?" * len(lookup_filter.titles))})')
+            parameters.extend(title.lower() for title in lookup_filter.titles)
+        return 'WHERE ' + ' AND '.join(conditions) if conditions else '', parameters
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def day_to_timestamp(day: date) -> int:
+    """Return the timestamp of the start of a day in UTC, in milliseconds like the Kindle's."""
+    return int(datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp() * 1000)
@@ -0,0 +1,38 @@
+import json
+import os
+from typing import Dict, List, Union
+
+
+class ExportState:
+    """
+    Remembers how far each book has been exported, so later exports can skip lookups that were already exported.
+
+    For every book, the timestamp of its most recent exported lookup is kept in a small JSON file, along with the
+    books of an export that didn't fit in the daily API limit and should be resumed later.
+    """
+    default_path = 'kanki_state.json'
+
+    def __init__(self, path: Union[str, bytes, os.PathLike] = default_path):
+        self.path = path
+        self.last_exported: Dict[str, int] = {}  # lowercase book title -> timestamp of last exported lookup
+        self.pending: List[str] = []  # titles of books with lookups left to export
+
+        if os.path.isfile(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            self.last_exported = state.get('last_exported', {})
+            self.pending = state.get('pending', [])
+
+    def last_timestamp(self, book_title: str) -> int:
+        """Return the timestamp of the last exported lookup in a book, or 0 if it was never exported."""
+        return self.last_exported.get(book_title.lower(), 0)
+
+    def update(self, book_title: str, timestamp: int) -> None:
+        self.last_exported[book_title.lower()] = timestamp
+
+    def save(self) -> None:
+        # Write to a temporary file first so that a crash never leaves a half written state behind
+        temporary_path = f'{os.fsdecode(self.path)}.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as f:
+            json.dump({'last_exported': self.last_exported, 'pending': self.pending}, f, indent=2, ensure_ascii=False)
+        os.replace(temporary_path, self.path)
@@ -0,0 +1,292 @@
+import logging
+import os
+import pathlib
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+from kanki.exceptions import MissingBookError, MissingVocabError
+
+
+class Lookup(NamedTuple):
+    """A word looked up on the Kindle, in the sentence it was found in."""
+    word: str
+    usage: str  # the sentence
+    title: str
+    authors: str
+    timestamp: int  # milliseconds since the epoch
+    stem: Optional[str]
+    id: str
+
+
+class Book(NamedTuple):
+    title: str
+    authors: str
+    lookups: int  # number of lookups
+    last_lookup: int  # timestamp of the most recent lookup
+    keys: Tuple[str, ...]  # BOOK_INFO ids, the same book may have been added to the Kindle more than once
+
+
+class VocabDB:
+    """
+    Read-only access to the Kindle vocabulary database, vocab.db.
+
+    The catalog of books is read once and kept in memory, and the lookups of any number of books are fetched with a
+    single query that is streamed from the cursor.
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+        self.sources = 1  # number of vocabulary files read
+        self.duplicates = 0  # lookups found in more than one vocabulary file, and only read once
+        self._catalog: Optional[List[Book]] = None
+        self._books_by_title: Dict[str, Book] = {}
+
+    @staticmethod
+    def open(path: Union[str, os.PathLike], immutable: bool = True) -> 'VocabDB':
+        """
+        Open the vocabulary file read-only, so the Kindle's database is never modified.
+
+        :param immutable: promise SQLite the file doesn't change while it's open, which skips all locking. Only
+                          safe for a copy of the file, not for one the Kindle may still be writing to.
+        """
+        uri = pathlib.Path(path).absolute().as_uri() + '?mode=ro'
+        if immutable:
+            uri += '&immutable=1'
+        return VocabDB(sqlite3.connect(uri, uri=True, check_same_thread=False))
+
+    @staticmethod
+    def open_many(paths: Sequence[Union[str, os.PathLike]], immutable: bool = True,
+                  workers: Optional[int] = None) -> 'VocabDB':
+        """
+        Open the vocabulary files of several Kindles as one, e.g. every vocab.db in a directory.
+
+        The files are read in parallel by a process pool and merged into an in-memory database. Books are merged by
+        their GUID, or ASIN if they have none, and a lookup found in several files, i.e. the same word in the same
+        sentence of the same book, is only kept once: the first time it was looked up.
+
+        :param paths: vocabulary files, or directories to search for .db files
+        :param immutable: see open()
+        :param workers: number of processes reading files, by default one per file up to the number of CPUs
+        :raises MissingVocabError: if none of the paths is, or has, a vocabulary file
+        """
+        files = find_vocab_files(paths, immutable)
+        if not files:
+            raise MissingVocabError(f'No Kindle vocabulary file found in {", ".join(map(os.fsdecode, paths))}')
+        if len(files) == 1:
+            return VocabDB.open(files[0], immutable)
+
+        workers = workers or min(len(files), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            contents = list(executor.map(read_vocab_file, files, [immutable] * len(files)))
+
+        connection = sqlite3.connect(':memory:', check_same_thread=False)
+        connection.executescript(MERGED_SCHEMA)
+        books, words, lookups = {}, {}, []  # merged book key -> book row, word key -> word row
+        for file_books, file_words, file_lookups in contents:
+            merged_keys = {}  # BOOK_INFO id in this file -> merged book key
+            for key, asin, guid, lang, title, authors in file_books:
+                merged_key = f'guid:{guid}' if guid else f'asin:{asin}' if asin else f'{title.lower()}:{authors}'
+                merged_keys[key] = merged_key
+                books.setdefault(merged_key, (merged_key, asin, guid, lang, title, authors))
+            for word in file_words:
+                words.setdefault(word[0], word)
+            lookups.extend((lookup_id, word_key, merged_keys.get(book_key, book_key), usage, timestamp)
+                           for lookup_id, word_key, book_key, usage, timestamp in file_lookups)
+
+        # Keep the first of duplicate lookups, before any word is looked up in a dictionary
+        lookups.sort(key=lambda lookup: lookup[4])
+        seen_ids, seen = set(), set()
+        unique = []
+        for lookup in lookups:
+            lookup_id, word_key, book_key, usage, _ = lookup
+            if lookup_id in seen_ids or (book_key, word_key, usage) in seen:
+                continue
+            seen_ids.add(lookup_id)
+            seen.add((book_key, word_key, usage))
+            unique.append(lookup)
+
+        connection.executemany('INSERT INTO BOOK_INFO VALUES (?, ?, ?, ?, ?, ?)', books.values())
+        connection.executemany('INSERT INTO WORDS VALUES (?, ?, ?, ?)', words.values())
+        connection.executemany('INSERT INTO LOOKUPS VALUES (?, ?, ?, ?, ?)', unique)
+        connection.commit()
+        vocab = VocabDB(connection)
+        vocab.sources = len(files)
+        vocab.duplicates = len(lookups) - len(unique)
+        return vocab
+
+    def catalog(self) -> List[Book]:
+        """Return all books with lookups, the book with the most recent lookup first."""
+        if self._catalog is None:
+            # Drive the join from LOOKUPS, so it is scanned once while books are found through their unique ids
+            sql_query = '''SELECT BOOK_INFO.id, BOOK_INFO.title, BOOK_INFO.authors, COUNT(*), MAX(LOOKUPS.timestamp)
+                             FROM LOOKUPS INNER JOIN BOOK_INFO ON BOOK_INFO.id = LOOKUPS.book_key
+                           GROUP BY BOOK_INFO.id'''
+            books: Dict[str, Book] = {}
+            for key, title, authors, lookups, last_lookup in self.connection.execute(sql_query):
+                book = books.get(title.lower())
+                if book:
+                    book = Book(book.title, book.authors, book.lookups + lookups, max(book.last_lookup, last_lookup),
+                                book.keys + (key, ))
+                else:
+                    book = Book(title, authors, lookups, last_lookup, (key, ))
+                books[title.lower()] = book
+
+            self._books_by_title = books
+            self._catalog = sorted(books.values(), key=lambda b: b.last_lookup, reverse=True)
+        return self._catalog
+
+    def book(self, title: str) -> Book:
+        """Return the book with the given title (case insensitive)."""
+        self.catalog()
+        try:
+            return self._books_by_title[title.lower()]
+        except KeyError:
+            raise MissingBookError(f'The book titled {title} does have any lookups') from None
+
+    def count_lookups(self, title: str) -> int:
+        return self.book(title).lookups
+
+    def lookups(self, titles: Iterable[str], since: Optional[Dict[str, int]] = None) -> Iterator[Lookup]:
+        """
+        Yield the lookups of the given book titles, book by book and in the order they were looked up.
+
+        :param since: only include lookups made after the given timestamp, by book title
+        """
+        selected, parameters = self.select_books(titles, since)
+        if not parameters:
+            return
+
+        sql_query = f'''
+            WITH selected(book_key, position, since) AS (VALUES {selected})
+            SELECT WORDS.word, LOOKUPS.usage, BOOK_INFO.title, BOOK_INFO.authors, LOOKUPS.timestamp, WORDS.stem,
+                   LOOKUPS.id
+              FROM LOOKUPS INNER JOIN selected ON selected.book_key = LOOKUPS.book_key
+                           LEFT JOIN WORDS ON WORDS.id = LOOKUPS.word_key
+                           LEFT JOIN BOOK_INFO ON BOOK_INFO.id = LOOKUPS.book_key
+            WHERE LOOKUPS.timestamp > selected.since
+            ORDER BY selected.position, LOOKUPS.timestamp
+        '''
+        cursor = self.connection.execute(sql_query, parameters)
+        for row in cursor:
+            yield Lookup._make(row)
+
+    def all_lookups(self, since: int = 0) -> Iterator[Lookup]:
+        """Yield the lookups of all books made after the given timestamp, in the order they were looked up."""
+        sql_query = '''
+            SELECT WORDS.word, LOOKUPS.usage, BOOK_INFO.title, BOOK_INFO.authors, LOOKUPS.timestamp, WORDS.stem,
+                   LOOKUPS.id
+              FROM LOOKUPS INNER JOIN BOOK_INFO ON BOOK_INFO.id = LOOKUPS.book_key
+                           LEFT JOIN WORDS ON WORDS.id = LOOKUPS.word_key
+            WHERE LOOKUPS.timestamp > ?
+            ORDER BY LOOKUPS.timestamp
+        '''
+        for row in self.connection.execute(sql_query, (since, )):
+            yield Lookup._make(row)
+
+    def lookup_totals(self) -> Tuple[int, int]:
+        """
+        Return the number of lookups that all_lookups() would yield and the sum of their timestamps, which are cheap to
+        compare with a copy of the lookups to tell if any were added or removed.
+        """
+        sql_query = '''SELECT COUNT(*), IFNULL(SUM(LOOKUPS.timestamp), 0)
+                         FROM LOOKUPS INNER JOIN BOOK_INFO ON BOOK_INFO.id = LOOKUPS.book_key'''
+        return tuple(self.connection.execute(sql_query).fetchone())
+
+    def count_lookups_since(self, titles: List[str], since: Optional[Dict[str, int]] = None) -> List[int]:
+        """Return the number of lookups that lookups() would yield for each of the given book titles."""
+        selected, parameters = self.select_books(titles, since)
+        counts = [0] * len(titles)
+        if not parameters:
+            return counts
+
+        sql_query = f'''
+            WITH selected(book_key, position, since) AS (VALUES {selected})
+            SELECT selected.position, COUNT(*)
+              FROM LOOKUPS INNER JOIN selected ON selected.book_key = LOOKUPS.book_key
+            WHERE LOOKUPS.timestamp > selected.since
+            GROUP BY selected.position
+        '''
+        for position, count in self.connection.execute(sql_query, parameters):
+            counts[position] = count
+        return counts
+
+    def select_books(self, titles: Iterable[str], since: Optional[Dict[str, int]]) -> Tuple[str, List]:
+        """Return SQL values and their parameters for the keys, positions and since timestamps of the given books."""
+        since = {title.lower(): timestamp for title, timestamp in (since or {}).items()}
+        parameters = []
+        for position, title in enumerate(titles):
+            for key in self.book(title).keys:
+                parameters.extend((key, position, since.get(title.lower(), 0)))
+        return ', '.join(['(?, ?, ?)'] * (len(parameters) // 3)), parameters
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+# Only the columns kanki reads, with the names of the Kindle's tables so that VocabDB can query a merged database
+MERGED_SCHEMA = '''
+    CREATE TABLE BOOK_INFO (id TEXT PRIMARY KEY, asin TEXT, guid TEXT, lang TEXT, title TEXT, authors TEXT);
+    CREATE TABLE WORDS (id TEXT PRIMARY KEY, word TEXT, stem TEXT, lang TEXT);
+    CREATE TABLE LOOKUPS (id TEXT PRIMARY KEY, word_key TEXT, book_key TEXT, usage TEXT, timestamp INTEGER);
+    CREATE INDEX lookups_book_key ON LOOKUPS (book_key, timestamp);
+'''
+
+
+# Tables every Kindle vocabulary file has, other .db files are skipped
+VOCAB_TABLES = {'BOOK_INFO', 'LOOKUPS', 'WORDS'}
+
+
+def find_vocab_files(paths: Sequence[Union[str, os.PathLike]], immutable: bool = True) -> List[str]:
+    """
+    Return the given vocabulary files, and the .db files in the given directories and their subdirectories. Files that
+    aren't Kindle vocabulary files, e.g. other databases on a Kindle or in a shared folder, are skipped with a warning.
+    """
+    vocab_files = []
+    for file in list_db_files(paths):
+        if is_vocab_file(file, immutable):
+            vocab_files.append(file)
+        else:
+            logging.warning(f'Skipping "{file}", it isn\'t a Kindle vocabulary file')
+    return vocab_files
+
+
+def list_db_files(paths: Sequence[Union[str, os.PathLike]]) -> List[str]:
+    """Return the given files, and the .db files in the given directories and their subdirectories, unopened."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(str(file) for file in sorted(pathlib.Path(path).rglob('*.db')))
+        else:
+            files.append(str(path))
+    return files
+
+
+def is_vocab_file(path: str, immutable: bool = True) -> bool:
+    """Return true if the file is an SQLite database with the tables of a Kindle vocabulary file."""
+    try:
+        vocab = VocabDB.open(path, immutable)
+    except sqlite3.Error:
+        return False
+    try:
+        tables = {name.upper() for name, in vocab.connection.execute('SELECT name FROM sqlite_master '
+                                                                      'WHERE type = \'table\'')}
+    except sqlite3.DatabaseError:
+        # Not an SQLite database at all
+        return False
+    finally:
+        vocab.close()
+    return VOCAB_TABLES <= tables
+
+
+def read_vocab_file(path: str, immutable: bool = True) -> Tuple[List[tuple], List[tuple], List[tuple]]:
+    """Return the books, words and lookups of a vocabulary file, run in a worker process by VocabDB.open_many."""
+    vocab = VocabDB.open(path, immutable)
+    try:
+        connection = vocab.connection
+        books = connection.execute('SELECT id, asin, guid, lang, title, authors FROM BOOK_INFO').fetchall()
+        words = connection.execute('SELECT id, word, stem, lang FROM WORDS').fetchall()
+        lookups = connection.execute('SELECT id, word_key, book_key, usage, timestamp FROM LOOKUPS').fetchall()
+    finally:
+        vocab.close()
+    return books, words, lookups
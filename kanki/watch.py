@@ -0,0 +1,91 @@
+import logging
+import os
+import time
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+from kanki.vocab import is_vocab_file, list_db_files
+
+
+class VocabWatcher:
+    """
+    Watches vocabulary files for changes, e.g. the vocab.db of a mounted Kindle, by polling their modification times
+    and sizes.
+
+    Polling only takes a stat() of every file, which works on any file system a Kindle may be mounted with. Whether a
+    .db file is a vocabulary file is only checked when it appears or changes, see is_vocab. A Kindle writes its
+    database several times while syncing, so a change is only reported once the files have stayed the same for a while.
+    """
+    default_interval = 2.0
+    default_debounce = 5.0
+    journal_suffixes = ('-journal', '-wal')  # SQLite writes changes to these first
+
+    def __init__(self, paths: Sequence[Union[str, os.PathLike]], interval: float = default_interval,
+                 debounce: float = default_debounce):
+        """
+        :param paths: vocabulary files, or directories to search for .db files
+        :param interval: seconds between polls
+        :param debounce: seconds the files must stay unchanged before a change is reported
+        """
+        self.paths = paths
+        self.interval = interval
+        self.debounce = debounce
+        self.checked: Dict[str, Tuple[Tuple[int, int], bool]] = {}  # .db file -> its stat when checked, and the result
+
+    def snapshot(self) -> Dict[str, Tuple[int, int]]:
+        """Return the modification time and size of every vocabulary file and its journal that exists right now."""
+        snapshot = {}
+        for path in list_db_files(self.paths):
+            stat = VocabWatcher.stat(path)
+            if stat is None or not self.is_vocab(path, stat):
+                continue
+            snapshot[path] = stat
+            for journal in (path + suffix for suffix in VocabWatcher.journal_suffixes):
+                stat = VocabWatcher.stat(journal)
+                if stat is not None:
+                    snapshot[journal] = stat
+        return snapshot
+
+    def is_vocab(self, path: str, stat: Tuple[int, int]) -> bool:
+        """
+        Return true if the .db file is a Kindle vocabulary file, opening it only if it is new or has changed since it
+        was last checked, e.g. a vocabulary file still being written when it appeared. Other files are warned about
+        once.
+        """
+        checked = self.checked.get(path)
+        if checked is not None and checked[0] == stat:
+            return checked[1]
+        # The Kindle may be writing the file, so SQLite has to lock it while reading
+        is_vocab = is_vocab_file(path, immutable=False)
+        if not is_vocab and checked is None:
+            logging.warning(f'Skipping "{path}", it isn\'t a Kindle vocabulary file')
+        self.checked[path] = (stat, is_vocab)
+        return is_vocab
+
+    @staticmethod
+    def stat(path: str) -> Optional[Tuple[int, int]]:
+        """Return the modification time and size of the file, None if it doesn't exist."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def changes(self) -> Iterator[List[str]]:
+        """
+        Yield the vocabulary files right away, and again every time they have changed and settled, forever.
+
+        Nothing is yielded while there are no files, e.g. while the Kindle isn't mounted, and files that are mounted
+        again unchanged don't count as a change.
+        """
+        reported = None  # snapshot of the files when they were last yielded
+        current = self.snapshot()
+        changed_at = time.monotonic()
+        while True:
+            settled = reported is None or time.monotonic() - changed_at >= self.debounce
+            if current and current != reported and settled:
+                reported = current
+                yield [file for file in current if not file.endswith(VocabWatcher.journal_suffixes)]
+            time.sleep(self.interval)
+            latest = self.snapshot()
+            if latest != current:
+                current, changed_at = latest, time.monotonic()
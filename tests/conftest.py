@@ -1,7 +1,12 @@
 import sqlite3
+import threading
+from typing import Callable
 
 import pytest
 
+from benchmarks.fake_api import FakeMWServer
+from kanki.vocab import VocabDB
+
 
 @pytest.fixture
 def setup_database() -> sqlite3.Cursor:
@@ -10,11 +15,41 @@ def setup_database() -> sqlite3.Cursor:
     cursor = conn.cursor()
 
     insert_books(cursor)
+    insert_words(cursor)
     insert_lookups(cursor)
 
     return cursor
 
 
+@pytest.fixture
+def vocab_db(setup_database: sqlite3.Cursor) -> VocabDB:
+    """Return the test database wrapped in the vocabulary data layer"""
+    return VocabDB(setup_database.connection)
+
+
+@pytest.fixture
+def start_fake_api() -> Callable[..., FakeMWServer]:
+    """Return a function starting local stand-ins for the Merriam-Webster API, see FakeMWServer for its arguments"""
+    servers = []
+
+    def start(**options) -> FakeMWServer:
+        server = FakeMWServer(**options)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def fake_api(start_fake_api: Callable[..., FakeMWServer]) -> FakeMWServer:
+    """Return a local stand-in for the Merriam-Webster API, where half of the words are missing"""
+    return start_fake_api(suggestion_rate=0.5)
+
+
 def insert_lookups(cursor):
     cursor.execute('CREATE TABLE LOOKUPS '
                    '(id text UNIQUE, word_key text, book_key text,'
@@ -23,11 +58,29 @@ def insert_lookups(cursor):
         ('ID1:pos:1', 'en:hello', 'ID1', 'dict1', 'pos:1', 'hello sir', 1),
         ('ID1:pos:2', 'en:foo', 'ID1', 'dict1', 'pos:2', 'foo sentence', 2),
         ('ID1:pos:3', 'en:bar', 'ID1', 'dict1', 'pos:3', 'bar sentence', 3),
-        ('ID2:pos:1', 'en:physics', 'ID2', 'dict1', 'pos:1', 'Physics are astounding!', 4)
+        ('ID2:pos:1', 'en:physics', 'ID2', 'dict1', 'pos:1', 'Physics are astounding!', 4),
+        ('ID3:pos:1', 'en:running', 'ID3', 'dict1', 'pos:1', 'running sentence', 5),
+        ('ID3:pos:2', 'en:ran', 'ID3', 'dict1', 'pos:2', 'ran sentence', 6),
+        ('ID3:pos:3', 'en:foo', 'ID3', 'dict1', 'pos:3', 'another foo sentence', 7)
     ]
     cursor.executemany('INSERT INTO LOOKUPS VALUES (?, ?, ?, ?, ?, ?, ?)', sample_lookups)
 
 
+def insert_words(cursor):
+    cursor.execute('CREATE TABLE WORDS '
+                   '(id text PRIMARY KEY NOT NULL, word text, stem text, lang text,'
+                   'category integer DEFAULT 0, timestamp integer DEFAULT 0, profileid text)')
+    sample_words = [
+        ('en:hello', 'hello', 'hello', 'en', 0, 1, ''),
+        ('en:foo', 'foo', 'foo', 'en', 0, 2, ''),
+        ('en:bar', 'bar', 'bar', 'en', 0, 3, ''),
+        ('en:physics', 'physics', 'physics', 'en', 0, 4, ''),
+        ('en:running', 'running', 'run', 'en', 0, 5, ''),
+        ('en:ran', 'ran', 'run', 'en', 0, 6, '')
+    ]
+    cursor.executemany('INSERT INTO WORDS VALUES (?, ?, ?, ?, ?, ?, ?)', sample_words)
+
+
 def insert_books(cursor):
     cursor.execute('CREATE TABLE BOOK_INFO '
                    '(id text UNIQUE, asin text, guid text, lang text, title text, authors text)')
@@ -0,0 +1,122 @@
+import sqlite3
+import zipfile
+
+import pytest
+import pytest_mock
+
+from kanki.anki import AnkiCollection, AnkiWriter, MODEL_ID
+from kanki.exceptions import UnsupportedCollectionError
+from kanki.merriam_webster import MWDictionary
+from kanki.run import Kanki
+from kanki.state import ExportState
+from kanki.vocab import Lookup, VocabDB
+
+RUNNING = Lookup('running', 'Running late', 'The Stand', 'King, Stephen', 1_600_000_000_000, 'run', 'ID1:pos:1')
+FOO = Lookup('foo', 'foo sentence', 'The Stand', 'King, Stephen', 1_600_000_000_000, 'foo', 'ID1:pos:2')
+
+
+def read_notes(path):
+    connection = sqlite3.connect(path)
+    notes = connection.execute('SELECT id, guid, mid, flds, sfld FROM notes ORDER BY id').fetchall()
+    cards = connection.execute('SELECT nid, did, due FROM cards ORDER BY nid').fetchall()
+    connection.close()
+    return notes, cards
+
+
+def test_write_to_collection(tmp_path):
+    path = tmp_path / 'collection.anki2'
+    with AnkiWriter(path) as output:
+        output.write_lookup(RUNNING, ('run', ['to go faster than a walk'], 'ˈrʌn'))
+        output.write_lookup(FOO, ('foo', ['a placeholder'], None))
+    assert (output.added, output.updated) == (2, 0)
+
+    notes, cards = read_notes(path)
+    assert [note[0] for note in notes] == [1_600_000_000_000, 1_600_000_000_001], \
+        'Expected note ids from lookup timestamps, made unique'
+    fields = ['run', 'ˈrʌn', '<b>Running</b> late', 'to go faster than a walk', 'The Stand', 'King, Stephen']
+    assert notes[0][1:] == (AnkiCollection.guid('ID1:pos:1'), MODEL_ID, '\x1f'.join(fields), 'run')
+    assert [card[0] for card in cards] == [note[0] for note in notes]
+    assert [card[2] for card in cards] == [1, 2]
+
+    # Exporting the same lookup again updates its note
+    with AnkiWriter(path) as output:
+        output.write_lookup(RUNNING, ('run', ['to move swiftly'], 'ˈrʌn'))
+    assert (output.added, output.updated) == (0, 1)
+    updated_notes, updated_cards = read_notes(path)
+    assert len(updated_notes) == 2 and len(updated_cards) == 2
+    assert 'to move swiftly' in updated_notes[0][3]
+
+
+def test_guid_is_stable():
+    assert AnkiCollection.guid('ID1:pos:1') == AnkiCollection.guid('ID1:pos:1')
+    assert AnkiCollection.guid('ID1:pos:1') != AnkiCollection.guid('ID1:pos:2')
+
+
+def test_refuse_newer_collections(tmp_path):
+    path = tmp_path / 'collection.anki2'
+    AnkiCollection(path).close()
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.execute('UPDATE col SET ver = 18')
+    connection.close()
+    with pytest.raises(UnsupportedCollectionError):
+        AnkiCollection(path)
+
+
+def test_export_package(vocab_db: VocabDB, tmp_path, monkeypatch: pytest.MonkeyPatch,
+                        mocker: pytest_mock.MockerFixture):
+    monkeypatch.chdir(tmp_path)
+    dictionary = mocker.Mock(spec=MWDictionary)
+    dictionary.lookup.side_effect = lambda word: (word, [f'definition of {word}'], None)
+    kanki = Kanki(dictionary=dictionary, vocab=vocab_db, book_titles=['The Stand', 'Dune Messiah'])
+    kanki.anki_path = 'kanki.apkg'
+    kanki.export_book_lookups()
+
+    with zipfile.ZipFile(tmp_path / 'kanki.apkg') as package:
+        assert sorted(package.namelist()) == ['collection.anki2', 'media']
+        package.extract('collection.anki2', tmp_path / 'extracted')
+    notes, cards = read_notes(tmp_path / 'extracted' / 'collection.anki2')
+    assert len(notes) == len(cards) == 6
+    assert [path.name for path in tmp_path.iterdir() if path.suffix == '.anki2'] == [], \
+        'Expected the temporary collection to be removed'
+
+
+def test_package_export_killed_after_checkpoint(vocab_db: VocabDB, tmp_path, monkeypatch: pytest.MonkeyPatch,
+                                                mocker: pytest_mock.MockerFixture):
+    monkeypatch.chdir(tmp_path)
+    mocker.patch.object(Kanki, 'checkpoint_interval', 1)
+    killed_at = 'run'
+
+    class Killed(BaseException):
+        """Stands in for the process being killed, so the package is never written."""
+
+    def mock_lookup(word):
+        if word == killed_at:
+            raise Killed
+        return word, [f'definition of {word}'], None
+
+    dictionary = mocker.Mock(spec=MWDictionary)
+    dictionary.lookup.side_effect = mock_lookup
+    state = ExportState(tmp_path / 'state.json')
+    kanki = Kanki(dictionary=dictionary, vocab=vocab_db, book_titles=['The Stand', 'Dune Messiah'], state=state,
+                  jobs=1)
+    kanki.anki_path = 'kanki.apkg'
+    close = mocker.patch.object(AnkiWriter, 'close')
+    with pytest.raises(Killed):
+        kanki.export_book_lookups()
+    assert not (tmp_path / 'kanki.apkg').exists()
+    saved_state = ExportState(tmp_path / 'state.json')
+    assert saved_state.last_timestamp('The Stand') == 0, 'Expected no progress saved for cards not in the package'
+    assert saved_state.pending == ['The Stand', 'Dune Messiah']
+
+    mocker.stop(close)
+    killed_at = None
+    resumed = Kanki(dictionary=dictionary, vocab=vocab_db, book_titles=saved_state.pending, state=saved_state,
+                    since_last=True, jobs=1)
+    resumed.anki_path = 'kanki.apkg'
+    resumed.export_book_lookups()
+    with zipfile.ZipFile(tmp_path / 'kanki.apkg') as package:
+        package.extract('collection.anki2', tmp_path / 'extracted')
+    notes, cards = read_notes(tmp_path / 'extracted' / 'collection.anki2')
+    assert len(notes) == 6, 'Expected the resumed export to export the lookups again'
+    assert ExportState(tmp_path / 'state.json').pending == []
@@ -0,0 +1,98 @@
+import json
+import sqlite3
+
+import pytest
+import pytest_mock
+
+from benchmarks.fake_api import FakeMWServer
+from kanki.archive import ResponseArchive
+from kanki.cache import LookupCache
+from kanki.dead_letters import DeadLetters
+from kanki.merriam_webster import MWDictionary
+from kanki.run import Kanki
+from kanki.vocab import VocabDB
+
+
+def entry(word: str, **fields) -> dict:
+    return {'meta': {'stems': [word, word + 's']}, 'hwi': {'hw': word, 'prs': [{'ipa': 'ˈ' + word}]},
+            'shortdef': [f'definition of {word}'], **fields}
+
+
+def test_archive_responses(fake_api: FakeMWServer, tmp_path):
+    archive = ResponseArchive(tmp_path / 'responses.db')
+    dictionary = MWDictionary('dummy', api_base_url=fake_api.url, archive=archive)
+    for word in ['hello', 'foo', 'Hello']:
+        try:
+            dictionary.lookup(word)
+        except TypeError:
+            pass
+    assert len(archive) == 2
+    assert [word for word, _ in archive.latest()] == ['foo', 'hello']
+    word, body = archive.latest()[1]
+    assert json.loads(ResponseArchive.decompress(body)) == fake_api.entry('Hello'), \
+        'Expected the most recent response of a word'
+
+
+@pytest.mark.parametrize('threshold', [Kanki.reparse_threshold, 0])
+def test_reparse(vocab_db: VocabDB, tmp_path, monkeypatch: pytest.MonkeyPatch, mocker: pytest_mock.MockerFixture,
+                 threshold: int):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(Kanki, 'reparse_threshold', threshold)
+    archive = ResponseArchive(tmp_path / 'responses.db')
+    archive.add('hello', json.dumps([entry('hello')]).encode('utf-8'))
+    archive.add('foo', json.dumps([entry('foo', shortdef=None)]).encode('utf-8'))
+    archive.add('foo', json.dumps([entry('foo', hwi={'hw': 'foo', 'prs': [{'mw': 'ˈfü'}]})]).encode('utf-8'))
+    archive.add('bar', json.dumps(['bark', 'barn']).encode('utf-8'))
+    archive.add('physics', b'<html>not json</html>')
+    cache = LookupCache(tmp_path / 'cache.db')
+    dead_letters = DeadLetters(tmp_path / 'dead_letters.db')
+    dead_letters.record('foo', KeyError('ipa'))
+
+    kanki = Kanki(vocab=vocab_db)
+    get = mocker.patch('requests.Session.get')
+    kanki.reparse(archive, cache, workers=2, dead_letters=dead_letters)
+    get.assert_not_called()
+
+    cards = (tmp_path / Kanki.successful_words_path).read_text(encoding='utf-8').splitlines()
+    assert [line.split(',')[:2] for line in cards if line.startswith('"')] == \
+        [['"foo"', '"ˈfü"'], ['"hello"', '"ˈhello"'], ['"foo"', '"ˈfü"']], 'Expected the lookups of every book'
+    failed = (tmp_path / Kanki.failed_words_path).read_text(encoding='utf-8').splitlines()
+    assert [line.split(',')[0] for line in failed if line.startswith('"')] == ['"physics"', '"bar"']
+    assert cache.get('hellos') == ('hello', ['definition of hello'], 'ˈhello'), 'Expected entries to be cached'
+    assert 'foo' not in dead_letters
+
+
+@pytest.mark.parametrize('threshold', [Kanki.reparse_threshold, 0])
+def test_reparse_missing_words(vocab_db: VocabDB, tmp_path, monkeypatch: pytest.MonkeyPatch, threshold: int):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(Kanki, 'reparse_threshold', threshold)
+    archive = ResponseArchive(tmp_path / 'responses.db')
+    archive.add('hello', json.dumps([entry('hello')]).encode('utf-8'))
+    archive.add('bar', json.dumps(['bark', 'barn']).encode('utf-8'))
+    archive.add('bark', json.dumps([entry('bark')]).encode('utf-8'))
+    archive.add('run', json.dumps(['ruin']).encode('utf-8'))
+    fallback_archive = ResponseArchive(tmp_path / 'fallback_responses.db')
+    fallback_archive.add('run', json.dumps([entry('run')]).encode('utf-8'))
+    fallback_archive.add('physics', json.dumps(['physic']).encode('utf-8'))
+    cache = LookupCache(tmp_path / 'cache.db')
+    dead_letters = DeadLetters(tmp_path / 'dead_letters.db')
+    dead_letters.record('bar', TypeError('bar'))
+
+    Kanki(vocab=vocab_db).reparse(archive, cache, workers=2, dead_letters=dead_letters,
+                                  fallback_archive=fallback_archive)
+
+    cards = (tmp_path / Kanki.successful_words_path).read_text(encoding='utf-8').splitlines()
+    assert [line.split(',')[:2] for line in cards if line.startswith('"')] == \
+        [['"run"', '"ˈrun"'], ['"run"', '"ˈrun"'], ['"hello"', '"ˈhello"'], ['"bark"', '"ˈbark"']], \
+        'Expected words found through a suggestion or the fallback dictionary'
+    failed = (tmp_path / Kanki.failed_words_path).read_text(encoding='utf-8').splitlines()
+    assert [line.split(',')[0] for line in failed if line.startswith('"')] == ['"physics"']
+    assert cache.get('bar') == ('bark', ['definition of bark'], 'ˈbark'), 'Expected the suggestion cached for the word'
+    assert 'bar' not in dead_letters
+
+
+def test_close_archive(tmp_path):
+    archive = ResponseArchive(tmp_path / 'responses.db')
+    MWDictionary('dummy', archive=archive).close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        len(archive)
@@ -0,0 +1,40 @@
+import pytest
+
+from benchmarks.fake_api import FakeMWServer
+from benchmarks.synthetic_vocab import generate_vocab_db
+from kanki.exceptions import ServiceUnavailableError
+from kanki.merriam_webster import MWDictionary
+from kanki.vocab import VocabDB
+
+
+def test_generate_vocab_db(tmp_path):
+    path = tmp_path / 'vocab.db'
+    generate_vocab_db(path, lookups=2500, books=3, vocabulary=100)
+    vocab = VocabDB.open(path)
+    books = vocab.catalog()
+    assert len(books) == 3
+    assert sum(book.lookups for book in books) == 2500
+    lookups = list(vocab.lookups([book.title for book in books]))
+    assert len(lookups) == 2500
+    assert all(lookup.word.startswith(lookup.stem) for lookup in lookups)
+    assert len({lookup.stem for lookup in lookups}) <= 100
+    vocab.close()
+
+
+def test_lookup_in_fake_api(fake_api: FakeMWServer):
+    dictionary = MWDictionary('dummy', api_base_url=fake_api.url)
+    found, missing = [], []
+    for word in ['hello', 'foo', 'bar', 'baz', 'qux', 'quux']:
+        try:
+            word_stem, definitions, ipa = dictionary.lookup(word)
+            assert word_stem == word and definitions and ipa
+            found.append(word)
+        except TypeError:
+            missing.append(word)
+    assert found and missing, 'Expected some words to be answered with suggestions'
+    assert fake_api.queries == dictionary.queries_made == 6
+
+    fake_api.error_rate = 1
+    dictionary.client.retries = 0
+    with pytest.raises(ServiceUnavailableError):
+        dictionary.lookup(found[0])
@@ -0,0 +1,138 @@
+import gzip
+import json
+import time
+
+import pytest
+import pytest_mock
+
+from benchmarks.fake_api import FakeMWServer
+from kanki.cache import LookupCache
+from kanki.exceptions import InvalidBundleError
+from kanki.merriam_webster import MWDictionary
+
+
+def test_cache_roundtrip(tmp_path):
+    cache = LookupCache(tmp_path / 'cache.db')
+    assert cache.get('hello') is None
+    cache.put('Hello ', ('hello', ['a greeting'], 'hə-ˈlō'))
+    assert cache.get('hello') == ('hello', ['a greeting'], 'hə-ˈlō'), 'Expected keys to be normalized'
+    assert 'HELLO' in cache
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_cache_persists(tmp_path):
+    cache = LookupCache(tmp_path / 'cache.db')
+    cache.put('foo', ('foo', ['a placeholder'], None))
+    cache.close()
+    assert LookupCache(tmp_path / 'cache.db').get('foo') == ('foo', ['a placeholder'], None)
+
+
+def test_cache_expiry(tmp_path, mocker: pytest_mock.MockerFixture):
+    cache = LookupCache(tmp_path / 'cache.db', ttl_days=1)
+    cache.put('foo', ('foo', [], None))
+    mocker.patch('kanki.cache.time.time', return_value=time.time() + 2 * 24 * 60 * 60)
+    assert 'foo' not in cache
+    assert cache.get('foo') is None
+    assert len(cache) == 0
+
+
+def test_cache_eviction(tmp_path, mocker: pytest_mock.MockerFixture):
+    clock = mocker.patch('kanki.cache.time.time', return_value=1.0)
+    cache = LookupCache(tmp_path / 'cache.db', max_entries=2)
+    cache.put('a', ('a', [], None))
+    clock.return_value = 2.0
+    cache.put('b', ('b', [], None))
+    clock.return_value = 3.0
+    cache.get('a')  # 'b' is now the least recently used entry
+    cache.put('c', ('c', [], None))
+    assert len(cache) == 2
+    assert 'a' in cache and 'c' in cache
+    assert 'b' not in cache
+
+
+def test_cache_refresh(tmp_path):
+    cache = LookupCache(tmp_path / 'cache.db')
+    cache.put('foo', ('foo', [], None))
+    refreshing_cache = LookupCache(tmp_path / 'cache.db', refresh=True)
+    assert refreshing_cache.get('foo') is None
+    assert 'foo' not in refreshing_cache
+
+
+def test_cached_lookup_skips_api(tmp_path, mocker: pytest_mock.MockerFixture):
+    cache = LookupCache(tmp_path / 'cache.db')
+    cache.put('foo', ('foo', ['a placeholder'], None))
+    dictionary = MWDictionary('dummy', cache)
+    get = mocker.patch.object(dictionary.session, 'get')
+    assert dictionary.lookup('foo') == ('foo', ['a placeholder'], None)
+    assert dictionary.queries_made == 0
+    get.assert_not_called()
+
+
+def test_cache_inflections(tmp_path, mocker: pytest_mock.MockerFixture):
+    clock = mocker.patch('kanki.cache.time.time', return_value=1.0)
+    cache = LookupCache(tmp_path / 'cache.db', max_entries=2)
+    cache.put('run', ('run', ['to go fast'], None), forms=['run', 'ran', 'Running', 'runs'])
+    cache.put('runner', ('runner', ['one who runs'], None), forms=['runner', 'runs'])
+    assert cache.get('running') == ('run', ['to go fast'], None)
+    assert cache.get('runs') == ('run', ['to go fast'], None), 'Expected the first headword of a form to be kept'
+    assert 'ran' in cache
+    assert (cache.hits, cache.inflection_hits) == (2, 2)
+
+    clock.return_value = 2.0
+    cache.get('runner')
+    cache.put('walk', ('walk', [], None), forms=['walked'])
+    assert 'ran' not in cache, 'Expected the forms of evicted words to be forgotten'
+    assert cache.connection.execute('SELECT COUNT(*) FROM forms WHERE word = ?', ('run', )).fetchone()[0] == 0
+
+
+def test_inflections_skip_api(tmp_path, fake_api: FakeMWServer):
+    dictionary = MWDictionary('dummy', LookupCache(tmp_path / 'cache.db'), api_base_url=fake_api.url)
+    word = next(word for word in ['walk', 'jump', 'talk', 'climb'] if isinstance(fake_api.entry(word)[0], dict))
+    assert dictionary.lookup(word)[0] == word
+    assert dictionary.lookup(word + 'ing')[0] == word
+    assert dictionary.lookup(word + 'ed')[0] == word
+    assert dictionary.queries_made == fake_api.queries == 1
+
+
+def test_cache_bundle(tmp_path, mocker: pytest_mock.MockerFixture):
+    clock = mocker.patch('kanki.cache.time.time', return_value=1.0)
+    cache = LookupCache(tmp_path / 'cache.db')
+    cache.put('run', ('run', ['to go fast'], None), forms=['ran'])
+    clock.return_value = 2.0
+    cache.put('running', ('run', ['to go fast', 'to manage'], None), forms=['runs'])
+    cache.put('foo', ('foo', ['a placeholder'], 'fü'))
+    assert cache.export_bundle(tmp_path / 'bundle.json.gz') == 2, 'Expected entries to be deduplicated by headword'
+
+    clock.return_value = 3.0
+    other = LookupCache(tmp_path / 'other.db')
+    other.put('foo', ('foo', ['a newer placeholder'], None))
+    other.put('bar', ('bar', [], None))
+    assert other.import_bundle(tmp_path / 'bundle.json.gz') == 1, 'Expected more recent entries to be kept'
+    assert len(other) == 3
+    for word in ('run', 'ran', 'Running', 'runs'):
+        assert other.get(word) == ('run', ['to go fast', 'to manage'], None)
+    assert other.get('foo') == ('foo', ['a newer placeholder'], None)
+    assert other.import_bundle(tmp_path / 'bundle.json.gz') == 0
+
+
+def test_invalid_cache_bundle(tmp_path):
+    cache = LookupCache(tmp_path / 'cache.db')
+    cache.put('foo', ('foo', ['a placeholder'], None))
+    path = tmp_path / 'bundle.json.gz'
+    cache.export_bundle(path)
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        bundle = json.load(f)
+
+    def write(**changes):
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            json.dump({**bundle, **changes}, f)
+
+    write(entries=[['foo', ['a tampered placeholder'], None, 1.0, []]])
+    with pytest.raises(InvalidBundleError, match='checksum'):
+        cache.import_bundle(path)
+    write(version=LookupCache.bundle_version + 1)
+    with pytest.raises(InvalidBundleError, match='version'):
+        cache.import_bundle(path)
+    path.write_text('not a bundle')
+    with pytest.raises(InvalidBundleError):
+        cache.import_bundle(path)
@@ -1,4 +1,6 @@
-from kanki.card import Card
+import pytest
+
+from kanki.card import Card, CardBatch
 
 
 def test_replace_nones():
@@ -15,3 +17,29 @@ def test_get_csv_encoding():
     assert card.get_csv_encoding() == '"word","","\'trouble\'","","book_title","author"'
     card.book_title = '"also_trouble"'
     assert card.get_csv_encoding() == '"word","","\'trouble\'","","\'also_trouble\'","author"'
+
+
+def test_card_batch_encoding():
+    batch = CardBatch()
+    card = Card('word', 'sentence', 'book_title', 'author')
+    batch.append_card(card)
+    assert batch.encode() == card.get_csv_encoding() + '\n'
+
+    batch.clear()
+    batch.append('run', 'ˈrʌn', 'Running "late", he ran.', 'to go "fast"', 'A "book"', 'Doe, Jane', 'running')
+    assert batch.encode('csv') == \
+        '"run","ˈrʌn","<b>Running</b> \'late\', he ran.","to go ""fast""","A \'book\'","Doe, Jane"\n'
+    batch.definitions[0] = 'to go\tfast'
+    assert batch.encode('tsv') == \
+        'run\tˈrʌn\t<b>Running</b> \'late\', he ran.\t"to go\tfast"\tA \'book\'\tDoe, Jane\n'
+    with pytest.raises(ValueError):
+        batch.encode('xml')
+
+
+def test_card_batch_highlighting():
+    batch = CardBatch()
+    for sentence, highlight in [('The cat sat on the Cat.', 'cat'), ('Concatenate the cats', 'cat'),
+                                ('Mr. Smith met mr. Jones', 'mr.'), ('Nothing to see', None)]:
+        batch.append('word', None, sentence, None, 'title', 'author', highlight)
+    assert batch.highlighted_sentences() == ['The <b>cat</b> sat on the <b>Cat</b>.', 'Concatenate the cats',
+                                             '<b>Mr.</b> Smith met <b>mr.</b> Jones', 'Nothing to see']
@@ -0,0 +1,118 @@
+import time
+
+import pytest
+
+from benchmarks.fake_api import FakeMWServer
+from kanki.client import APIClient, RateLimiter
+from kanki.exceptions import ServiceUnavailableError
+from kanki.merriam_webster import MWDictionary
+from kanki.run import Kanki
+from kanki.state import ExportState
+from kanki.vocab import VocabDB
+
+
+def fast_client(**options) -> APIClient:
+    """Return a client that doesn't wait long between retries."""
+    return APIClient(**{'backoff': 0.001, 'max_backoff': 0.01, **options})
+
+
+def test_retry_failed_queries(fake_api: FakeMWServer):
+    fake_api.error_rate, fake_api.seed = 0.3, 1
+    dictionary = MWDictionary('dummy', api_base_url=fake_api.url, client=fast_client(retries=10))
+    for word in ['hello', 'foo', 'bar', 'baz', 'qux', 'quux', 'corge', 'grault']:
+        try:
+            dictionary.lookup(word)
+        except TypeError:
+            pass
+    assert fake_api.queries > 8, 'Expected some queries to be retried'
+    assert dictionary.queries_made == fake_api.queries, 'Expected retries to count against the quota'
+
+
+def test_honor_retry_after(fake_api: FakeMWServer):
+    fake_api.throttle_rate, fake_api.retry_after = 1, 0.1
+    client = fast_client(retries=2)
+    dictionary = MWDictionary('dummy', api_base_url=fake_api.url, client=client)
+    start = time.perf_counter()
+    with pytest.raises(ServiceUnavailableError):
+        dictionary.lookup('hello')
+    assert time.perf_counter() - start >= 0.2
+    assert fake_api.queries == 3
+    assert client.rate_limiter.rate is not None, 'Expected the request rate to be limited after 429 responses'
+
+    fake_api.retry_after = 3600
+    with pytest.raises(ServiceUnavailableError):
+        dictionary.lookup('hello')
+    assert fake_api.queries == 4, 'Expected no retry when asked to wait too long'
+    assert client.circuit_breaker.is_open
+
+
+def test_circuit_breaker(fake_api: FakeMWServer):
+    fake_api.error_rate = 1
+    client = fast_client(retries=5, failure_threshold=3)
+    dictionary = MWDictionary('dummy', api_base_url=fake_api.url, client=client)
+    with pytest.raises(ServiceUnavailableError):
+        dictionary.lookup('hello')
+    assert fake_api.queries == 3
+    with pytest.raises(ServiceUnavailableError):
+        dictionary.lookup('foo')
+    assert fake_api.queries == 3, 'Expected no queries once the circuit breaker is open'
+
+    fake_api.error_rate = 0
+    dictionary.reset()
+    assert dictionary.lookup('hello')[0] == 'hello', 'Expected queries again once the circuit breaker is reset'
+
+
+def test_timeout(fake_api: FakeMWServer):
+    fake_api.latency = 0.5
+    dictionary = MWDictionary('dummy', api_base_url=fake_api.url, client=fast_client(timeout=0.05, retries=1))
+    start = time.perf_counter()
+    with pytest.raises(ServiceUnavailableError):
+        dictionary.lookup('hello')
+    assert time.perf_counter() - start < 0.5
+    assert dictionary.queries_made == 0, 'Expected queries without a response not to be counted'
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(min_rate=1)
+    limiter.wait()
+    limiter.throttled()
+    assert limiter.rate is None, 'Expected no limit before the rate of requests is known'
+    limiter.wait()
+    limiter.throttled()
+    assert limiter.rate >= 1
+    limiter.rate = 4
+    limiter.throttled()
+    assert limiter.rate == 2
+    limiter.succeeded()
+    assert limiter.rate == 2.25
+    limiter.max_rate = 2.5
+    for _ in range(10):
+        limiter.succeeded()
+    assert limiter.rate == 2.5
+
+
+def test_retry_after_header():
+    class Response:
+        def __init__(self, retry_after):
+            self.headers = {'Retry-After': retry_after} if retry_after is not None else {}
+
+    assert APIClient.retry_after(Response('3')) == 3
+    assert APIClient.retry_after(Response(None)) is None
+    assert APIClient.retry_after(Response('Wed, 21 Oct 2015 07:28:00 GMT')) == 0
+    assert APIClient.retry_after(Response('soon')) is None
+
+
+def test_export_stops_when_api_unavailable(vocab_db: VocabDB, fake_api: FakeMWServer, tmp_path,
+                                           monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.chdir(tmp_path)
+    fake_api.error_rate = 1
+    dictionary = MWDictionary('dummy', api_base_url=fake_api.url, client=fast_client(failure_threshold=5))
+    state = ExportState()
+    kanki = Kanki(dictionary=dictionary, vocab=vocab_db, book_titles=['The Stand', 'Dune Messiah'], state=state,
+                  jobs=2)
+    with pytest.raises(ServiceUnavailableError):
+        kanki.export_book_lookups()
+    assert fake_api.queries <= 5 + 2, 'Expected the circuit breaker to stop the lookups in flight'
+    assert state.pending == ['The Stand', 'Dune Messiah'], 'Expected the export to be resumable'
+    with open(Kanki.failed_words_path, encoding='utf-8') as f:
+        assert f.read() == kanki.metadata_about_export(), 'Expected unavailable words not to be written as failed'
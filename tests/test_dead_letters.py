@@ -0,0 +1,64 @@
+import pytest
+import pytest_mock
+
+from kanki.dead_letters import DeadLetters
+from kanki.dictionary import DeadLetterDictionary
+from kanki.exceptions import MissingWordError
+from kanki.merriam_webster import MWDictionary
+from kanki.run import Kanki
+from kanki.vocab import VocabDB
+
+DAY = 24 * 60 * 60
+
+
+def test_expiry_doubles(tmp_path, mocker: pytest_mock.MockerFixture):
+    clock = mocker.patch('kanki.dead_letters.time.time', return_value=0.0)
+    dead_letters = DeadLetters(tmp_path / 'dead_letters.db', base_delay_days=1, max_delay_days=3)
+    assert dead_letters.record('Foo', TypeError('foo not found')).retry_at == DAY
+    assert dead_letters.get('foo').reason == DeadLetters.MISSING
+    assert dead_letters.due() == []
+
+    clock.return_value = DAY
+    assert 'foo' not in dead_letters, 'Expected the failure to expire'
+    assert dead_letters.due() == ['foo']
+    assert dead_letters.record('foo', KeyError('shortdef')).retry_at == DAY + 2 * DAY
+    assert dead_letters.record('foo', KeyError('shortdef')).retry_at == DAY + 3 * DAY, 'Expected the delay to be capped'
+    assert dead_letters.get('foo') == ('foo', DeadLetters.FAILED, "'shortdef'", 3, DAY + 3 * DAY)
+    assert dead_letters.skips == 2
+    assert not DeadLetters(tmp_path / 'dead_letters.db', refresh=True).get('foo')
+
+    dead_letters.remove('foo')
+    assert len(dead_letters) == 0
+
+
+def test_dead_letter_dictionary(tmp_path, mocker: pytest_mock.MockerFixture):
+    online = MWDictionary('dummy')
+    lookup = mocker.patch.object(online, 'lookup', side_effect=MissingWordError('foo not found', ['food']))
+    dictionary = DeadLetterDictionary(online, DeadLetters(tmp_path / 'dead_letters.db'))
+    assert dictionary.costs_query('foo')
+    for _ in range(2):
+        with pytest.raises(TypeError):
+            dictionary.lookup('foo')
+    lookup.assert_called_once_with('foo')
+    assert not dictionary.costs_query('foo'), 'Expected words known to be missing not to be queried again'
+
+
+def test_retry_failed(vocab_db: VocabDB, tmp_path, monkeypatch: pytest.MonkeyPatch,
+                      mocker: pytest_mock.MockerFixture):
+    monkeypatch.chdir(tmp_path)
+    dead_letters = DeadLetters(tmp_path / 'dead_letters.db', base_delay_days=0)
+    for word in ('foo', 'physics', 'hello'):
+        dead_letters.record(word, TypeError(f'{word} not found'))
+    dead_letters.base_delay_days = 1
+    dictionary = mocker.Mock(spec=MWDictionary)
+    dictionary.lookup.side_effect = lambda word: (word, [f'definition of {word}'], None)
+    dictionary.max_queries = None
+    kanki = Kanki(dictionary=DeadLetterDictionary(dictionary, dead_letters), vocab=vocab_db)
+
+    kanki.retry_failed(limit=2)
+    assert [call.args[0] for call in dictionary.lookup.call_args_list] == ['foo', 'physics']
+    assert dead_letters.due() == ['hello']
+    exported = [line for line in (tmp_path / kanki.export_paths()[0]).read_text(encoding='utf-8').splitlines()
+                if line.startswith('"')]
+    assert [line.split(',')[0] for line in exported] == ['"foo"', '"physics"', '"foo"'], \
+        'Expected every lookup of the words found to be exported'
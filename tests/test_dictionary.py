@@ -0,0 +1,120 @@
+import time
+from typing import Callable
+
+import pytest
+import pytest_mock
+
+from benchmarks.fake_api import FakeMWServer
+from kanki.cache import LookupCache
+from kanki.dead_letters import DeadLetters
+from kanki.dictionary import DeadLetterDictionary, Dictionary, HedgedDictionary
+from kanki.exceptions import MissingWordError, ServiceUnavailableError
+from kanki.merriam_webster import MWDictionary
+from kanki.metrics import Metrics
+from kanki.quota import QuotaLedger
+from kanki.run import Kanki
+from kanki.vocab import VocabDB
+
+
+@pytest.fixture
+def slow_api(start_fake_api: Callable[..., FakeMWServer]) -> FakeMWServer:
+    """Return a local stand-in for the Merriam-Webster API that takes a while to answer and lacks no words"""
+    return start_fake_api(latency=0.5)
+
+
+def test_suggestions_are_raised(fake_api: FakeMWServer):
+    fake_api.suggestion_rate = 1
+    with pytest.raises(MissingWordError) as err:
+        MWDictionary('dummy', api_base_url=fake_api.url).lookup('colour')
+    assert err.value.suggestions == ['coloure', 'colourer', 'colourly']
+
+
+def test_follow_suggestion(tmp_path, mocker: pytest_mock.MockerFixture):
+    def lookup(word: str):
+        if word == 'colour':
+            raise MissingWordError(f'{word} not found', suggestions=['color', 'colored'])
+        if word == 'qwzx':
+            raise MissingWordError(f'{word} not found')
+        return word, [f'definition of {word}'], None
+
+    primary = mocker.Mock(spec=Dictionary)
+    primary.lookup.side_effect = lookup
+    primary.cache = LookupCache(tmp_path / 'cache.db')
+    primary.ledger = None
+    primary.metrics = Metrics()
+    dictionary = HedgedDictionary(primary)
+
+    assert dictionary.lookup('colour') == ('color', ['definition of color'], None)
+    assert primary.cache.get('colour') == ('color', ['definition of color'], None), \
+        'Expected the entry of the suggestion to be cached for the word looked up'
+    with pytest.raises(TypeError):
+        dictionary.lookup('qwzx')
+    assert primary.metrics.counters['suggestions_found'] == 1
+    dictionary.close()
+
+
+def test_suggestion_unavailable(tmp_path, mocker: pytest_mock.MockerFixture):
+    def lookup(word: str):
+        if word == 'colour':
+            raise MissingWordError(f'{word} not found', suggestions=['color'])
+        raise ServiceUnavailableError('The API keeps failing')
+
+    primary = mocker.Mock(spec=Dictionary)
+    primary.lookup.side_effect = lookup
+    primary.cache, primary.ledger, primary.metrics = None, None, None
+    dead_letters = DeadLetters(tmp_path / 'dead_letters.db')
+    dictionary = DeadLetterDictionary(HedgedDictionary(primary), dead_letters)
+    with pytest.raises(ServiceUnavailableError):
+        dictionary.lookup('colour')
+    assert 'colour' not in dead_letters, 'Expected the word not to fail before its suggestion was looked up'
+    dictionary.close()
+
+
+def test_suggestions_within_limit(fake_api: FakeMWServer, tmp_path):
+    fake_api.suggestion_rate = 1
+    ledger = QuotaLedger(2, tmp_path / 'quota.json')
+    ledger.record()
+    dictionary = HedgedDictionary(MWDictionary('dummy', ledger=ledger, api_base_url=fake_api.url))
+    with pytest.raises(TypeError):
+        dictionary.lookup('colour')
+    assert fake_api.queries == 1, 'Expected no suggestion to be looked up without queries left today'
+    assert ledger.remaining() == 0
+    dictionary.close()
+
+
+def test_export_with_suggestions_within_limit(vocab_db: VocabDB, fake_api: FakeMWServer, tmp_path,
+                                              monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.chdir(tmp_path)
+    fake_api.suggestion_rate = 1
+    ledger = QuotaLedger(1000, tmp_path / 'quota.json')
+    ledger.record(996)
+    dictionary = HedgedDictionary(MWDictionary('dummy', ledger=ledger, api_base_url=fake_api.url, pool_size=4),
+                                  workers=2)
+    kanki = Kanki(dictionary=dictionary, vocab=vocab_db, book_titles=['The Stand', 'Dune Messiah'], jobs=2)
+    kanki.export_book_lookups()
+    assert ledger.used == 1000, 'Expected suggestions not to spend the queries of the words scheduled'
+    assert ledger.reserved == 0
+    dictionary.close()
+
+
+def test_hedge_missing_words(fake_api: FakeMWServer, slow_api: FakeMWServer):
+    fake_api.suggestion_rate = 1
+    primary = MWDictionary('dummy', api_base_url=fake_api.url)
+    secondary = MWDictionary('dummy', api_base_url=slow_api.url)
+    dictionary = HedgedDictionary(primary, secondary, hedge_after=10, follow_suggestions=False)
+    assert dictionary.lookup('hello')[0] == 'hello', 'Expected the secondary dictionary to have the word'
+    assert (fake_api.queries, slow_api.queries) == (1, 1)
+    assert dictionary.queries_made == 1, 'Expected only queries of the primary dictionary to count'
+    dictionary.close()
+
+
+def test_hedge_slow_words(fake_api: FakeMWServer, slow_api: FakeMWServer):
+    fake_api.suggestion_rate = 0
+    primary = MWDictionary('dummy', api_base_url=slow_api.url)
+    secondary = MWDictionary('dummy', api_base_url=fake_api.url)
+    dictionary = HedgedDictionary(primary, secondary, hedge_after=0.05)
+    start = time.perf_counter()
+    assert dictionary.lookup('hello')[0] == 'hello'
+    assert time.perf_counter() - start < 0.5, 'Expected the faster answer to be used'
+    assert fake_api.queries == 1
+    dictionary.close()
@@ -0,0 +1,30 @@
+from kanki.card import Card
+from kanki.export import ExportWriter
+from kanki.vocab import Lookup
+
+
+def test_export_writer(tmp_path):
+    path = tmp_path / 'export.txt'
+    with ExportWriter(path, '# header\n') as output:
+        output.write(Card('word', 'sentence', 'book_title', 'author'))
+        assert path.read_text() == '', 'Expected cards to be buffered'
+        output.flush()
+        assert path.read_text() == '# header\n"word","","sentence","","book_title","author"\n'
+        output.write(Card('other', 'sentence', 'book_title', 'author'))
+    assert output.count == 2
+    assert path.read_text().endswith('"other","","sentence","","book_title","author"\n')
+
+    with ExportWriter(path, '# header\n', append=True):
+        pass
+    assert path.read_text().count('# header') == 2
+
+
+def test_export_lookups_as_tsv(tmp_path):
+    path = tmp_path / 'export.txt'
+    with ExportWriter(path, '', format='tsv') as output:
+        output.write_lookup(Lookup('running', 'Running late', 'The Stand', 'King, Stephen', 1, 'run', 'ID1:pos:1'),
+                            ('run', ['to go faster than a walk', 'to flee'], None))
+        output.write_lookup(Lookup('foo', 'foo sentence', 'The Stand', 'King, Stephen', 2, 'foo', 'ID1:pos:2'), None)
+    assert path.read_text(encoding='utf-8') == \
+        'run\t\t<b>Running</b> late\tto go faster than a walk; to flee\tThe Stand\tKing, Stephen\n' \
+        'foo\t\t<b>foo</b> sentence\t\tThe Stand\tKing, Stephen\n'
@@ -1,53 +1,110 @@
-import sqlite3
+import time
 
 import pytest
 import pytest_mock
 
-from kanki.exceptions import MissingBookError
-from kanki.run import Kanki
+from benchmarks.fake_api import FakeMWServer
+from kanki.cache import LookupCache
+from kanki.dead_letters import DeadLetters
+from kanki.dictionary import QuotaDictionary
+from kanki.exceptions import MissingBookError, MissingWordError
+from kanki.quota import QuotaLedger
+from kanki.run import Kanki, create_dictionary, get_arg_parser
+from kanki.state import ExportState
+from kanki.vocab import VocabDB
 from merriam_webster import MWDictionary
 
 
-def test_remove_books_until_safe(mocker: pytest_mock.MockerFixture):
-    # books = {name: number of lookups}
-    books = {'BOOK_A': 1,
-             'BOOK_B': MWDictionary.max_queries // 2,
-             'BOOK_C': MWDictionary.max_queries // 2}
-    kanki = Kanki(dictionary=MWDictionary(api_key='dummy'), book_titles=list(books.keys()))
-
-    def mock_count_lookups(self, book_title):
-        return books.get(book_title)
-
-    mocker.patch.object(
-        Kanki,
-        'count_lookups',
-        mock_count_lookups
-    )
-
-    actual_1 = kanki.remove_books_until_safe()
-    expected_1 = ['BOOK_A', 'BOOK_B']
-
-    actual_2 = kanki.remove_books_until_safe()
-    expected_2 = expected_1
-
-    assert expected_1 == actual_1, 'wrong book remaining'
-    assert expected_2 == actual_2, 'the book should stay in the list'
-
-
-def test_remove_unsafe_book(mocker: pytest_mock.MockerFixture):
-    kanki = Kanki(dictionary=MWDictionary('dummy'), book_titles=['B'])
+def test_schedule(vocab_db: VocabDB, tmp_path):
+    cache = LookupCache(tmp_path / 'cache.db')
+    kanki = Kanki(dictionary=MWDictionary('dummy', cache), vocab=vocab_db,
+                  book_titles=['The Stand', 'Dune Messiah'])
+    counts, lookups = kanki.select_lookups()
+    lookups = list(lookups)  # hello, foo, bar, running, ran, foo
+    assert counts == [3, 3]
+
+    today = list(kanki.schedule(lookups, budget=3))
+    assert [lookup.word for lookup in today] == ['hello', 'foo', 'bar']
+    assert kanki.postponed_from.word == 'running'
+
+    today = list(kanki.schedule(lookups, budget=4))
+    assert [lookup.word for lookup in today] == ['hello', 'foo', 'bar', 'running', 'ran', 'foo'], \
+        'Expected repeated words to be free'
+    assert kanki.postponed_from is None
+
+    cache.put('hello', ('hello', [], None))
+    today = list(kanki.schedule(lookups, budget=2))
+    assert [lookup.word for lookup in today] == ['hello', 'foo', 'bar'], 'Expected cached words to be free'
+
+    today = list(kanki.schedule(lookups, budget=0))
+    assert [lookup.word for lookup in today] == ['hello']
+
+
+def test_resume_after_postponing(vocab_db: VocabDB, tmp_path):
+    state = ExportState(tmp_path / 'state.json')
+    kanki = Kanki(dictionary=MWDictionary('dummy'), vocab=vocab_db,
+                  book_titles=['The Stand', 'Dune Messiah'], state=state)
+    # The budget ran out in the middle of the second book
+    kanki.checkpoint([], {'The Stand': 3, 'Dune Messiah': 5}, in_progress='Dune Messiah')
+    assert state.pending == ['Dune Messiah']
+
+    resumed = Kanki(dictionary=MWDictionary('dummy'), vocab=vocab_db,
+                    book_titles=ExportState(tmp_path / 'state.json').pending, state=state, since_last=True)
+    counts, lookups = resumed.select_lookups()
+    assert [lookup.word for lookup in lookups] == ['ran', 'foo']
+
+
+def test_overlapping_postponed_exports(vocab_db: VocabDB, tmp_path):
+    feynman = '"Surely You\'re Joking, Mr. Feynman!": Adventures of a Curious Character'
+    state = ExportState(tmp_path / 'state.json')
+    first = Kanki(dictionary=MWDictionary('dummy'), vocab=vocab_db, book_titles=['The Stand', 'Dune Messiah'],
+                  state=state, since_last=True)
+    first.begin_export()
+    first.checkpoint([], {'The Stand': 3}, in_progress='Dune Messiah')
+    assert state.pending == ['Dune Messiah']
+
+    second = Kanki(dictionary=MWDictionary('dummy'), vocab=vocab_db, book_titles=[feynman, 'the stand'], state=state,
+                   since_last=True)
+    second.begin_export()
+    assert state.pending == ['Dune Messiah', feynman, 'the stand'], 'Expected the earlier export to stay pending'
+    second.checkpoint([], {feynman: 4}, in_progress='the stand')
+    assert state.pending == ['Dune Messiah', 'the stand']
+    second.checkpoint([], {}, in_progress=None)
+    assert ExportState(tmp_path / 'state.json').pending == ['Dune Messiah'], \
+        'Expected only the books of the finished export to be done'
+
+
+def test_export_is_resumable(vocab_db: VocabDB, tmp_path, monkeypatch: pytest.MonkeyPatch,
+                             mocker: pytest_mock.MockerFixture):
+    monkeypatch.chdir(tmp_path)
+    mocker.patch.object(Kanki, 'checkpoint_interval', 1)
+    interrupt_at = 'run'
+
+    def mock_lookup(word):
+        if word == interrupt_at:
+            raise KeyboardInterrupt
+        return word, [f'definition of {word}'], None
+
+    dictionary = MWDictionary('dummy')
+    mocker.patch.object(dictionary, 'lookup', side_effect=mock_lookup)
+    state = ExportState()
+    kanki = Kanki(dictionary=dictionary, vocab=vocab_db, book_titles=['The Stand', 'Dune Messiah'], state=state, jobs=1)
+    with pytest.raises(SystemExit):
+        kanki.export_book_lookups()
 
-    def mock_count_lookups(self, book_title):
-        unsafe_book_lookups = MWDictionary.max_queries + 1
-        return unsafe_book_lookups
+    assert state.pending == ['The Stand', 'Dune Messiah']
+    assert state.last_timestamp('The Stand') == 3
+    exported = (tmp_path / Kanki.successful_words_path).read_text(encoding='utf-8')
+    assert '"bar","","<b>bar</b> sentence"' in exported, 'Expected cards to be written before the interruption'
 
-    mocker.patch.object(Kanki, 'count_lookups', mock_count_lookups)
-    with pytest.raises(SystemExit):
-        kanki.remove_books_until_safe()
+    interrupt_at = None
+    resumed = Kanki(dictionary=dictionary, vocab=vocab_db, book_titles=state.pending, state=state, since_last=True)
+    cards, failed_words, missing_words = resumed.create_flashcards()
+    assert [card.sentence for card in cards] == ['running sentence', 'ran sentence', 'another foo sentence']
 
 
-def test_count_lookups(setup_database: sqlite3.Cursor):
-    kanki = Kanki(db_cursor=setup_database)
+def test_count_lookups(vocab_db: VocabDB):
+    kanki = Kanki(vocab=vocab_db)
     assert 1 == kanki.count_lookups('"Surely You\'re Joking, Mr. Feynman!": Adventures of a Curious Character')
     assert 3 == kanki.count_lookups('The Stand')
     assert 3 == kanki.count_lookups('thE staNd'), 'Expected case insensitive SQL query'
@@ -55,6 +112,52 @@ def test_count_lookups(setup_database: sqlite3.Cursor):
         kanki.count_lookups('Unknown book')
 
 
+def test_count_api_queries(vocab_db: VocabDB):
+    kanki = Kanki(dictionary=MWDictionary('dummy'), vocab=vocab_db)
+    assert 3 == kanki.count_api_queries(map(Kanki.query_word, kanki.get_lookups('The Stand')))
+    assert 2 == kanki.count_api_queries(map(Kanki.query_word, kanki.get_lookups('Dune Messiah'))), \
+        'Expected inflections of a word to be counted once'
+    assert 4 == kanki.count_api_queries(['hello', 'foo', 'bar', 'run', 'run', 'foo'])
+
+
+def test_plan_is_a_dry_run(vocab_db: VocabDB, tmp_path, capsys: pytest.CaptureFixture,
+                           mocker: pytest_mock.MockerFixture):
+    lookup = mocker.spy(QuotaDictionary, 'lookup')
+    args = get_arg_parser().parse_args(['-t', 'The Stand', '--plan'])
+    dictionary = create_dictionary(args, None, str(tmp_path))
+    assert list(tmp_path.iterdir()) == [], 'Expected no cache or archive to be created'
+    dictionary.close()
+
+    LookupCache(tmp_path / LookupCache.default_path).put('hello', ('hello', [], None))
+    dictionary = create_dictionary(args, None, str(tmp_path))
+    assert not dictionary.costs_query('hello'), 'Expected the existing cache to be read'
+    kanki = Kanki(dictionary=dictionary, vocab=vocab_db, book_titles=['The Stand'])
+    kanki.print_export_plan()
+    assert '2 API queries needed' in capsys.readouterr().out
+    assert sorted(path.name for path in tmp_path.iterdir()) == [LookupCache.default_path]
+    lookup.assert_not_called()
+    with pytest.raises(RuntimeError):
+        dictionary.lookup('hello')
+
+
+def test_plan_skips_failed_words(vocab_db: VocabDB, tmp_path, capsys: pytest.CaptureFixture):
+    args = get_arg_parser().parse_args(['-t', 'The Stand', '--plan'])
+    LookupCache(tmp_path / LookupCache.default_path).put('hello', ('hello', [], None))
+    DeadLetters(tmp_path / DeadLetters.default_path).record('bar', MissingWordError('bar'))
+    dictionary = create_dictionary(args, None, str(tmp_path))
+    Kanki(dictionary=dictionary, vocab=vocab_db, book_titles=['The Stand']).print_export_plan()
+    out = capsys.readouterr().out
+    assert '3 unique words, 1 of them already cached' in out, 'Expected failed words not to count as cached'
+    assert '1 words will be skipped' in out
+    assert '1 API queries needed' in out
+
+
+def test_select_unknown_book(vocab_db: VocabDB):
+    kanki = Kanki(vocab=vocab_db, book_titles=['Unknown book'])
+    with pytest.raises(SystemExit):
+        kanki.select_lookups()
+
+
 def test_flatten():
     assert Kanki.flatten([]) == []
     assert Kanki.flatten([[]]) == []
@@ -62,3 +165,79 @@ def test_flatten():
     assert Kanki.flatten([[], [], [1]]) == [1]
     assert Kanki.flatten([[1], [2]]) == [1, 2]
     assert Kanki.flatten([[1, 2], [3]]) == [1, 2, 3]
+
+
+def test_create_flashcards(vocab_db: VocabDB, mocker: pytest_mock.MockerFixture):
+    def mock_lookup(word):
+        if word == 'foo':
+            raise KeyError('shortdef')
+        if word == 'bar':
+            raise TypeError
+        return word.upper(), [f'definition of {word}'], None
+
+    dictionary = mocker.Mock(spec=MWDictionary)
+    dictionary.lookup.side_effect = mock_lookup
+    kanki = Kanki(dictionary=dictionary, vocab=vocab_db, book_titles=['The Stand'], jobs=3)
+
+    cards, failed_words, missing_words = kanki.create_flashcards()
+    assert [c.word for c in cards] == ['HELLO']
+    assert cards[0].definitions == 'definition of hello'
+    assert [c.word for c in failed_words] == ['foo']
+    assert [c.word for c in missing_words] == ['bar']
+
+
+def test_create_flashcards_in_order(vocab_db: VocabDB, mocker: pytest_mock.MockerFixture):
+    def slow_lookup(word):
+        time.sleep({'hello': 3, 'foo': 2, 'bar': 1}[word] / 1000)  # later words finish first
+        return word, [], None
+
+    dictionary = mocker.Mock(spec=MWDictionary)
+    dictionary.lookup.side_effect = slow_lookup
+    kanki = Kanki(dictionary=dictionary, vocab=vocab_db, book_titles=['The Stand'], jobs=3)
+    cards, failed_words, missing_words = kanki.create_flashcards()
+    assert [c.word for c in cards] == ['hello', 'foo', 'bar']
+
+
+def test_create_flashcards_looks_up_each_stem_once(vocab_db: VocabDB, mocker: pytest_mock.MockerFixture):
+    dictionary = mocker.Mock(spec=MWDictionary)
+    dictionary.lookup.side_effect = lambda word: (word, [f'definition of {word}'], None)
+    kanki = Kanki(dictionary=dictionary, vocab=vocab_db, book_titles=['The Stand', 'Dune Messiah'])
+
+    cards, failed_words, missing_words = kanki.create_flashcards()
+    assert sorted(call.args[0] for call in dictionary.lookup.call_args_list) == ['bar', 'foo', 'hello', 'run']
+    assert [c.word for c in cards] == ['hello', 'foo', 'bar', 'run', 'run', 'foo']
+    assert [c.sentence for c in cards][-3:] == ['running sentence', 'ran sentence', 'another foo sentence']
+    assert [c.book_title for c in cards][-1] == 'Dune Messiah'
+
+
+def test_since_last(vocab_db: VocabDB, tmp_path, mocker: pytest_mock.MockerFixture):
+    state = ExportState(tmp_path / 'state.json')
+    state.update('The Stand', 2)
+    kanki = Kanki(vocab=vocab_db, book_titles=['The Stand', 'Dune Messiah'], state=state, since_last=True)
+    assert [lookup[0] for lookup in kanki.get_lookups('The Stand')] == ['bar']
+
+    state.update('Dune Messiah', 7)
+    counts, lookups = kanki.select_lookups()
+    assert [lookup.word for lookup in lookups] == ['bar']
+    assert kanki.book_titles == ['The Stand'], 'Expected books without new lookups to be removed'
+
+    mocker.patch('kanki.run.datetime').today.return_value.strftime.return_value = '2022-06-01'
+    assert kanki.export_paths() == ('kanki_export_2022-06-01.txt', 'kanki_failed_words_2022-06-01.txt')
+
+
+def test_prefetch(vocab_db: VocabDB, fake_api: FakeMWServer, tmp_path):
+    fake_api.suggestion_rate = 0
+    cache = LookupCache(tmp_path / 'cache.db')
+    ledger = QuotaLedger(4, tmp_path / 'quota.json')
+    ledger.record()
+    dictionary = MWDictionary('dummy', cache, pool_size=2, ledger=ledger, api_base_url=fake_api.url)
+    dictionary.max_queries = 4
+    kanki = Kanki(dictionary=dictionary, vocab=vocab_db, jobs=2)
+    assert kanki.prefetch_words(3) == ['run', 'foo', 'physics'], 'Expected the most recently read book first'
+
+    kanki.prefetch(limit=1)
+    assert fake_api.queries == 1
+    kanki.prefetch()
+    assert fake_api.queries == 3, 'Expected only the queries left today to be spent'
+    assert ledger.remaining() == 0
+    assert kanki.prefetch_words(3) == ['hello', 'bar'], 'Expected prefetched words not to cost queries any more'
@@ -0,0 +1,59 @@
+import json
+
+import pytest
+import pytest_mock
+
+from kanki.dictionary import FallbackDictionary
+from kanki.local_dictionary import LocalDictionary
+from kanki.merriam_webster import MWDictionary
+
+
+@pytest.fixture
+def local_dictionary(tmp_path):
+    entries = [
+        {'meta': {'id': 'run:1', 'stems': ['run', 'ran', 'running', 'runs']},
+         'hwi': {'hw': 'run', 'prs': [{'ipa': 'ˈrʌn'}]},
+         'shortdef': ['to go faster than a walk']},
+        {'meta': {'id': 'run:2', 'stems': ['run', 'runs']}, 'hwi': {'hw': 'run'}, 'shortdef': ['an act of running']},
+        {'word': 'hello', 'definitions': ['a greeting'], 'forms': ['hellos']},
+        {'meta': {'id': 'broken'}},
+    ]
+    dump_path = tmp_path / 'dump.jsonl'
+    dump_path.write_text('\n'.join(json.dumps(entry) for entry in entries) + '\n', encoding='utf-8')
+    index_path = tmp_path / LocalDictionary.default_path
+    assert LocalDictionary.build(dump_path, index_path) == 6
+    dictionary = LocalDictionary(index_path)
+    yield dictionary
+    dictionary.close()
+
+
+def test_lookup(local_dictionary: LocalDictionary):
+    assert local_dictionary.lookup('run') == ('run', ['to go faster than a walk'], 'ˈrʌn'), \
+        'Expected the first entry of a headword to be used'
+    assert local_dictionary.lookup(' Running') == local_dictionary.lookup('ran'), \
+        'Expected inflections to find the entry of their headword'
+    assert local_dictionary.lookup('hellos') == ('hello', ['a greeting'], None)
+    assert local_dictionary.has_entry('hello')
+    assert not local_dictionary.has_entry('broken'), 'Expected unparseable entries to be skipped'
+    with pytest.raises(TypeError):
+        local_dictionary.lookup('foo')
+
+
+def test_lookup_in_empty_index(tmp_path):
+    (tmp_path / 'dump.jsonl').write_text('', encoding='utf-8')
+    assert LocalDictionary.build(tmp_path / 'dump.jsonl', tmp_path / 'empty.idx') == 0
+    with pytest.raises(TypeError):
+        LocalDictionary(tmp_path / 'empty.idx').lookup('foo')
+
+
+def test_fallback(local_dictionary: LocalDictionary, mocker: pytest_mock.MockerFixture):
+    online = MWDictionary('dummy')
+    mocker.patch.object(online, 'lookup', return_value=('foo', ['a placeholder'], None))
+    dictionary = FallbackDictionary(local_dictionary, online)
+
+    assert dictionary.lookup('ran')[0] == 'run'
+    assert dictionary.lookup('foo') == ('foo', ['a placeholder'], None)
+    online.lookup.assert_called_once_with('foo')
+    assert not dictionary.costs_query('ran'), 'Expected words in the local dictionary to be free'
+    assert dictionary.costs_query('foo')
+    assert dictionary.max_queries == MWDictionary.max_queries
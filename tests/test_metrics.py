@@ -0,0 +1,55 @@
+import json
+import pstats
+
+import pytest
+
+from benchmarks.fake_api import FakeMWServer
+from kanki.cache import LookupCache
+from kanki.merriam_webster import MWDictionary
+from kanki.metrics import Metrics, timer
+from kanki.run import Kanki
+from kanki.vocab import VocabDB
+
+
+def test_metrics_report():
+    metrics = Metrics()
+    with metrics.timer('sql'):
+        pass
+    assert list(metrics.timed_iter('sql', [1, 2])) == [1, 2]
+    with timer(None, 'ignored'):
+        pass
+    for status, seconds in [(200, 0.005), (200, 0.04), (503, 20)]:
+        metrics.record_response(status, seconds)
+    metrics.count('words_missing', 2)
+
+    report = metrics.report(books=['The Stand'])
+    assert report['books'] == ['The Stand']
+    assert report['phases']['sql']['calls'] == 4, 'Expected every item and the end of the iterator to be timed'
+    assert 'ignored' not in report['phases']
+    assert report['http_status'] == {'200': 2, '503': 1}
+    assert report['api_latency_ms']['count'] == 3
+    assert report['api_latency_ms']['max'] == 20000
+    histogram = report['api_latency_ms']['histogram']
+    assert (histogram['<=10'], histogram['<=50'], histogram['>10000']) == (1, 1, 1)
+    assert report['counts'] == {'words_missing': 2}
+
+
+def test_export_metrics(vocab_db: VocabDB, fake_api: FakeMWServer, tmp_path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.chdir(tmp_path)
+    dictionary = MWDictionary('dummy', LookupCache(tmp_path / 'cache.db'), api_base_url=fake_api.url)
+    kanki = Kanki(dictionary=dictionary, vocab=vocab_db, book_titles=['The Stand', 'Dune Messiah'], jobs=2)
+    kanki.export_book_lookups(metrics_path='metrics.json', profile_path='export.prof')
+
+    with open('metrics.json', encoding='utf-8') as f:
+        report = json.load(f)
+    assert report['books'] == ['The Stand', 'Dune Messiah']
+    assert report['api_queries'] == 4
+    assert report['http_status'] == {'200': 4}
+    assert report['api_latency_ms']['count'] == 4
+    assert report['cache'] == {'hits': 0, 'misses': 4, 'inflection_hits': 0}
+    counts = report['counts']
+    assert counts['cards_exported'] + counts['words_missing'] == 6
+    assert {'select', 'sql', 'http', 'json', 'wait', 'write', 'checkpoint', 'total'} <= report['phases'].keys()
+
+    stats = pstats.Stats('export.prof')
+    assert any(function == 'lookup' for _, _, function in stats.stats), 'Expected lookups in worker threads profiled'
@@ -0,0 +1,62 @@
+import io
+import json
+
+import pytest_mock
+
+from kanki.merriam_webster import MWDictionary
+from kanki.progress import EventLog, Progress
+from kanki.run import Kanki
+from kanki.vocab import VocabDB
+
+
+def test_progress_is_throttled(mocker: pytest_mock.MockerFixture):
+    clock = mocker.patch('kanki.progress.time.monotonic', return_value=0.0)
+    stream = io.StringIO()
+    progress = Progress(20, stream=stream, interval=1.0)
+    for i in range(20):
+        clock.return_value = (i + 1) * 0.25
+        progress.record('foo', Progress.MISSING if i == 0 else Progress.RESOLVED)
+    assert stream.getvalue().splitlines() == [
+        '[ 4/20] Looking up words, 4.0 words/s, 4s left: 3 OK, 0 bad API responses, 1 not found',
+        '[ 8/20] Looking up words, 4.0 words/s, 3s left: 7 OK, 0 bad API responses, 1 not found',
+        '[12/20] Looking up words, 4.0 words/s, 2s left: 11 OK, 0 bad API responses, 1 not found',
+        '[16/20] Looking up words, 4.0 words/s, 1s left: 15 OK, 0 bad API responses, 1 not found',
+        '[20/20] Looking up words, 4.0 words/s, done in 5s: 19 OK, 0 bad API responses, 1 not found',
+    ], 'Expected the progress to be shown at most once a second'
+
+
+def test_quiet_progress():
+    stream = io.StringIO()
+    with Progress(2, stream=stream, quiet=True, interval=0) as progress:
+        progress.record('foo', Progress.RESOLVED)
+        progress.record('bar', Progress.MISSING)
+    assert stream.getvalue() == ''
+
+
+def test_format_seconds():
+    assert Progress.format_seconds(5.4) == '5s'
+    assert Progress.format_seconds(65) == '1m 05s'
+    assert Progress.format_seconds(3 * 60 * 60 + 60) == '3h 01m'
+
+
+def test_events(vocab_db: VocabDB, tmp_path, mocker: pytest_mock.MockerFixture):
+    def lookup(word: str):
+        if word == 'physics':
+            raise TypeError(f'{word} not found')
+        if word == 'hello':
+            raise KeyError('shortdef')
+        return word, [f'definition of {word}'], None
+
+    dictionary = mocker.Mock(spec=MWDictionary)
+    dictionary.lookup.side_effect = lookup
+    kanki = Kanki(dictionary=dictionary, vocab=vocab_db, book_titles=['The Stand'])
+    kanki.quiet = True
+    kanki.events = EventLog(tmp_path / 'events.jsonl')
+    kanki.create_flashcards()
+    kanki.events.close()
+
+    events = [json.loads(line) for line in (tmp_path / 'events.jsonl').read_text(encoding='utf-8').splitlines()]
+    assert [(event['event'], event['word']) for event in events] == [
+        ('failed', 'hello'), ('resolved', 'foo'), ('resolved', 'bar')]
+    assert events[0]['error'] == "'shortdef'"
+    assert events[1]['book'] == 'The Stand' and events[1]['headword'] == 'foo'
@@ -0,0 +1,38 @@
+import datetime
+
+import pytest_mock
+
+from kanki.quota import QuotaLedger
+
+
+def test_quota_ledger(tmp_path):
+    ledger = QuotaLedger(10, tmp_path / 'quota.json')
+    assert ledger.remaining() == 10
+    ledger.record(3)
+    assert QuotaLedger(10, tmp_path / 'quota.json').remaining() == 7, 'Expected spent queries to be saved'
+    assert ledger.days_needed(7) == 1
+    assert ledger.days_needed(8) == 2
+    assert ledger.days_needed(27) == 3
+
+
+def test_quota_ledger_new_day(tmp_path, mocker: pytest_mock.MockerFixture):
+    ledger = QuotaLedger(10, tmp_path / 'quota.json')
+    ledger.record(10)
+    assert ledger.remaining() == 0
+
+    tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+    mocker.patch('kanki.quota.date').today.return_value = tomorrow
+    assert ledger.remaining() == 10
+    assert QuotaLedger(10, tmp_path / 'quota.json').remaining() == 10
+
+
+def test_reserve_queries(tmp_path):
+    ledger = QuotaLedger(3, tmp_path / 'quota.json')
+    assert ledger.reserve() and ledger.reserve()
+    assert ledger.spare() == 1
+    ledger.record()
+    assert (ledger.remaining(), ledger.spare()) == (2, 1), 'Expected a query to use up a reservation'
+    assert ledger.reserve()
+    assert not ledger.reserve(), 'Expected no more queries to spare'
+    ledger.release()
+    assert ledger.spare() == 2
@@ -0,0 +1,95 @@
+from datetime import date
+
+import pytest
+import pytest_mock
+
+from kanki.merriam_webster import MWDictionary
+from kanki.run import Kanki, get_arg_parser
+from kanki.search import LookupFilter, SearchIndex, day_to_timestamp
+from kanki.state import ExportState
+from kanki.vocab import VocabDB
+
+
+def test_search(vocab_db: VocabDB, tmp_path):
+    index = SearchIndex(tmp_path / 'search.db')
+    assert index.sync(vocab_db) == 7
+    assert index.sync(vocab_db) == 0
+
+    def words(**options) -> list:
+        return [lookup.word for lookup in index.search(LookupFilter(**options))]
+
+    assert words(match='sentence') == ['foo', 'ran', 'running', 'bar', 'foo'], 'Expected the most recent first'
+    assert words(match='"another foo"') == ['foo']
+    assert words(match='dune') == ['foo', 'ran', 'running'], 'Expected book titles to be searched'
+    assert words(words='RUN*') == ['ran', 'running'], 'Expected stems to match too'
+    assert words(match='sentence', titles=('the stand', )) == ['bar', 'foo']
+    assert words(first_day=date(1970, 1, 1), last_day=date(1970, 1, 1)) == ['foo', 'ran', 'running', 'physics', 'bar',
+                                                                           'foo', 'hello']
+    assert words(first_day=date(1970, 1, 2)) == []
+    assert index.search(LookupFilter(match='foo'), limit=1)[0].id == 'ID3:pos:3'
+
+
+def test_sync(vocab_db: VocabDB, tmp_path):
+    index = SearchIndex(tmp_path / 'search.db')
+    index.sync(vocab_db)
+    vocab_db.connection.execute("INSERT INTO LOOKUPS VALUES ('ID1:pos:4', 'en:bar', 'ID1', 'dict1', 'pos:4', "
+                                "'an old bar', 2)")
+    vocab_db.connection.execute("DELETE FROM LOOKUPS WHERE id = 'ID1:pos:1'")
+    assert index.sync(vocab_db) == 2, 'Expected lookups added out of order and removed lookups to be found'
+    assert [lookup.id for lookup in index.search(LookupFilter(match='bar'))] == ['ID1:pos:3', 'ID1:pos:4']
+    assert index.search(LookupFilter(match='hello')) == []
+
+
+def test_export_filter(vocab_db: VocabDB, tmp_path, monkeypatch: pytest.MonkeyPatch,
+                       mocker: pytest_mock.MockerFixture):
+    kanki = Kanki(vocab=vocab_db, book_titles=['The Stand', 'Dune Messiah'])
+    kanki.search_index = SearchIndex(tmp_path / 'search.db')
+    kanki.lookup_filter = LookupFilter(match='foo OR sir')
+    counts, lookups = kanki.select_lookups()
+    assert counts == [2, 1]
+    assert [lookup.word for lookup in lookups] == ['hello', 'foo', 'foo'], 'Expected the order of an export'
+
+    kanki.lookup_filter = LookupFilter(words='ran')
+    counts, lookups = kanki.select_lookups()
+    assert kanki.book_titles == ['Dune Messiah']
+    assert counts == [1]
+
+    monkeypatch.chdir(tmp_path)
+    dictionary = mocker.Mock(spec=MWDictionary)
+    dictionary.lookup.side_effect = lambda word: (word, [f'definition of {word}'], None)
+    dictionary.max_queries = None
+    state = ExportState(tmp_path / 'state.json')
+    state.update('The Stand', 3)
+    kanki = Kanki(dictionary=dictionary, vocab=vocab_db, book_titles=['The Stand'], state=state)
+    kanki.lookup_filter = LookupFilter(words='hello')
+    kanki.export_book_lookups()
+    assert state.last_timestamp('The Stand') == 3, 'Expected a filtered export not to move the mark of --since-last'
+    assert not (tmp_path / 'state.json').exists()
+
+
+def test_export_filter_streams_lookups(vocab_db: VocabDB, tmp_path, mocker: pytest_mock.MockerFixture):
+    state = ExportState(tmp_path / 'state.json')
+    state.update('The Stand', 1)
+    kanki = Kanki(vocab=vocab_db, book_titles=['The Stand', 'Dune Messiah'], state=state, since_last=True)
+    kanki.search_index = SearchIndex(tmp_path / 'search.db')
+    kanki.lookup_filter = LookupFilter(match='foo OR sir')
+    ids = mocker.spy(kanki.search_index, 'ids')
+    counts, lookups = kanki.select_lookups()
+    assert counts == [1, 1], 'Expected only the lookups since the last export to be counted'
+    ids.assert_not_called()
+    assert next(lookups).usage == 'foo sentence'
+    assert ids.call_count == 1, 'Expected the matches to be found book by book'
+    assert [lookup.usage for lookup in lookups] == ['another foo sentence']
+    assert ids.call_count == 2
+
+
+def test_filter_arguments():
+    args = get_arg_parser().parse_args(['--words', 'b*', '--from', '2022-05-01', 'search'])
+    assert (args.words, args.first_day) == ('b*', date(2022, 5, 1)), \
+        'Expected the filters of kanki itself to apply to search'
+    args = get_arg_parser().parse_args(['search', '--words', 'b*'])
+    assert (args.words, args.first_day) == ('b*', None)
+
+
+def test_day_to_timestamp():
+    assert day_to_timestamp(date(1970, 1, 2)) == 24 * 60 * 60 * 1000
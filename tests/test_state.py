@@ -0,0 +1,14 @@
+from kanki.state import ExportState
+
+
+def test_export_state(tmp_path):
+    state = ExportState(tmp_path / 'state.json')
+    assert state.last_timestamp('The Stand') == 0
+    state.update('The Stand', 3)
+    assert state.last_timestamp('THE STAND') == 3, 'Expected case insensitive titles'
+    state.pending = ['Dune Messiah']
+    state.save()
+
+    saved_state = ExportState(tmp_path / 'state.json')
+    assert saved_state.last_timestamp('The Stand') == 3
+    assert saved_state.pending == ['Dune Messiah']
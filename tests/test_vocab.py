@@ -0,0 +1,108 @@
+import sqlite3
+
+import pytest
+
+from kanki.exceptions import MissingBookError, MissingVocabError
+from kanki.vocab import VocabDB
+from tests.conftest import insert_books, insert_lookups, insert_words
+
+
+def test_catalog(vocab_db: VocabDB):
+    catalog = vocab_db.catalog()
+    assert [book.title for book in catalog] == ['Dune Messiah', '"Surely You\'re Joking, Mr. Feynman!": '
+                                                                'Adventures of a Curious Character', 'The Stand']
+    assert [book.lookups for book in catalog] == [3, 1, 3]
+    assert vocab_db.book('the stand').keys == ('ID1', )
+    with pytest.raises(MissingBookError):
+        vocab_db.book('Unknown book')
+
+
+def test_lookups(vocab_db: VocabDB):
+    lookups = list(vocab_db.lookups(['dune messiah', 'The Stand']))
+    assert [lookup.word for lookup in lookups] == ['running', 'ran', 'foo', 'hello', 'foo', 'bar'], \
+        'Expected lookups in the order of the given books'
+    assert lookups[0].stem == 'run'
+    assert lookups[0].title == 'Dune Messiah'
+    assert lookups[0].id == 'ID3:pos:1'
+
+    lookups = vocab_db.lookups(['The Stand', 'Dune Messiah'], since={'the stand': 2, 'Dune Messiah': 6})
+    assert [lookup.word for lookup in lookups] == ['bar', 'foo']
+
+
+def test_open_read_only(tmp_path):
+    path = tmp_path / 'vocab.db'
+    connection = sqlite3.connect(path)
+    cursor = connection.cursor()
+    insert_books(cursor)
+    insert_words(cursor)
+    insert_lookups(cursor)
+    connection.commit()
+    connection.close()
+
+    vocab_db = VocabDB.open(path)
+    assert vocab_db.count_lookups('The Stand') == 3
+    with pytest.raises(sqlite3.OperationalError):
+        vocab_db.connection.execute('DELETE FROM LOOKUPS')
+
+
+def test_count_lookups_since(vocab_db: VocabDB):
+    assert vocab_db.count_lookups_since(['The Stand', 'Dune Messiah']) == [3, 3]
+    assert vocab_db.count_lookups_since(['The Stand', 'Dune Messiah'], since={'The Stand': 3}) == [0, 3]
+
+
+def test_open_many(tmp_path):
+    (tmp_path / 'kindle2').mkdir()
+    first = sqlite3.connect(tmp_path / 'kindle1.db')
+    insert_books(first)
+    insert_words(first)
+    insert_lookups(first)
+    first.commit()
+    first.close()
+
+    # Another Kindle with one of the books under a different id, and a lookup synced from the first Kindle
+    second = sqlite3.connect(tmp_path / 'kindle2' / 'vocab.db')
+    insert_books(second)
+    insert_words(second)
+    insert_lookups(second)
+    second.execute('DELETE FROM LOOKUPS')
+    second.execute('DELETE FROM BOOK_INFO')
+    second.executemany('INSERT INTO BOOK_INFO VALUES (?, ?, ?, ?, ?, ?)', [
+        ('ID9', 'asin', 'ID1', 'en', 'The Stand', 'King, Stephen'),
+        ('ID10', 'asin', 'ID10', 'en', 'Solaris', 'Lem, Stanisław'),
+    ])
+    second.executemany('INSERT INTO WORDS VALUES (?, ?, ?, ?, ?, ?, ?)', [('en:new', 'new', 'new', 'en', 0, 8, '')])
+    second.executemany('INSERT INTO LOOKUPS VALUES (?, ?, ?, ?, ?, ?, ?)', [
+        ('ID9:pos:1', 'en:hello', 'ID9', 'dict1', 'pos:1', 'hello sir', 10),
+        ('ID9:pos:9', 'en:new', 'ID9', 'dict1', 'pos:9', 'a new sentence', 11),
+        ('ID10:pos:1', 'en:bar', 'ID10', 'dict1', 'pos:1', 'bar sentence', 12),
+    ])
+    second.commit()
+    second.close()
+
+    # Other databases, e.g. of the Kindle itself, are skipped
+    other = sqlite3.connect(tmp_path / 'kindle2' / 'annotations.db')
+    other.execute('CREATE TABLE BOOK_INFO (id TEXT)')
+    other.close()
+    (tmp_path / 'notes.db').write_bytes(b'not a database')
+
+    vocab_db = VocabDB.open_many([tmp_path], workers=2)
+    assert vocab_db.sources == 2
+    assert vocab_db.duplicates == 1
+    assert [book.title for book in vocab_db.catalog()][:2] == ['Solaris', 'The Stand']
+    lookups = list(vocab_db.lookups(['The Stand']))
+    assert [(lookup.word, lookup.timestamp) for lookup in lookups] == [('hello', 1), ('foo', 2), ('bar', 3),
+                                                                       ('new', 11)], \
+        'Expected the first of duplicate lookups, and the lookups of both Kindles'
+    assert vocab_db.count_lookups_since(['The Stand', 'Solaris'], since={'The Stand': 3}) == [1, 1]
+
+    single = VocabDB.open_many([tmp_path / 'kindle1.db'])
+    assert single.sources == 1 and single.count_lookups('The Stand') == 3
+
+
+def test_open_many_without_vocab_files(tmp_path):
+    (tmp_path / 'empty').mkdir()
+    with pytest.raises(MissingVocabError):
+        VocabDB.open_many([tmp_path / 'empty'])
+    (tmp_path / 'notes.db').write_bytes(b'not a database')
+    with pytest.raises(MissingVocabError):
+        VocabDB.open_many([tmp_path])
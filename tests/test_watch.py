@@ -0,0 +1,132 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+
+import pytest
+import pytest_mock
+
+import kanki.watch
+
+from kanki.exceptions import ServiceUnavailableError
+from kanki.merriam_webster import MWDictionary
+from kanki.run import Kanki
+from kanki.state import ExportState
+from kanki.watch import VocabWatcher
+from tests.conftest import insert_books, insert_lookups, insert_words
+
+
+def create_vocab_file(path) -> None:
+    connection = sqlite3.connect(path)
+    insert_books(connection)
+    insert_words(connection)
+    insert_lookups(connection)
+    connection.commit()
+    connection.close()
+
+
+def add_lookup(path, lookup_id: str, timestamp: int) -> None:
+    connection = sqlite3.connect(path)
+    connection.execute('INSERT INTO LOOKUPS VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       (lookup_id, 'en:physics', 'ID1', 'dict1', 'pos:9', 'physics sentence', timestamp))
+    connection.commit()
+    connection.close()
+
+
+def test_changes(tmp_path):
+    path = tmp_path / 'vocab.db'
+    create_vocab_file(path)
+    watcher = VocabWatcher([tmp_path], interval=0.01, debounce=0.1)
+    changes = watcher.changes()
+    assert next(changes) == [str(path)], 'Expected the files to be reported right away'
+
+    add_lookup(path, 'ID1:pos:9', 10)
+    os.utime(path, ns=(time.time_ns(), time.time_ns() + 1_000_000_000))  # in case mtime is coarse
+    start = time.monotonic()
+    assert next(changes) == [str(path)]
+    assert time.monotonic() - start >= 0.1, 'Expected the change to be debounced'
+
+
+def test_snapshot_checks_new_files_once(tmp_path, mocker: pytest_mock.MockerFixture, caplog: pytest.LogCaptureFixture):
+    path = tmp_path / 'vocab.db'
+    create_vocab_file(path)
+    other = sqlite3.connect(tmp_path / 'other.db')
+    other.execute('CREATE TABLE notes (text TEXT)')
+    other.commit()
+    other.close()
+    is_vocab_file = mocker.spy(kanki.watch, 'is_vocab_file')
+    watcher = VocabWatcher([tmp_path], interval=0.01, debounce=0.1)
+    for _ in range(3):
+        assert list(watcher.snapshot()) == [str(path)]
+    assert is_vocab_file.call_count == 2, 'Expected every file to be opened once, when it appeared'
+    assert caplog.text.count('other.db') == 1, 'Expected a warning about the other database once'
+
+    add_lookup(path, 'ID1:pos:9', 10)
+    os.utime(path, ns=(time.time_ns(), time.time_ns() + 1_000_000_000))  # in case mtime is coarse
+    assert list(watcher.snapshot()) == [str(path)]
+    assert is_vocab_file.call_count == 3, 'Expected a changed file to be checked again'
+
+
+def test_watch(tmp_path, monkeypatch: pytest.MonkeyPatch, mocker: pytest_mock.MockerFixture):
+    monkeypatch.chdir(tmp_path)
+    path = tmp_path / 'vocab.db'
+    create_vocab_file(path)
+
+    class Syncs:
+        """Stands in for a watcher, with a Kindle syncing a new lookup after the first export."""
+
+        def changes(self):
+            yield [str(path)]
+            add_lookup(path, 'ID1:pos:9', 10)
+            yield [str(path)]
+            yield [str(path)]
+
+    dictionary = mocker.Mock(spec=MWDictionary)
+    dictionary.lookup.side_effect = lambda word: (word, [f'definition of {word}'], None)
+    dictionary.max_queries = None
+    state = ExportState()
+    kanki = Kanki(dictionary=dictionary, state=state, jobs=2)
+    kanki.watch(Syncs())
+
+    exported = [line for name in os.listdir(tmp_path) if name.startswith('kanki_export_')
+                for line in (tmp_path / name).read_text(encoding='utf-8').splitlines() if line.startswith('"')]
+    assert len(exported) == 7 + 1, 'Expected every lookup once, and only the new lookup after the sync'
+    assert exported[-1].startswith('"physics"')
+    assert state.last_timestamp('The Stand') == 10
+    dictionary.close.assert_not_called()
+
+
+def test_watch_survives_outage(tmp_path, monkeypatch: pytest.MonkeyPatch, mocker: pytest_mock.MockerFixture):
+    monkeypatch.chdir(tmp_path)
+    path = tmp_path / 'vocab.db'
+    create_vocab_file(path)
+    available = [False, True]  # during the first and second sync
+
+    def lookup(word: str):
+        if not available[0]:
+            raise ServiceUnavailableError('HTTP 503')
+        return word, [f'definition of {word}'], None
+
+    class Syncs:
+        def changes(self):
+            yield [str(path)]
+            available.pop(0)
+            yield [str(path)]
+
+    dictionary = mocker.Mock(spec=MWDictionary)
+    dictionary.lookup.side_effect = lookup
+    dictionary.max_queries = None
+    state = ExportState()
+    kanki = Kanki(dictionary=dictionary, state=state, jobs=2)
+    kanki.watch(Syncs())
+
+    assert dictionary.reset.call_count == 2, 'Expected the dictionary to be reset before every export'
+    assert state.pending == []
+    assert state.last_timestamp('The Stand') == 3, 'Expected the export stopped by the outage to continue'
+
+
+def test_startup_imports():
+    code = 'import sys, kanki.run; print(" ".join(sorted({"requests", "tabulate"} & sys.modules.keys())))'
+    imported = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout.strip()
+    assert imported == '', 'Expected requests and tabulate to only be imported when needed'